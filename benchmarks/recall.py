@@ -0,0 +1,113 @@
+"""Measure the recall@k lost to a PCA projection and to quantized storage.
+
+    python -m benchmarks.recall --vectors full.npy \\
+        --projection projection-256.npz --k 10 --queries 500
+
+``--vectors`` holds full-precision (768-dim) embeddings of a representative
+sample, e.g. saved by ``python -m embedding.projection --save-vectors``.
+``--queries`` of them are held out as queries; the rest form the index.
+The exact cosine top-k over the full-precision vectors is the baseline,
+and each codec of the local vector store is scored against it, with and
+without the projection.
+"""
+
+import argparse
+import json
+from typing import Optional
+
+import numpy as np
+
+from common.vector_store import CODECS, LocalVectorStore
+
+
+def exact_top_k(index: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    index = index / np.linalg.norm(index, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ index.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def store_top_k(
+    index: np.ndarray, queries: np.ndarray, k: int, codec: str
+) -> np.ndarray:
+    store = LocalVectorStore(index.shape[1], codec=codec)
+    store.upsert([(str(row), vector, {}) for row, vector in enumerate(index)])
+    return np.asarray(
+        [
+            [int(match["id"]) for match in store.query(query, k, False)]
+            for query in queries
+        ]
+    )
+
+
+def recall_at_k(expected: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    return hits / expected.size
+
+
+def recall_report(
+    vectors: np.ndarray,
+    k: int,
+    queries: int,
+    projection: Optional[str] = None,
+    seed: int = 0,
+) -> list:
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    query_vectors, index = vectors[order[:queries]], vectors[order[queries:]]
+    expected = exact_top_k(index, query_vectors, k)
+
+    variants = [(f"{vectors.shape[1]}", index, query_vectors)]
+    if projection:
+        with np.load(projection, allow_pickle=False) as data:
+            mean, components = data["mean"], data["components"]
+        variants.append(
+            (
+                f"{len(components)} (PCA)",
+                (index - mean) @ components.T,
+                (query_vectors - mean) @ components.T,
+            )
+        )
+    report = []
+    for dimension, variant_index, variant_queries in variants:
+        for codec in CODECS:
+            found = store_top_k(variant_index, variant_queries, k, codec)
+            report.append(
+                {
+                    "dimension": dimension,
+                    "codec": codec,
+                    "bytes_per_vector": variant_index.shape[1]
+                    * np.dtype(CODECS[codec]).itemsize
+                    + (4 if codec == "int8" else 0),
+                    f"recall@{k}": round(recall_at_k(expected, found), 4),
+                }
+            )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--vectors", required=True)
+    parser.add_argument("--projection", help="PCA from embedding.projection")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    vectors = np.load(args.vectors).astype(np.float32)
+    if not 0 < args.queries < len(vectors) - args.k:
+        parser.error(f"--queries must leave at least --k of {len(vectors)} vectors")
+    report = recall_report(vectors, args.k, args.queries, args.projection)
+    for row in report:
+        print(
+            f"{row['dimension']:>10} {row['codec']:>8}: "
+            f"{row['bytes_per_vector']:>5} bytes/vector, "
+            f"recall@{args.k}={row[f'recall@{args.k}']}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""Load-test the services and report latency percentiles per endpoint and stage.
+
+    python -m benchmarks.run --boot --replay benchmarks/replay.jsonl \\
+        --concurrency 16 --requests 2000 --output results.json
+
+With ``--boot`` the three services are started locally against stand-ins:
+a seeded local vector store (``VECTOR_STORE=local``) and a directory in
+place of the GCS bucket (``STORAGE_BACKEND=local``), with tracing off
+unless ``--tracing`` is given. Without it, the
+``--*-url`` options point at services that are already running.
+
+Each line of the replay file is one request, replayed in order and cycled
+until ``--requests`` have been sent::
+
+    {"endpoint": "search", "size": [1920, 1080], "params": {"top_k": 10}}
+    {"endpoint": "embed", "image": "tests/data/test_image.jpeg"}
+
+``endpoint`` is ``embed``, ``search`` or ``ingest``. Images are either read
+from ``image`` or generated with the given ``size`` (and ``format``, JPEG by
+default). Unless ``"unique": false`` is set, a few bytes are appended to each
+upload so that caches and deduplication do not hide the work being measured.
+
+Stage breakdowns come from the ``Server-Timing`` header of each response.
+Results are written as JSON; ``--baseline`` compares them with an earlier
+run, e.g. one saved on another commit.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from io import BytesIO
+from itertools import cycle, islice
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {
+    "embedding": ("embedding.main:app", 5000, "/readyz"),
+    "ingesting": ("ingesting.main:app", 5001, "/readyz"),
+    "retriever": ("retriever.main:app", 5002, "/readyz"),
+}
+
+ENDPOINTS = {
+    "embed": ("embedding", "/embed"),
+    "search": ("retriever", "/search_image"),
+    "ingest": ("ingesting", "/push_image"),
+}
+
+
+def load_replay(path: str) -> List[dict]:
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                if entry["endpoint"] not in ENDPOINTS:
+                    raise ValueError(f"Unknown endpoint: {entry['endpoint']}")
+                entries.append(entry)
+    if not entries:
+        raise ValueError(f"No requests in {path}")
+    return entries
+
+
+def render_images(entries: List[dict]) -> Dict[str, bytes]:
+    """Encode every distinct image in the replay once, up front."""
+    images = {}
+    rng = np.random.default_rng(0)
+    for entry in entries:
+        key = image_key(entry)
+        if key in images:
+            continue
+        if "image" in entry:
+            with open(entry["image"], "rb") as f:
+                images[key] = f.read()
+            continue
+        width, height = entry.get("size", [640, 480])
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        buffer = BytesIO()
+        Image.fromarray(pixels).save(buffer, format=entry.get("format", "JPEG"))
+        images[key] = buffer.getvalue()
+    return images
+
+
+def image_key(entry: dict) -> str:
+    if "image" in entry:
+        return entry["image"]
+    return json.dumps([entry.get("size", [640, 480]), entry.get("format", "JPEG")])
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                stages[name] = float(value)
+    return stages
+
+
+def seed_local_store(index_path: str, count: int, dimension: int):
+    from common.vector_store import LocalVectorStore
+
+    store = LocalVectorStore(dimension, path=index_path, flush_every=count + 1)
+    rng = np.random.default_rng(1)
+    for start in range(0, count, 1000):
+        vectors = rng.standard_normal((min(1000, count - start), dimension))
+        store.upsert(
+            [
+                (
+                    f"seed-{start + i}",
+                    vector.tolist(),
+                    {
+                        "gcs_path": f"images/seed-{start + i}.jpg",
+                        "filename": f"seed-{start + i}.jpg",
+                    },
+                )
+                for i, vector in enumerate(vectors)
+            ]
+        )
+    store.flush()
+
+
+def boot_services(workdir: str, args) -> List[subprocess.Popen]:
+    embedding_url = f"http://127.0.0.1:{SERVICES['embedding'][1]}"
+    base_env = {
+        **os.environ,
+        "VECTOR_STORE": "local",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_BUCKET_PATH": os.path.join(workdir, "bucket"),
+        "TRACING_ENABLED": "true" if args.tracing else "false",
+        "EMBEDDING_SERVICE_URL": f"{embedding_url}/embed",
+        "EMBEDDING_BATCH_SERVICE_URL": f"{embedding_url}/embed_batch",
+        "PYTHONPATH": os.pathsep.join(
+            filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])
+        ),
+    }
+    seed_local_store(
+        os.path.join(workdir, "index-retriever"), args.seed_vectors, args.dimension
+    )
+    processes = []
+    for name, (app, port, _) in SERVICES.items():
+        env = {**base_env, "LOCAL_INDEX_PATH": os.path.join(workdir, f"index-{name}")}
+        log = open(os.path.join(workdir, f"{name}.log"), "w")
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", app, "--port", str(port)],
+                cwd=REPO_ROOT,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        )
+    print(f"Booting services (logs in {workdir})")
+    return processes
+
+
+async def wait_until_ready(urls: Dict[str, str], names: List[str], timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        for name in names:
+            path = SERVICES[name][2]
+            while True:
+                try:
+                    response = await client.get(urls[name] + path)
+                    if response.status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{name} was not ready after {timeout}s")
+                await asyncio.sleep(0.5)
+
+
+async def drive(entries, images, urls, concurrency, total, warmup) -> tuple:
+    requests = iter(enumerate(islice(cycle(entries), warmup + total)))
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+
+        async def worker():
+            for index, entry in requests:
+                service, path = ENDPOINTS[entry["endpoint"]]
+                data = images[image_key(entry)]
+                if entry.get("unique", True):
+                    data += f"benchmark-{index}".encode()
+                ext = "png" if entry.get("format") == "PNG" else "jpeg"
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        urls[service] + path,
+                        params=entry.get("params"),
+                        files={"file": (f"image.{ext}", data, f"image/{ext}")},
+                    )
+                    status = response.status_code
+                    stages = parse_server_timing(response.headers.get("Server-Timing"))
+                except httpx.HTTPError:
+                    status, stages = None, {}
+                if index >= warmup:
+                    samples.append(
+                        {
+                            "endpoint": entry["endpoint"],
+                            "status": status,
+                            "latency_ms": (time.perf_counter() - started) * 1000,
+                            "stages_ms": stages,
+                        }
+                    )
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "mean": round(float(np.mean(values)), 3),
+    }
+
+
+def summarize(samples: List[dict], elapsed: float) -> dict:
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample["endpoint"]].append(sample)
+        by_endpoint["all"].append(sample)
+    summary = {}
+    for endpoint, group in by_endpoint.items():
+        ok = [s for s in group if s["status"] == 200]
+        stages = defaultdict(list)
+        # Stage names differ between endpoints, so "all" only reports latency
+        for sample in ok if endpoint != "all" else []:
+            for stage, duration in sample["stages_ms"].items():
+                stages[stage].append(duration)
+        summary[endpoint] = {
+            "requests": len(group),
+            "errors": len(group) - len(ok),
+            "rps": round(len(ok) / elapsed, 3),
+            "latency_ms": percentiles([s["latency_ms"] for s in ok]),
+            "stages_ms": {name: percentiles(values) for name, values in stages.items()},
+        }
+    return summary
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(summary: dict, baseline: Optional[dict]):
+    for endpoint, stats in sorted(summary.items()):
+        latency = stats["latency_ms"]
+        line = (
+            f"{endpoint:>8}: {stats['requests']} requests, {stats['errors']} errors, "
+            f"{stats['rps']} req/s, p50={latency.get('p50')}ms "
+            f"p95={latency.get('p95')}ms p99={latency.get('p99')}ms"
+        )
+        previous = (baseline or {}).get(endpoint)
+        if previous and previous["latency_ms"] and latency:
+            deltas = [
+                f"{key} {latency[key] - previous['latency_ms'][key]:+.1f}ms"
+                for key in ("p50", "p95", "p99")
+            ]
+            line += f" (vs baseline: {', '.join(deltas)}, "
+            line += f"{stats['rps'] - previous['rps']:+.1f} req/s)"
+        print(line)
+        for stage, values in stats["stages_ms"].items():
+            print(f"{'':>10}{stage:<12} p50={values['p50']}ms p95={values['p95']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--replay", default="benchmarks/replay.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run")
+    parser.add_argument("--boot", action="store_true", help="Start the services")
+    parser.add_argument("--seed-vectors", type=int, default=10000)
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument(
+        "--tracing", action="store_true", help="Keep tracing on in booted services"
+    )
+    for name, (_, port, _) in SERVICES.items():
+        parser.add_argument(f"--{name}-url", default=f"http://127.0.0.1:{port}")
+    args = parser.parse_args()
+
+    entries = load_replay(args.replay)
+    images = render_images(entries)
+    urls = {name: getattr(args, f"{name}_url") for name in SERVICES}
+
+    processes = []
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        if args.boot:
+            processes = boot_services(workdir, args)
+        # Search and ingest go through the embedding service as well
+        needed = {"embedding"} | {ENDPOINTS[e["endpoint"]][0] for e in entries}
+        asyncio.run(wait_until_ready(urls, sorted(needed), args.ready_timeout))
+        samples, elapsed = asyncio.run(
+            drive(entries, images, urls, args.concurrency, args.requests, args.warmup)
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    summary = summarize(samples, elapsed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["endpoints"]
+    print_report(summary, baseline)
+    if args.output:
+        results = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {
+                "replay": args.replay,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "booted": args.boot,
+                "tracing": args.tracing if args.boot else None,
+            },
+            "duration_seconds": round(elapsed, 3),
+            "endpoints": summary,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
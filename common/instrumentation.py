@@ -0,0 +1,328 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Optional
+
+from fastapi import HTTPException
+from loguru import logger
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+from opentelemetry.sdk.trace.sampling import (
+    Decision,
+    ParentBased,
+    Sampler,
+    SamplingResult,
+    TraceIdRatioBased,
+)
+from opentelemetry.trace import SpanContext, StatusCode, TraceFlags
+from prometheus_client import Counter, Gauge, Histogram
+
+
+class StageTimer:
+    """Per-request stage durations, reported in a ``Server-Timing`` header.
+
+    The benchmark harness in ``benchmarks/`` reads the header to break
+    latency down by stage. ``failed_stage`` is the first stage that raised.
+    """
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self.failed_stage: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.failed_stage = self.failed_stage or name
+            raise
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def merge(self, other: "StageTimer"):
+        for name, seconds in other.durations.items():
+            self.add(name, seconds)
+
+    def header(self) -> str:
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.2f}"
+            for name, seconds in self.durations.items()
+        )
+
+
+def trace_exemplar() -> Optional[Dict[str, str]]:
+    """Exemplar linking a sample to the current trace, if it is sampled."""
+    context = trace.get_current_span().get_span_context()
+    if not context.is_valid or not context.trace_flags.sampled:
+        return None
+    return {"trace_id": format(context.trace_id, "032x")}
+
+
+class RequestMetrics:
+    """End-to-end and per-stage latency, in-flight requests and errors.
+
+    Histograms carry the trace id as an exemplar (exposed in the
+    OpenMetrics format), so a slow bucket leads to an example trace.
+    Errors are counted by the stage that raised, or ``request`` when the
+    failure happened outside any stage. ``on_request`` is also called with
+    ``(endpoint, status, seconds)`` for every request.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        on_request: Optional[Callable[[str, int, float], None]] = None,
+    ):
+        self.on_request = on_request
+        self.latency = Histogram(
+            f"{service}_request_duration_seconds",
+            "End-to-end request latency",
+            ["endpoint", "status"],
+        )
+        self.stage_latency = Histogram(
+            f"{service}_stage_duration_seconds",
+            "Latency of each stage of a request",
+            ["endpoint", "stage"],
+        )
+        self.in_flight = Gauge(
+            f"{service}_requests_in_flight",
+            "Requests being handled",
+            ["endpoint"],
+            multiprocess_mode="livesum",
+        )
+        self.errors = Counter(
+            f"{service}_request_errors",
+            "Failed requests, by the stage that failed",
+            ["endpoint", "stage", "status"],
+        )
+
+    @contextmanager
+    def track(self, endpoint: str, timer: StageTimer):
+        """Record one request; enter it inside the request's span."""
+        exemplar = trace_exemplar()
+        in_flight = self.in_flight.labels(endpoint)
+        in_flight.inc()
+        start = perf_counter()
+        status = 200
+        try:
+            yield timer
+        except HTTPException as e:
+            status = e.status_code
+            raise
+        except Exception:
+            status = 500
+            raise
+        finally:
+            in_flight.dec()
+            seconds = perf_counter() - start
+            self.latency.labels(endpoint, str(status)).observe(seconds, exemplar)
+            if self.on_request is not None:
+                self.on_request(endpoint, status, seconds)
+            for stage, seconds in timer.durations.items():
+                self.stage_latency.labels(endpoint, stage).observe(seconds, exemplar)
+            if status >= 400:
+                stage = timer.failed_stage or "request"
+                self.errors.labels(endpoint, stage, str(status)).inc()
+
+
+class RecordOnlySampler(Sampler):
+    """Record spans without sampling them, so tail sampling can keep them."""
+
+    def should_sample(self, parent_context, trace_id, name, *args, **kwargs):
+        parent = trace.get_current_span(parent_context).get_span_context()
+        return SamplingResult(Decision.RECORD_ONLY, trace_state=parent.trace_state)
+
+    def get_description(self) -> str:
+        return "RecordOnlySampler"
+
+
+class HeadSampler(TraceIdRatioBased):
+    """Samples ``ratio`` of new traces; the rest are recorded for tail sampling."""
+
+    def should_sample(self, parent_context, trace_id, name, *args, **kwargs):
+        result = super().should_sample(parent_context, trace_id, name, *args, **kwargs)
+        if result.decision is Decision.DROP:
+            return RecordOnlySampler().should_sample(parent_context, trace_id, name)
+        return result
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """Exports head-sampled traces, plus the slow and failed rest.
+
+    Spans of traces that the head sampler passed over are held until the
+    local root span ends. The trace is then exported if the root took at
+    least ``slow_seconds``, or if any of its spans ended in error.
+    Otherwise it is dropped. The decision is local to this service: a
+    downstream service follows only the head decision. At most
+    ``max_traces`` traces are held; the oldest are dropped to make room.
+    """
+
+    def __init__(
+        self, processor: SpanProcessor, slow_seconds: float, max_traces: int = 4096
+    ):
+        self.processor = processor
+        self.slow_seconds = slow_seconds
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+        self._pending: "OrderedDict[int, list]" = OrderedDict()
+
+    def on_start(self, span, parent_context=None):
+        self.processor.on_start(span, parent_context)
+
+    def on_end(self, span: ReadableSpan):
+        if span.context.trace_flags.sampled:
+            self.processor.on_end(span)
+            return
+        trace_id = span.context.trace_id
+        with self._lock:
+            spans = self._pending.get(trace_id)
+            if spans is None:
+                spans = self._pending[trace_id] = []
+                # Oldest traces first; their spans are dropped unexported
+                while len(self._pending) > self.max_traces:
+                    self._pending.popitem(last=False)
+            spans.append(span)
+            is_local_root = span.parent is None or span.parent.is_remote
+            if not is_local_root:
+                return
+            del self._pending[trace_id]
+        duration = (span.end_time - span.start_time) / 1e9
+        failed = any(s.status.status_code is StatusCode.ERROR for s in spans)
+        if duration >= self.slow_seconds or failed:
+            for kept in spans:
+                self.processor.on_end(sampled_copy(kept))
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.processor.force_flush(timeout_millis)
+
+
+def sampled_copy(span: ReadableSpan) -> ReadableSpan:
+    """The same span with its sampled flag set, so exporters accept it."""
+    span_context = span.context
+    return ReadableSpan(
+        name=span.name,
+        context=SpanContext(
+            span_context.trace_id,
+            span_context.span_id,
+            span_context.is_remote,
+            TraceFlags(TraceFlags.SAMPLED),
+            span_context.trace_state,
+        ),
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+def create_span_exporter(
+    name: str,
+    jaeger_agent_host: str = "localhost",
+    jaeger_agent_port: int = 6831,
+    otlp_endpoint: str = "http://localhost:4317",
+):
+    if name == "jaeger":
+        from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+
+        return JaegerExporter(
+            agent_host_name=jaeger_agent_host, agent_port=jaeger_agent_port
+        )
+    if name == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        return OTLPSpanExporter(endpoint=otlp_endpoint)
+    if name == "memory":
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+            InMemorySpanExporter,
+        )
+
+        return InMemorySpanExporter()
+    raise ValueError(f"Unknown trace exporter: {name}")
+
+
+def setup_tracing(
+    service_name: str,
+    exporter: str = "jaeger",
+    sample_ratio: float = 1.0,
+    tail_slow_seconds: float = 0.0,
+    **exporter_options,
+):
+    """Install a tracer provider exporting through ``exporter``.
+
+    Each service passes its ``Config.TRACING_*`` settings, with ``exporter``
+    set to ``"none"`` when tracing is disabled. ``exporter_options`` go to
+    ``create_span_exporter``. Returns the span exporter, or None when
+    tracing is off, in which case the API's no-op tracer is left in place
+    and spans cost next to nothing.
+    """
+    if exporter == "none":
+        logger.info("Tracing is disabled")
+        return None
+    tail_sampling = tail_slow_seconds > 0
+    if tail_sampling:
+        # Unsampled traces are still recorded, for TailSamplingProcessor
+        sampler = ParentBased(
+            HeadSampler(sample_ratio),
+            remote_parent_not_sampled=RecordOnlySampler(),
+            local_parent_not_sampled=RecordOnlySampler(),
+        )
+    else:
+        sampler = ParentBased(TraceIdRatioBased(sample_ratio))
+    provider = TracerProvider(
+        sampler=sampler, resource=Resource.create({SERVICE_NAME: service_name})
+    )
+    span_exporter = create_span_exporter(exporter, **exporter_options)
+    if exporter == "memory":
+        processor = SimpleSpanProcessor(span_exporter)
+    else:
+        processor = BatchSpanProcessor(span_exporter)
+    if tail_sampling:
+        processor = TailSamplingProcessor(processor, tail_slow_seconds)
+    provider.add_span_processor(processor)
+    trace.set_tracer_provider(provider)
+    return span_exporter
+
+
+class TraceContextMiddleware:
+    """Continue the caller's trace from its W3C ``traceparent`` header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        carrier = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in scope["headers"]
+        }
+        token = context.attach(propagate.extract(carrier))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            context.detach(token)
+
+
+def inject_trace_context(headers: dict) -> dict:
+    """Add the current trace context to outgoing request headers."""
+    propagate.inject(headers)
+    return headers
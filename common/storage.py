@@ -0,0 +1,49 @@
+import os
+import shutil
+from pathlib import Path
+
+
+class LocalBlob:
+    """The subset of ``google.cloud.storage.Blob`` the services use."""
+
+    def __init__(self, bucket: "LocalBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def upload_from_string(self, data: bytes, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def upload_from_file(self, file_obj, content_type=None, rewind=False, **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(file_obj, f)
+        os.replace(tmp_path, self.path)
+
+    def generate_signed_url(self, **kwargs) -> str:
+        return Path(self.path).resolve().as_uri()
+
+
+class LocalBucket:
+    """Directory standing in for a GCS bucket, for local runs and benchmarks."""
+
+    def __init__(self, root: str, name: str):
+        self.root = root
+        self.name = name
+
+    def exists(self) -> bool:
+        os.makedirs(self.root, exist_ok=True)
+        return True
+
+    def blob(self, name: str, chunk_size=None) -> LocalBlob:
+        return LocalBlob(self, name)
@@ -0,0 +1,101 @@
+import hashlib
+import os
+from typing import BinaryIO, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+SIGNATURES = {
+    b"\xff\xd8\xff": "JPEG",
+    b"\x89PNG\r\n\x1a\n": "PNG",
+}
+
+
+class UploadLimitMiddleware:
+    """Reject request bodies over ``max_bytes`` before they are parsed.
+
+    A Content-Length above the limit is refused straight away; bodies sent
+    without one are counted as they stream in and cut off at the limit.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse(
+                {"detail": "Request body too large."}, status_code=413
+            )
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(
+                        status_code=413, detail="Request body too large."
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def sniff_format(
+    file: BinaryIO, signatures: Dict[bytes, str] = SIGNATURES
+) -> Optional[str]:
+    """Format from the first bytes of an upload, without reading the rest."""
+    head = file.read(16)
+    file.seek(0)
+    for magic, image_format in signatures.items():
+        if head.startswith(magic):
+            return image_format
+    return None
+
+
+def upload_size(file: UploadFile) -> int:
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+def check_size(file: UploadFile, max_bytes: int):
+    if upload_size(file) > max_bytes:
+        raise HTTPException(
+            status_code=413, detail=f"Images must be at most {max_bytes} bytes."
+        )
+
+
+def check_upload(
+    file: UploadFile, max_bytes: int, signatures: Dict[bytes, str] = SIGNATURES
+) -> str:
+    """Enforce the size limit and the magic bytes before the image is read."""
+    check_size(file, max_bytes)
+    image_format = sniff_format(file.file, signatures)
+    if image_format is None:
+        raise HTTPException(
+            status_code=400, detail="Uploaded file is not a valid image."
+        )
+    return image_format
+
+
+def file_digest(file: BinaryIO, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file object, read in chunks and rewound afterwards."""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
@@ -0,0 +1,451 @@
+import fcntl
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+Vector = Tuple[str, list, dict]
+
+CODECS = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# Rows are scored in blocks so a quantized matrix is never widened whole
+SCORE_BLOCK_ROWS = 8192
+
+
+def encode(vectors: np.ndarray, codec: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize normalised float32 rows; returns the codes and per-row scales.
+
+    ``int8`` is symmetric scalar quantization with one scale per row, so a
+    row decodes as ``codes * scale``. Float codecs have a scale of 1.
+    """
+    if codec == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales
+    return vectors.astype(CODECS[codec]), np.ones(len(vectors), dtype=np.float32)
+
+
+def decode(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+class VectorStore(ABC):
+    """Operations the services need from a vector index.
+
+    ``query`` returns matches as ``{"id", "score", "metadata"}`` dicts and
+    ``fetch`` returns ``{id: {"values", "metadata"}}`` for the ids it found.
+    """
+
+    @abstractmethod
+    def upsert(self, vectors: List[Vector]):
+        """Insert or replace ``(id, values, metadata)`` vectors."""
+
+    @abstractmethod
+    def query(self, vector: list, top_k: int, include_metadata: bool = True):
+        """The ``top_k`` matches closest to ``vector``, best first."""
+
+    @abstractmethod
+    def fetch(self, ids: List[str]) -> Dict[str, dict]:
+        """The stored vectors among ``ids``."""
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        """Remove ``ids``; unknown ids are ignored."""
+
+    def flush(self):
+        pass
+
+
+class PineconeVectorStore(VectorStore):
+    def __init__(self, index):
+        self.index = index
+
+    def upsert(self, vectors: List[Vector]):
+        self.index.upsert(vectors=vectors)
+
+    def query(self, vector: list, top_k: int, include_metadata: bool = True):
+        matching = self.index.query(
+            vector=vector,
+            top_k=top_k,
+            include_values=False,
+            include_metadata=include_metadata,
+        )["matches"]
+        return [
+            {
+                "id": match["id"],
+                "score": float(match["score"]),
+                "metadata": dict(match.get("metadata") or {}),
+            }
+            for match in matching
+        ]
+
+    def fetch(self, ids: List[str]) -> Dict[str, dict]:
+        vectors = self.index.fetch(ids=ids).get("vectors", {})
+        return {
+            vector_id: {
+                "values": list(vector["values"]),
+                "metadata": dict(vector.get("metadata") or {}),
+            }
+            for vector_id, vector in vectors.items()
+        }
+
+    def delete(self, ids: List[str]):
+        self.index.delete(ids=ids)
+
+
+class MirroredVectorStore(VectorStore):
+    """Writes go to both stores, reads to the primary only.
+
+    Keeps a full-precision copy of every vector next to a compressed
+    primary index, for the exact re-ranking stage of two-stage search.
+    """
+
+    def __init__(self, primary: VectorStore, mirror: VectorStore):
+        self.primary = primary
+        self.mirror = mirror
+
+    def upsert(self, vectors: List[Vector]):
+        self.primary.upsert(vectors)
+        self.mirror.upsert(vectors)
+
+    def query(self, vector: list, top_k: int, include_metadata: bool = True):
+        return self.primary.query(vector, top_k, include_metadata)
+
+    def fetch(self, ids: List[str]) -> Dict[str, dict]:
+        return self.primary.fetch(ids)
+
+    def delete(self, ids: List[str]):
+        self.primary.delete(ids)
+        self.mirror.delete(ids)
+
+    def flush(self):
+        self.primary.flush()
+        self.mirror.flush()
+
+
+class LocalVectorStore(VectorStore):
+    """In-process cosine index over a contiguous matrix.
+
+    Rows are L2-normalised on insert so a query is one matrix-vector
+    product followed by ``argpartition`` for the top-k. ``codec`` keeps the
+    rows as float32, float16 (half the memory) or int8 (a quarter). With
+    ``ann="hnsw"`` (requires ``hnswlib``) queries go through an HNSW graph
+    instead of the exact scan; the graph holds its own float32 copy. When
+    ``path`` is set the matrix is saved as ``.npy`` and memory-mapped on the
+    next start, so no vectors are re-downloaded. Any number of processes may
+    read a saved store, but only one may save to it (see ``lock_writer``).
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        path: Optional[str] = None,
+        codec: str = "float32",
+        ann: str = "none",
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 200,
+        hnsw_ef_search: int = 64,
+        flush_every: int = 100,
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown vector codec: {codec}")
+        self.dimension = dimension
+        self.path = path
+        self.codec = codec
+        self.flush_every = flush_every
+        self._lock = threading.RLock()
+        self._vectors = np.empty((0, dimension), dtype=CODECS[codec])
+        self._scales = np.empty(0, dtype=np.float32)
+        self._ids: List[str] = []
+        self._metadata: List[dict] = []
+        self._rows: Dict[str, int] = {}
+        self._pending_writes = 0
+        self._generation = None
+        self._writer_lock = None
+        self._hnsw = None
+        self._hnsw_params = (hnsw_m, hnsw_ef_construction, hnsw_ef_search)
+        if path:
+            self._load()
+        if ann == "hnsw":
+            self._init_hnsw()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _init_hnsw(self):
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("hnswlib is not installed, using exact search instead")
+            return
+        m, ef_construction, ef_search = self._hnsw_params
+        max_elements = max(1024, 2 * len(self))
+        self._hnsw = hnswlib.Index(space="ip", dim=self.dimension)
+        hnsw_path = self._files(self._generation)[2] if self.path else None
+        if hnsw_path and os.path.exists(hnsw_path):
+            self._hnsw.load_index(hnsw_path, max_elements=max_elements)
+        else:
+            self._hnsw.init_index(
+                max_elements=max_elements, M=m, ef_construction=ef_construction
+            )
+            if len(self):
+                self._hnsw.add_items(
+                    self._decoded(slice(len(self))), np.arange(len(self))
+                )
+        self._hnsw.set_ef(ef_search)
+
+    def _normalize(self, values) -> np.ndarray:
+        vectors = np.asarray(values, dtype=np.float32).reshape(-1, self.dimension)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _decoded(self, rows) -> np.ndarray:
+        if self.codec == "float32":
+            return self._vectors[rows]
+        return decode(self._vectors[rows], self._scales[rows])
+
+    def _scores(self, query: np.ndarray, size: int) -> np.ndarray:
+        if self.codec == "float32":
+            return self._vectors[:size] @ query
+        scores = np.empty(size, dtype=np.float32)
+        for start in range(0, size, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, size)
+            block = self._vectors[start:end].astype(np.float32)
+            scores[start:end] = (block @ query) * self._scales[start:end]
+        return scores
+
+    def _reserve(self, size: int):
+        # Memory-mapped matrices are read-only; copy them into a growable
+        # array on the first write.
+        capacity = self._vectors.shape[0]
+        if size <= capacity and not isinstance(self._vectors, np.memmap):
+            return
+        new_capacity = max(size, 2 * capacity, 1024)
+        vectors = np.empty((new_capacity, self.dimension), dtype=CODECS[self.codec])
+        vectors[: len(self)] = self._vectors[: len(self)]
+        scales = np.ones(new_capacity, dtype=np.float32)
+        scales[: len(self)] = self._scales[: len(self)]
+        self._vectors, self._scales = vectors, scales
+        if self._hnsw is not None and new_capacity > self._hnsw.get_max_elements():
+            self._hnsw.resize_index(new_capacity)
+
+    def upsert(self, vectors: List[Vector]):
+        if not vectors:
+            return
+        with self._lock:
+            codes, scales = encode(
+                self._normalize([values for _, values, _ in vectors]), self.codec
+            )
+            self._reserve(len(self) + len(vectors))
+            rows = []
+            for (vector_id, _, metadata), row_codes, scale in zip(
+                vectors, codes, scales
+            ):
+                row = self._rows.get(vector_id)
+                if row is None:
+                    row = len(self._ids)
+                    self._rows[vector_id] = row
+                    self._ids.append(vector_id)
+                    self._metadata.append(dict(metadata or {}))
+                else:
+                    self._metadata[row] = dict(metadata or {})
+                self._vectors[row] = row_codes
+                self._scales[row] = scale
+                rows.append(row)
+            if self._hnsw is not None:
+                self._hnsw.add_items(self._decoded(rows), np.asarray(rows))
+            self._mark_dirty(len(vectors))
+
+    def query(self, vector: list, top_k: int, include_metadata: bool = True):
+        with self._lock:
+            size = len(self)
+            if size == 0 or top_k <= 0:
+                return []
+            query = self._normalize(vector)[0]
+            top_k = min(top_k, size)
+            if self._hnsw is not None:
+                labels, distances = self._hnsw.knn_query(query, k=top_k)
+                rows, scores = labels[0], 1.0 - distances[0]
+            else:
+                all_scores = self._scores(query, size)
+                if top_k < size:
+                    rows = np.argpartition(-all_scores, top_k - 1)[:top_k]
+                else:
+                    rows = np.arange(size)
+                rows = rows[np.argsort(-all_scores[rows])]
+                scores = all_scores[rows]
+            return [
+                {
+                    "id": self._ids[row],
+                    "score": float(score),
+                    "metadata": dict(self._metadata[row]) if include_metadata else {},
+                }
+                for row, score in zip(rows.tolist(), scores.tolist())
+            ]
+
+    def fetch(self, ids: List[str]) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                vector_id: {
+                    "values": self._decoded([self._rows[vector_id]])[0].tolist(),
+                    "metadata": dict(self._metadata[self._rows[vector_id]]),
+                }
+                for vector_id in ids
+                if vector_id in self._rows
+            }
+
+    def fetch_vectors(self, ids: List[str]) -> Tuple[List[str], np.ndarray]:
+        """The ids found and their normalised rows, as one float32 matrix."""
+        with self._lock:
+            found = [vector_id for vector_id in ids if vector_id in self._rows]
+            rows = [self._rows[vector_id] for vector_id in found]
+            if not rows:
+                return [], np.empty((0, self.dimension), dtype=np.float32)
+            return found, self._decoded(rows)
+
+    def delete(self, ids: List[str]):
+        with self._lock:
+            removed = 0
+            for vector_id in ids:
+                row = self._rows.pop(vector_id, None)
+                if row is None:
+                    continue
+                self._reserve(len(self))
+                last = len(self._ids) - 1
+                if row != last:
+                    # Move the last row into the hole to keep the matrix dense
+                    self._vectors[row] = self._vectors[last]
+                    self._scales[row] = self._scales[last]
+                    self._ids[row] = self._ids[last]
+                    self._metadata[row] = self._metadata[last]
+                    self._rows[self._ids[row]] = row
+                    if self._hnsw is not None:
+                        self._hnsw.add_items(self._decoded([row]), [row])
+                if self._hnsw is not None:
+                    self._hnsw.mark_deleted(last)
+                self._ids.pop()
+                self._metadata.pop()
+                removed += 1
+            self._mark_dirty(removed)
+
+    def _mark_dirty(self, count: int):
+        self._pending_writes += count
+        if self.path and self._pending_writes >= self.flush_every:
+            self.flush()
+
+    def _files(self, generation: Optional[int] = None):
+        """Paths of one saved generation; ``None`` is the unversioned layout."""
+        suffix = "" if generation is None else f".{generation}"
+        return (
+            os.path.join(self.path, f"vectors{suffix}.npy"),
+            os.path.join(self.path, "records.json"),
+            os.path.join(self.path, f"hnsw{suffix}.bin"),
+            os.path.join(self.path, f"scales{suffix}.npy"),
+        )
+
+    def flush(self):
+        """Save a new generation of the index.
+
+        The matrix, scales and graph go to files named after the generation;
+        ``records.json`` names it and is replaced last, in one atomic step,
+        so a reader in another process (the retriever's ``ExactReranker``)
+        never pairs new records with an old matrix. The generation before
+        the current one is kept for readers still opening it.
+        """
+        if not self.path or not self._pending_writes:
+            return
+        with self._lock:
+            self.lock_writer()
+            generation = (self._generation or 0) + 1
+            vectors_path, records_path, hnsw_path, scales_path = self._files(generation)
+            with open(vectors_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(self._vectors[: len(self)]))
+            with open(scales_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(self._scales[: len(self)]))
+            if self._hnsw is not None:
+                self._hnsw.save_index(hnsw_path)
+            with open(records_path + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "generation": generation,
+                        "ids": self._ids,
+                        "metadata": self._metadata,
+                    },
+                    f,
+                )
+            os.replace(records_path + ".tmp", records_path)
+            # Generation 0 stands for the unversioned layout of older indexes
+            if generation >= 2:
+                self._remove_generation(generation - 2 or None)
+            self._generation = generation
+            self._pending_writes = 0
+        logger.info(f"Saved {len(self)} vectors to {self.path}")
+
+    def lock_writer(self):
+        """Claim ``path`` as this process's to save to, or raise RuntimeError.
+
+        The claim is an exclusive ``flock`` held until the process exits, so
+        a second writer (another replica on a shared volume) fails here
+        instead of overwriting the first one's generations.
+        """
+        if self._writer_lock is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, "writer.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.path} is already being written by another process; "
+                f"a local vector store supports a single writer"
+            )
+        self._writer_lock = lock_file
+
+    def _remove_generation(self, generation: Optional[int]):
+        vectors_path, _, hnsw_path, scales_path = self._files(generation)
+        for path in (vectors_path, hnsw_path, scales_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load(self):
+        _, records_path, _, _ = self._files()
+        if not os.path.exists(records_path):
+            return
+        with open(records_path) as f:
+            records = json.load(f)
+        generation = records.get("generation")
+        vectors_path, _, _, scales_path = self._files(generation)
+        if generation is None and not os.path.exists(vectors_path):
+            return
+        vectors = np.load(vectors_path, mmap_mode="r")
+        if len(vectors) != len(records["ids"]):
+            raise ValueError(
+                f"Stored vectors have {len(vectors)} rows for "
+                f"{len(records['ids'])} records"
+            )
+        if vectors.shape[1:] != (self.dimension,):
+            raise ValueError(
+                f"Stored vectors have shape {vectors.shape}, "
+                f"expected dimension {self.dimension}"
+            )
+        if vectors.dtype != CODECS[self.codec]:
+            raise ValueError(
+                f"Stored vectors are {vectors.dtype}, expected codec {self.codec}; "
+                f"rebuild the index to change codecs"
+            )
+        self._vectors = vectors
+        if os.path.exists(scales_path):
+            self._scales = np.load(scales_path, mmap_mode="r")
+        else:
+            # Indexes saved before codecs were added are plain float32
+            self._scales = np.ones(len(vectors), dtype=np.float32)
+        self._ids = records["ids"]
+        self._metadata = records["metadata"]
+        self._rows = {vector_id: row for row, vector_id in enumerate(self._ids)}
+        self._generation = generation
+        logger.info(f"Loaded {len(self)} vectors from {self.path}")
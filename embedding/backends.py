@@ -0,0 +1,170 @@
+import math
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from loguru import logger
+
+from embedding.config import Config
+
+
+def cpu_limit() -> int:
+    """CPUs available to this container, rounded up, honouring cgroup quotas."""
+    limit = os.cpu_count() or 1
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            limit = min(limit, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                limit = min(limit, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    return max(1, limit)
+
+
+def configure_threads() -> int:
+    threads = Config.INTRA_OP_THREADS or max(1, cpu_limit() // Config.WORKERS)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op work has started
+        pass
+    logger.info(f"Using {threads} intra-op threads")
+    return threads
+
+
+class ClsEmbedder(torch.nn.Module):
+    """Wrap the HF model so it maps pixel values straight to CLS vectors."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).last_hidden_state[:, 0, :]
+
+
+def quantize_int8(module: torch.nn.Module) -> torch.nn.Module:
+    return torch.ao.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+class EagerBackend:
+    name = "eager"
+
+    def __init__(self, model, int8: bool = False):
+        self.module = ClsEmbedder(model).eval()
+        if int8:
+            self.module = quantize_int8(self.module)
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.module(pixel_values)
+
+
+class TorchScriptBackend(EagerBackend):
+    name = "torchscript"
+
+    def __init__(self, model, int8: bool = False, image_size: int = 224):
+        super().__init__(model, int8=int8)
+        example = torch.zeros(1, 3, image_size, image_size)
+        with torch.inference_mode():
+            traced = torch.jit.trace(self.module, example, check_trace=False)
+            self.module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+class OnnxBackend:
+    """ONNX Runtime session, exported (and optionally quantized) on first use."""
+
+    name = "onnx"
+
+    def __init__(self, model, int8: bool = False, image_size: int = 224):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError(
+                "INFERENCE_BACKEND=onnx requires the 'onnxruntime' package"
+            ) from e
+        path = self._export(model, image_size)
+        if int8:
+            path = self._quantize(path)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    @staticmethod
+    def _export(model, image_size: int) -> str:
+        os.makedirs(Config.MODEL_CACHE_DIR, exist_ok=True)
+        path = os.path.join(
+            Config.MODEL_CACHE_DIR, Config.MODEL_NAME.replace("/", "--") + ".onnx"
+        )
+        if not os.path.exists(path):
+            logger.info(f"Exporting {Config.MODEL_NAME} to {path}")
+            torch.onnx.export(
+                ClsEmbedder(model).eval(),
+                torch.zeros(1, 3, image_size, image_size),
+                path,
+                input_names=["pixel_values"],
+                output_names=["embedding"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "embedding": {0: "batch"}},
+                opset_version=17,
+            )
+        return path
+
+    @staticmethod
+    def _quantize(path: str) -> str:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = path.replace(".onnx", ".int8.onnx")
+        if not os.path.exists(quantized_path):
+            logger.info(f"Quantizing {path} to INT8")
+            quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        (embedding,) = self.session.run(
+            None, {"pixel_values": pixel_values.cpu().numpy()}
+        )
+        return torch.from_numpy(embedding)
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "torchscript": TorchScriptBackend,
+    "onnx": OnnxBackend,
+}
+
+
+def load_backend(model, name: Optional[str] = None, int8: Optional[bool] = None):
+    name = name or Config.INFERENCE_BACKEND
+    int8 = Config.INFERENCE_INT8 if int8 is None else int8
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name}")
+    backend = BACKENDS[name](model, int8=int8)
+    logger.info(f"Inference backend: {name}{' (int8)' if int8 else ''}")
+    return backend
+
+
+def cosine_similarity(reference: torch.Tensor, candidate: torch.Tensor) -> np.ndarray:
+    """Row-wise cosine similarity between two batches of embeddings."""
+    return torch.nn.functional.cosine_similarity(
+        reference.float(), candidate.float(), dim=1
+    ).numpy()
@@ -0,0 +1,139 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Any, Callable, List, Optional
+
+from loguru import logger
+
+
+class MicroBatcher:
+    """Coalesce concurrent requests into a single batched call.
+
+    Items submitted within ``max_wait_ms`` of the first queued item (or until
+    ``max_batch_size`` items are queued) are handed to ``process_batch`` as one
+    list. The batch runs on a dedicated executor so the event loop keeps
+    accepting requests while the model is busy. At most ``max_queue_size``
+    items wait for a batch; ``submit`` raises ``asyncio.QueueFull`` beyond
+    that so callers can shed load instead of queueing without bound.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int,
+        max_wait_ms: float,
+        max_queue_size: int = 0,
+        on_queue_depth: Optional[Callable[[int], None]] = None,
+        on_batch: Optional[Callable[[int], None]] = None,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_queue_size = max(0, max_queue_size)
+        self.on_queue_depth = on_queue_depth
+        self.on_batch = on_batch
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="embedding-batch"
+        )
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    def _ensure_worker(self):
+        # The worker is bound to the loop it was created on; recreate it if the
+        # app is now served from a different loop (e.g. per-request test loops).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue(self.max_queue_size)
+            self._worker = loop.create_task(self._run())
+
+    def has_capacity(self, count: int = 1) -> bool:
+        if not self.max_queue_size or self._queue is None:
+            return True
+        return self._queue.qsize() + count <= self.max_queue_size
+
+    async def submit(self, item):
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._queue.put_nowait((item, future))
+        self._report_queue_depth()
+        return await future
+
+    async def submit_many(self, items: List[Any]) -> List[Any]:
+        """Queue all of ``items`` or, if they do not fit, none of them.
+
+        Raises ``asyncio.QueueFull`` before queueing anything, so a rejected
+        request does not leave part of its items to be embedded for nothing.
+        Items of a cancelled call are skipped by the worker.
+        """
+        self._ensure_worker()
+        if not self.has_capacity(len(items)):
+            raise asyncio.QueueFull
+        futures = []
+        for item in items:
+            future = self._loop.create_future()
+            self._queue.put_nowait((item, future))
+            futures.append(future)
+        self._report_queue_depth()
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def stop(self):
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        self._executor.shutdown(wait=False)
+
+    def _report_queue_depth(self):
+        if self.on_queue_depth is not None:
+            self.on_queue_depth(self._queue.qsize())
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        self._report_queue_depth()
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [
+                (item, future)
+                for item, future in await self._collect()
+                if not future.done()
+            ]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            if self.on_batch is not None:
+                self.on_batch(len(batch))
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.process_batch, items
+                )
+            except Exception as e:
+                logger.error(f"Batch of {len(items)} failed: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,152 @@
+import hashlib
+import os
+from collections import OrderedDict
+from time import time
+from typing import BinaryIO, Callable, Optional, Union
+
+import numpy as np
+from loguru import logger
+
+from common.uploads import file_digest
+from embedding.config import Config
+
+
+def content_digest(data: Union[bytes, BinaryIO]) -> str:
+    if isinstance(data, bytes):
+        return hashlib.sha256(data).hexdigest()
+    return file_digest(data)
+
+
+class EmbeddingCache:
+    """LRU cache of embeddings keyed by the digest of the uploaded bytes.
+
+    Entries live in a fixed table of ``max_entries`` rows. With a ``path``
+    the table is a memory-mapped ``.npy`` file, so a restarted service
+    starts warm. Each row stores its own digest next to the vector, so the
+    table alone is enough to rebuild the index and a reused row can never be
+    served under the key it was evicted from.
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        max_entries: int,
+        ttl_seconds: float = 0,
+        path: Optional[str] = None,
+        on_hit: Optional[Callable[[], None]] = None,
+        on_miss: Optional[Callable[[], None]] = None,
+        on_evict: Optional[Callable[[], None]] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.on_hit = on_hit
+        self.on_miss = on_miss
+        self.on_evict = on_evict
+        dtype = np.dtype(
+            [
+                ("digest", "S64"),
+                ("expires_at", "f8"),
+                ("used_at", "f8"),
+                ("vector", "f4", (dimension,)),
+            ]
+        )
+        self._rows = self._open(path, dtype, max_entries)
+
+        # Rebuild the LRU order from the table, least recently used first
+        live = (self._rows["digest"] != b"") & ~self._expired(self._rows["expires_at"])
+        slots = np.flatnonzero(live)
+        slots = slots[np.argsort(self._rows["used_at"][slots], kind="stable")]
+        self._slots = OrderedDict(
+            (self._rows["digest"][slot].decode(), int(slot)) for slot in slots
+        )
+        self._free = sorted(set(range(max_entries)) - set(self._slots.values()))
+        if path:
+            logger.info(f"Loaded {len(self._slots)} cached embeddings from {path}")
+
+    @staticmethod
+    def _open(path: Optional[str], dtype: np.dtype, max_entries: int) -> np.ndarray:
+        if not path:
+            return np.zeros(max_entries, dtype=dtype)
+        if os.path.exists(path):
+            try:
+                rows = np.load(path, mmap_mode="r+")
+                if rows.dtype == dtype and rows.shape == (max_entries,):
+                    return rows
+            except (OSError, ValueError):
+                pass
+            logger.warning(f"Discarding embedding cache at {path}: layout changed")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=(max_entries,)
+        )
+
+    def _expired(self, expires_at):
+        return (expires_at > 0) & (expires_at <= time())
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def get(self, digest: str) -> Optional[np.ndarray]:
+        slot = self._slots.get(digest)
+        if slot is not None and self._expired(self._rows["expires_at"][slot]):
+            del self._slots[digest]
+            self._free.append(slot)
+            slot = None
+        if slot is None:
+            if self.on_miss is not None:
+                self.on_miss()
+            return None
+        self._slots.move_to_end(digest)
+        self._rows["used_at"][slot] = time()
+        if self.on_hit is not None:
+            self.on_hit()
+        return self._rows["vector"][slot].copy()
+
+    def set(self, digest: str, vector: np.ndarray):
+        slot = self._slots.pop(digest, None)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            elif self._slots:
+                _, slot = self._slots.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict()
+            else:
+                return
+        now = time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds else 0.0
+        self._rows[slot] = (digest.encode(), expires_at, now, vector)
+        self._slots[digest] = slot
+
+    def flush(self):
+        if isinstance(self._rows, np.memmap):
+            self._rows.flush()
+
+
+def get_embedding_cache(
+    dimension: int, on_hit=None, on_miss=None, on_evict=None
+) -> Optional[EmbeddingCache]:
+    if Config.EMBEDDING_CACHE_MAX_ENTRIES <= 0:
+        return None
+    path = None
+    if Config.EMBEDDING_CACHE_DIR:
+        if Config.WORKERS > 1:
+            # Workers would overwrite each other's rows in a shared file
+            logger.warning("EMBEDDING_CACHE_DIR is ignored with more than one worker")
+        else:
+            # Vectors from another model or backend must not be served
+            name = Config.MODEL_NAME.replace("/", "--") + f"-{Config.INFERENCE_BACKEND}"
+            if Config.INFERENCE_INT8:
+                name += "-int8"
+            if Config.PROJECTION_PATH:
+                stem = os.path.basename(Config.PROJECTION_PATH).rsplit(".", 1)[0]
+                name += f"-{stem}"
+            path = os.path.join(Config.EMBEDDING_CACHE_DIR, f"{name}.npy")
+    return EmbeddingCache(
+        dimension,
+        max_entries=Config.EMBEDDING_CACHE_MAX_ENTRIES,
+        ttl_seconds=Config.EMBEDDING_CACHE_TTL_SECONDS,
+        path=path,
+        on_hit=on_hit,
+        on_miss=on_miss,
+        on_evict=on_evict,
+    )
@@ -0,0 +1,59 @@
+import os
+
+
+class Config:
+    # Config for model
+    MODEL_NAME = "facebook/vit-msn-base"
+    MODEL_CACHE_DIR = os.getenv(
+        "MODEL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "embedding")
+    )
+    # Config for inference ("eager", "torchscript" or "onnx", which needs
+    # onnxruntime). Check a new backend with `python -m embedding.parity`.
+    INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+    INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "false").lower() == "true"
+    # 0 means the CPUs of the container limit, split evenly between workers
+    INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))
+    # PCA fitted with `python -m embedding.projection`; empty keeps the model's
+    # 768 dimensions. EMBEDDING_DIMENSION in ingesting and retriever must match.
+    PROJECTION_PATH = os.getenv("PROJECTION_PATH", "")
+    # Config for serving (see gunicorn_conf.py for the multi-worker mode)
+    WORKERS = int(os.getenv("WORKERS", "1"))
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "8099"))
+    # Config for request batching
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+    BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+    # Images waiting for a batch before new requests get a 429 with Retry-After
+    BATCH_MAX_QUEUE = int(os.getenv("BATCH_MAX_QUEUE", "512"))
+    RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    # Config for /embed_batch
+    EMBED_BATCH_MAX_IMAGES = int(os.getenv("EMBED_BATCH_MAX_IMAGES", "256"))
+    # Config for preprocessing
+    FAST_PREPROCESS = os.getenv("FAST_PREPROCESS", "true").lower() == "true"
+    PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+    # Config for the embedding cache (0 entries disables it). With a
+    # directory, the cache is kept in a memory-mapped file across restarts.
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+    EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "0"))
+    EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "")
+    # Config for uploads: larger images are rejected before they are read,
+    # larger request bodies before they are parsed
+    MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 2**20)))
+    MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(128 * 2**20)))
+    # Config for tracing. TRACING_EXPORTER is "jaeger", "otlp", "memory"
+    # (kept in process, for tests) or "none"; TRACING_ENABLED=false also
+    # turns tracing off, e.g. for benchmarks.
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "jaeger")
+    JAEGER_AGENT_HOST = os.getenv(
+        "JAEGER_AGENT_HOST",
+        "jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
+    )
+    JAEGER_AGENT_PORT = int(os.getenv("JAEGER_AGENT_PORT", "6831"))
+    OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4317")
+    # Share of new traces sampled up front; callers' decisions are followed.
+    # With TRACE_TAIL_SLOW_SECONDS > 0, the other traces are still exported
+    # when they are at least that slow or failed. That means recording every
+    # span of every request and holding it until its trace ends, so it is
+    # off by default; turn it on where that cost is acceptable.
+    TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))
+    TRACE_TAIL_SLOW_SECONDS = float(os.getenv("TRACE_TAIL_SLOW_SECONDS", "0"))
@@ -0,0 +1,49 @@
+"""Gunicorn settings for running the embedding service with several workers.
+
+    WORKERS=4 gunicorn -c embedding/gunicorn_conf.py embedding.main:app
+
+The app is imported once by the master (``preload_app``), so the weights are
+loaded a single time (``from_pretrained`` memory-maps safetensors) and the
+forked workers share them copy-on-write. Each worker builds its inference
+backend and runs a warm-up pass after the fork; ``/readyz`` reports ready
+once that pass has finished.
+
+Metrics from ``prometheus_client`` are written per worker under
+``PROMETHEUS_MULTIPROC_DIR`` and served, summed over workers, by the master
+on ``METRICS_PORT``. Instruments created through the OpenTelemetry meter
+stay per process and are not exported in this mode: with ``WORKERS`` above
+1, ``embedding_request_counter`` and the deprecated
+``embedding_response_time_seconds`` are dropped.
+"""
+
+import os
+import tempfile
+
+from embedding.config import Config
+
+# Must be set before prometheus_client is imported by the app
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="embedding-metrics-")
+)
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = Config.WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Building a TorchScript or ONNX backend during warm-up can take a while
+timeout = int(os.getenv("WORKER_TIMEOUT_SECONDS", "120"))
+
+
+def when_ready(server):
+    from prometheus_client import CollectorRegistry, start_http_server
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    start_http_server(port=Config.METRICS_PORT, addr="0.0.0.0", registry=registry)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
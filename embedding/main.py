@@ -1,45 +1,89 @@
-import atexit
+import asyncio
+import os
+import threading
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List
+from typing import BinaryIO, Iterable, List, Optional, Union
 from time import time
+import numpy as np
 import torch
 import uvicorn
 from opentelemetry.exporter.prometheus import PrometheusMetricReader
-from prometheus_client import Gauge, Summary, start_http_server
+from prometheus_client import Counter, Gauge, Histogram, Summary, start_http_server
 from opentelemetry.metrics import set_meter_provider
 from opentelemetry import metrics
 from opentelemetry.sdk.metrics import MeterProvider
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+from fastapi import FastAPI, File, Header, HTTPException, UploadFile
+from loguru import logger
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.trace import get_tracer_provider, set_tracer_provider
+from opentelemetry.trace import get_tracer_provider
 from PIL import Image, UnidentifiedImageError
 from transformers import ViTImageProcessor, ViTMSNModel
 
-set_tracer_provider(
-    TracerProvider(resource=Resource.create({SERVICE_NAME: "embedding-service"}))
+from common.instrumentation import (
+    RequestMetrics,
+    StageTimer,
+    TraceContextMiddleware,
+    setup_tracing,
 )
-tracer = get_tracer_provider().get_tracer("embedding", "0.1.1")
-jaeger_exporter = JaegerExporter(
-    agent_host_name="jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
-    agent_port=6831,
+from common.uploads import (
+    SIGNATURES,
+    UploadLimitMiddleware,
+    check_size,
+    check_upload,
+    sniff_format,
+)
+from embedding.backends import configure_threads, load_backend
+from embedding.batching import MicroBatcher
+from embedding.cache import content_digest, get_embedding_cache
+from embedding.config import Config
+from embedding.preprocessing import FastPreprocessor
+from embedding.projection import get_projection
+from embedding.serialization import encode_vectors, negotiate
+
+span_exporter = setup_tracing(
+    "embedding-service",
+    exporter=Config.TRACING_EXPORTER if Config.TRACING_ENABLED else "none",
+    sample_ratio=Config.TRACE_SAMPLE_RATIO,
+    tail_slow_seconds=Config.TRACE_TAIL_SLOW_SECONDS,
+    jaeger_agent_host=Config.JAEGER_AGENT_HOST,
+    jaeger_agent_port=Config.JAEGER_AGENT_PORT,
+    otlp_endpoint=Config.OTLP_ENDPOINT,
 )
-span_processor = BatchSpanProcessor(jaeger_exporter)
-get_tracer_provider().add_span_processor(span_processor)
-atexit.register(span_processor.shutdown)
+tracer = get_tracer_provider().get_tracer("embedding", "0.1.1")
 
 # Load model & extractor
-MODEL_NAME = "facebook/vit-msn-base"
+MODEL_NAME = Config.MODEL_NAME
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 extractor = ViTImageProcessor.from_pretrained(MODEL_NAME)
 model = ViTMSNModel.from_pretrained(MODEL_NAME).to(DEVICE)
 model.eval()
+projection = get_projection()
+
+# The backend is built on first use rather than at import: under gunicorn the
+# weights above are loaded once by the master and shared with the forked
+# workers, but torch's OpenMP thread pools do not survive a fork.
+inference = None
+inference_lock = threading.Lock()
+ready = False
+
+
+def get_inference():
+    global inference
+    with inference_lock:
+        if inference is None:
+            configure_threads()
+            inference = load_backend(model)
+    return inference
 
-# Start Prometheus client
-start_http_server(port=8099, addr="0.0.0.0")
+
+# Start Prometheus client (the gunicorn master serves the metrics of all
+# workers when PROMETHEUS_MULTIPROC_DIR is set)
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    start_http_server(port=Config.METRICS_PORT, addr="0.0.0.0")
 
 # Service name is required for most backends
 resource = Resource(attributes={SERVICE_NAME: "embedding-service"})
@@ -56,23 +100,238 @@ embedding_counter = meter.create_counter(
     name="embedding_request_counter", description="Number of embedding requests"
 )
 
+embedding_vector_size_gauge = Gauge(
+    "embedding_vector_size", "Size (length) of the last embedding vector"
+)
+
+# Deprecated: superseded by embedding_request_duration_seconds, and still
+# recorded (for successful requests, as before) for one release so existing
+# dashboards and alerts keep working. Remove in the next release.
 embedding_histogram = meter.create_histogram(
     name="embedding_response_time_seconds",
-    description="Response time for embedding requests",
+    description="Response time for embedding requests (deprecated)",
     unit="s",
 )
+embedding_response_time_summary = Summary(
+    "embedding_response_time_summary_seconds",
+    "Summary of embedding response time (deprecated)",
+)
 
-embedding_vector_size_gauge = Gauge(
-    "embedding_vector_size", "Size (length) of the last embedding vector"
+
+def record_legacy_latency(endpoint: str, status: int, seconds: float):
+    if status >= 400:
+        return
+    embedding_histogram.record(seconds, {"api": endpoint})
+    if endpoint == "/embed":
+        embedding_response_time_summary.observe(seconds)
+
+
+request_metrics = RequestMetrics("embedding", on_request=record_legacy_latency)
+
+# prometheus_client rather than the OpenTelemetry meter, so these are also
+# exported when gunicorn runs several workers (see gunicorn_conf.py)
+embedding_batch_size_histogram = Histogram(
+    "embedding_batch_size_images",
+    "Number of images in each batched forward pass",
+    ["api"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
 )
 
-embedding_response_time_summary = Summary(
-    "embedding_response_time_summary_seconds",
-    "Summary of embedding response time",
+embedding_queue_depth_gauge = Gauge(
+    "embedding_batch_queue_depth",
+    "Number of images waiting for a batch slot",
+    multiprocess_mode="livesum",
+)
+
+
+preprocessor = FastPreprocessor(extractor, max_batch_size=Config.BATCH_MAX_SIZE)
+preprocess_pool = ThreadPoolExecutor(
+    max_workers=Config.PREPROCESS_WORKERS, thread_name_prefix="embedding-preprocess"
+)
+
+
+embedding_cache_hit_counter = Counter(
+    "embedding_cache_hits", "Number of embedding cache hits"
+)
+embedding_cache_miss_counter = Counter(
+    "embedding_cache_misses", "Number of embedding cache misses"
+)
+embedding_cache_eviction_counter = Counter(
+    "embedding_cache_evictions",
+    "Number of embedding cache entries evicted to respect the size limit",
+)
+
+embedding_cache = get_embedding_cache(
+    projection.dimension if projection else model.config.hidden_size,
+    on_hit=embedding_cache_hit_counter.inc,
+    on_miss=embedding_cache_miss_counter.inc,
+    on_evict=embedding_cache_eviction_counter.inc,
+)
+
+
+def embed_images(
+    images: list, timer: Optional[StageTimer] = None
+) -> List[torch.Tensor]:
+    timer = timer or StageTimer()
+    with tracer.start_as_current_span("embed_batch") as span:
+        span.set_attribute("batch_size", len(images))
+
+        # Preprocess
+        with tracer.start_as_current_span("preprocess_image"), timer.stage(
+            "preprocess"
+        ):
+            if Config.FAST_PREPROCESS:
+                pixel_values = preprocessor(images)
+            else:
+                pixel_values = extractor(images=images, return_tensors="pt")[
+                    "pixel_values"
+                ]
+
+        # Inference
+        with tracer.start_as_current_span("model_inference"), timer.stage("inference"):
+            embeddings = get_inference()(pixel_values.to(DEVICE))  # CLS token
+            if projection is not None:
+                embeddings = projection(embeddings)
+            return list(embeddings.cpu())
+
+
+def embed_batch(images: list) -> list:
+    """Batcher entry point: each vector comes with the timings of its batch."""
+    timer = StageTimer()
+    return [(vector, timer) for vector in embed_images(images, timer)]
+
+
+NPY_MAGIC = b"\x93NUMPY"
+# Besides images, uploads may be pixels preprocessed by the client
+UPLOAD_SIGNATURES = {**SIGNATURES, NPY_MAGIC: "NPY"}
+
+
+def load_image(data: Union[bytes, BinaryIO]) -> Image.Image:
+    """Decode an encoded image, or wrap uint8 HxWx3 pixels sent as .npy."""
+    file = BytesIO(data) if isinstance(data, bytes) else data
+    is_npy = file.read(len(NPY_MAGIC)) == NPY_MAGIC
+    file.seek(0)
+    if not is_npy:
+        return Image.open(file).convert("RGB")
+    try:
+        pixels = np.load(file, allow_pickle=False)
+    except ValueError:
+        raise UnidentifiedImageError("Invalid pixel array")
+    if pixels.dtype != np.uint8 or pixels.ndim != 3 or pixels.shape[2] != 3:
+        raise UnidentifiedImageError("Pixel arrays must be uint8 HxWx3")
+    return Image.fromarray(pixels, "RGB")
+
+
+# What decoding raises for a bad upload: not an image, a truncated one, a
+# decompression bomb or a malformed pixel array
+INVALID_IMAGE_ERRORS = (
+    UnidentifiedImageError,
+    Image.DecompressionBombError,
+    OSError,
+    SyntaxError,
+    ValueError,
+    EOFError,
+)
+
+
+def prepare_image(data: Union[bytes, BinaryIO]):
+    """Decode one upload and, with fast preprocessing, resize it to uint8."""
+    image = load_image(data)
+    return preprocessor.resize(image) if Config.FAST_PREPROCESS else image
+
+
+async def prepare_images(payloads: list) -> list:
+    # Decoding runs on its own pool so it overlaps with inference of the
+    # previous batch instead of blocking the event loop.
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        *(loop.run_in_executor(preprocess_pool, prepare_image, d) for d in payloads),
+        return_exceptions=True,
+    )
+
+
+def warm_up_image():
+    width, height = preprocessor.size
+    blank = np.zeros((height, width, 3), dtype=np.uint8)
+    return blank if Config.FAST_PREPROCESS else Image.fromarray(blank)
+
+
+async def run_warm_up():
+    """Build the backend and run one forward pass on a blank image.
+
+    The pass goes through the batcher like any request: its thread is the
+    only one allowed to use the preprocessor's batch buffer.
+    """
+    global ready
+    start = time()
+    await batcher.submit(warm_up_image())
+    ready = True
+    logger.info(f"Model warmed up in {time() - start:.2f} seconds")
+
+
+async def cached_vectors(payloads: list):
+    """Digest each upload and look it up in the embedding cache.
+
+    Returns the digests and, per upload, the cached vector or None.
+    """
+    if embedding_cache is None:
+        return [None] * len(payloads), [None] * len(payloads)
+    loop = asyncio.get_running_loop()
+    with tracer.start_as_current_span("cache_lookup"):
+        digests = await asyncio.gather(
+            *(
+                loop.run_in_executor(preprocess_pool, content_digest, d)
+                for d in payloads
+            )
+        )
+        vectors = []
+        for digest in digests:
+            cached = embedding_cache.get(digest)
+            vectors.append(None if cached is None else torch.from_numpy(cached))
+    return digests, vectors
+
+
+def remember(digest: Optional[str], vector: torch.Tensor):
+    if embedding_cache is not None:
+        embedding_cache.set(digest, vector.numpy())
+
+
+batcher = MicroBatcher(
+    embed_batch,
+    max_batch_size=Config.BATCH_MAX_SIZE,
+    max_wait_ms=Config.BATCH_MAX_WAIT_MS,
+    max_queue_size=Config.BATCH_MAX_QUEUE,
+    on_queue_depth=embedding_queue_depth_gauge.set,
+    on_batch=embedding_batch_size_histogram.labels("/embed").observe,
 )
 
+
+def overloaded() -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Embedding queue is full, retry later",
+        headers={"Retry-After": str(Config.RETRY_AFTER_SECONDS)},
+    )
+
+
 # FastAPI app
 app = FastAPI(title="ViT-MSN Embedding Service")
+app.add_middleware(UploadLimitMiddleware, max_bytes=Config.MAX_REQUEST_BYTES)
+app.add_middleware(TraceContextMiddleware)
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    # In the background, so /healthz answers while /readyz waits for the model
+    app.state.warm_up = asyncio.ensure_future(run_warm_up())
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+    preprocess_pool.shutdown(wait=False)
+    if embedding_cache is not None:
+        embedding_cache.flush()
 
 
 @app.get("/")
@@ -85,43 +344,220 @@ def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/readyz")
+def readiness_check():
+    if not ready:
+        raise HTTPException(status_code=503, detail="Model is warming up")
+    return {"status": "ready"}
+
+
 @app.post("/embed", response_model=List[float])
-async def embed_image(file: UploadFile = File(...)):
-    starting_time = time()
-    with tracer.start_as_current_span("embed_image") as span:
-        try:
-            span.set_attribute("file_name", file.filename)
-            span.set_attribute("content_type", file.content_type)
-
-            with tracer.start_as_current_span("load_image"):
-                image = Image.open(BytesIO(await file.read())).convert("RGB")
-
-        except UnidentifiedImageError:
-            span.record_exception(Exception("Invalid image format"))
-            raise HTTPException(
-                status_code=400, detail="Uploaded file is not a valid image."
-            )
+async def embed_image(
+    file: UploadFile = File(...), accept: Optional[str] = Header(default=None)
+):
+    timer = StageTimer()
+    with tracer.start_as_current_span("embed_image") as span, request_metrics.track(
+        "/embed", timer
+    ):
+        media_type, dtype = negotiate(accept)
+        if not batcher.has_capacity():
+            raise overloaded()
+        span.set_attribute("file_name", file.filename)
+        span.set_attribute("content_type", file.content_type)
+        check_upload(file, Config.MAX_UPLOAD_BYTES, UPLOAD_SIGNATURES)
+        # The spooled upload is digested and decoded in place, not read whole
+        data = file.file
+        with timer.stage("cache"):
+            (digest,), (vector,) = await cached_vectors([data])
+        span.set_attribute("cache_hit", vector is not None)
 
-        # Preprocess
-        with tracer.start_as_current_span("preprocess_image"):
-            inputs = extractor(images=image, return_tensors="pt").to(DEVICE)
+        if vector is None:
+            try:
+                with tracer.start_as_current_span("load_image"), timer.stage("decode"):
+                    image = await asyncio.get_running_loop().run_in_executor(
+                        preprocess_pool, prepare_image, data
+                    )
+            except INVALID_IMAGE_ERRORS as e:
+                span.record_exception(e)
+                raise HTTPException(
+                    status_code=400, detail="Uploaded file is not a valid image."
+                )
 
-        # Inference
-        with tracer.start_as_current_span("model_inference"):
-            with torch.no_grad():
-                outputs = model(**inputs)
-                embedding = outputs.last_hidden_state[:, 0, :]  # CLS token
-                vector = embedding.squeeze().cpu().tolist()
+            # Preprocess & inference are batched with concurrent requests
+            # "batch" covers queueing plus the batch's preprocess and inference
+            with tracer.start_as_current_span("wait_for_batch"), timer.stage("batch"):
+                try:
+                    vector, batch_timer = await batcher.submit(image)
+                except asyncio.QueueFull:
+                    raise overloaded()
+            timer.merge(batch_timer)
+            remember(digest, vector)
 
         span.set_attribute("vector_length", len(vector))
-    elapsed_time = time() - starting_time
-    vector_size = len(vector)
-    label = {"api": "/embed"}
-    embedding_counter.add(1, label)
-    embedding_histogram.record(elapsed_time, label)
-    embedding_response_time_summary.observe(elapsed_time)
-    embedding_vector_size_gauge.set(vector_size)
-    return vector
+        with timer.stage("encode"):
+            response = encode_vectors(vector, media_type, dtype)
+    embedding_counter.add(1, {"api": "/embed"})
+    embedding_vector_size_gauge.set(len(vector))
+    response.headers["Server-Timing"] = timer.header()
+    return response
+
+
+ARCHIVE_CONTENT_TYPES = {
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-tar",
+    "application/gzip",
+    "application/x-gzip",
+}
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+
+def is_archive(file: UploadFile) -> bool:
+    filename = (file.filename or "").lower()
+    return file.content_type in ARCHIVE_CONTENT_TYPES or filename.endswith(
+        ARCHIVE_EXTENSIONS
+    )
+
+
+def too_many_images() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"At most {Config.EMBED_BATCH_MAX_IMAGES} images per batch.",
+    )
+
+
+def archive_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Archives may expand to at most {Config.MAX_UPLOAD_BYTES} bytes.",
+    )
+
+
+def read_archive(file: BinaryIO, max_members: int) -> List[bytes]:
+    """Files in a zip or tar archive, in name order.
+
+    The member count and the sizes the archive declares are checked before
+    anything is decompressed, and every read is bounded, so an archive never
+    expands to more than ``Config.MAX_UPLOAD_BYTES`` in memory.
+    """
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        with zipfile.ZipFile(file) as archive:
+            members = sorted(
+                (member for member in archive.infolist() if not member.is_dir()),
+                key=lambda member: member.filename,
+            )
+            check_archive([member.file_size for member in members], max_members)
+            return read_members(archive.open(member) for member in members)
+    file.seek(0)
+    with tarfile.open(fileobj=file, mode="r:*") as archive:
+        members = sorted(
+            (member for member in archive.getmembers() if member.isfile()),
+            key=lambda member: member.name,
+        )
+        check_archive([member.size for member in members], max_members)
+        return read_members(archive.extractfile(member) for member in members)
+
+
+def check_archive(sizes: List[int], max_members: int):
+    if len(sizes) > max_members:
+        raise too_many_images()
+    if sum(sizes) > Config.MAX_UPLOAD_BYTES:
+        raise archive_too_large()
+
+
+def read_members(members: Iterable[BinaryIO]) -> List[bytes]:
+    # Declared sizes are not trusted: reads stop one byte past what is left
+    payloads = []
+    left = Config.MAX_UPLOAD_BYTES
+    for member in members:
+        with member:
+            data = member.read(left + 1)
+        left -= len(data)
+        if left < 0:
+            raise archive_too_large()
+        payloads.append(data)
+    return payloads
+
+
+@app.post("/embed_batch", response_model=List[List[float]])
+async def embed_image_batch(
+    files: List[UploadFile] = File(...), accept: Optional[str] = Header(default=None)
+):
+    timer = StageTimer()
+    with tracer.start_as_current_span(
+        "embed_image_batch"
+    ) as span, request_metrics.track("/embed_batch", timer):
+        media_type, dtype = negotiate(accept)
+        with tracer.start_as_current_span("load_images"):
+            payloads = []
+            for file in files:
+                check_size(file, Config.MAX_UPLOAD_BYTES)
+                if is_archive(file):
+                    max_members = Config.EMBED_BATCH_MAX_IMAGES - len(payloads)
+                    try:
+                        payloads.extend(read_archive(file.file, max_members))
+                    except (tarfile.TarError, zipfile.BadZipFile):
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Uploaded archive {file.filename} is not readable.",
+                        )
+                else:
+                    payloads.append(file.file)
+
+            if len(payloads) > Config.EMBED_BATCH_MAX_IMAGES:
+                raise too_many_images()
+            # The magic bytes /embed checks, for every file and archive member
+            for position, payload in enumerate(payloads):
+                if isinstance(payload, bytes):
+                    payload = BytesIO(payload)
+                if sniff_format(payload, UPLOAD_SIGNATURES) is None:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Image at position {position} is not a valid image.",
+                    )
+            with timer.stage("cache"):
+                digests, vectors = await cached_vectors(payloads)
+            misses = [i for i, vector in enumerate(vectors) if vector is None]
+            if not batcher.has_capacity(len(misses)):
+                raise overloaded()
+
+            with timer.stage("decode"):
+                images = await prepare_images([payloads[i] for i in misses])
+            for position, image in zip(misses, images):
+                if isinstance(image, INVALID_IMAGE_ERRORS):
+                    span.record_exception(image)
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Image at position {position} is not a valid image.",
+                    )
+                if isinstance(image, Exception):
+                    raise image
+        span.set_attribute("image_count", len(payloads))
+        span.set_attribute("cache_hits", len(payloads) - len(misses))
+
+        # Every image joins the batcher queue at once, so they are split into
+        # full batches of Config.BATCH_MAX_SIZE without waiting on the window.
+        with tracer.start_as_current_span("wait_for_batch"), timer.stage("batch"):
+            try:
+                embedded = await batcher.submit_many(images)
+            except asyncio.QueueFull:
+                raise overloaded()
+        for i, (vector, _) in zip(misses, embedded):
+            vectors[i] = vector
+            remember(digests[i], vector)
+        for batch_timer in {id(t): t for _, t in embedded}.values():
+            timer.merge(batch_timer)
+
+        with timer.stage("encode"):
+            if not vectors:
+                response = encode_vectors(torch.empty(0), media_type, dtype)
+            else:
+                embedding_vector_size_gauge.set(len(vectors[0]))
+                response = encode_vectors(torch.stack(vectors), media_type, dtype)
+    embedding_counter.add(len(vectors), {"api": "/embed_batch"})
+    response.headers["Server-Timing"] = timer.header()
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+"""Compare an inference backend against eager PyTorch before switching to it.
+
+    python -m embedding.parity --backend onnx --int8 --images ./samples
+
+Prints the cosine similarity between eager-mode and backend embeddings per
+image and exits non-zero when the minimum falls below ``--threshold``, so
+a backend that would silently shift the vector space is caught before
+anything is re-indexed against it.
+"""
+
+import argparse
+import os
+import sys
+
+from PIL import Image
+from transformers import ViTImageProcessor, ViTMSNModel
+
+from embedding.backends import (
+    BACKENDS,
+    EagerBackend,
+    configure_threads,
+    cosine_similarity,
+    load_backend,
+)
+from embedding.config import Config
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def parity_report(model, pixel_values, backend_name: str, int8: bool) -> dict:
+    reference = EagerBackend(model)(pixel_values)
+    candidate = load_backend(model, backend_name, int8)(pixel_values)
+    similarity = cosine_similarity(reference, candidate)
+    return {
+        "backend": backend_name,
+        "int8": int8,
+        "images": len(similarity),
+        "min_cosine": float(similarity.min()),
+        "mean_cosine": float(similarity.mean()),
+        "per_image": similarity.tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), required=True)
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--images", default="tests/data")
+    parser.add_argument("--threshold", type=float, default=0.99)
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.images, name)
+        for name in os.listdir(args.images)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        sys.exit(f"No images found in {args.images}")
+    images = [Image.open(path).convert("RGB") for path in paths]
+
+    configure_threads()
+    extractor = ViTImageProcessor.from_pretrained(Config.MODEL_NAME)
+    model = ViTMSNModel.from_pretrained(Config.MODEL_NAME).eval()
+    pixel_values = extractor(images=images, return_tensors="pt")["pixel_values"]
+
+    report = parity_report(model, pixel_values, args.backend, args.int8)
+    for path, similarity in zip(paths, report["per_image"]):
+        print(f"{similarity:.6f}  {path}")
+    print(
+        f"{report['backend']}{' int8' if report['int8'] else ''}: "
+        f"min={report['min_cosine']:.6f} mean={report['mean_cosine']:.6f} "
+        f"over {report['images']} images"
+    )
+    if report["min_cosine"] < args.threshold:
+        sys.exit(f"Cosine similarity below {args.threshold}; do not switch backends")
+
+
+if __name__ == "__main__":
+    main()
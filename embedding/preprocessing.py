@@ -0,0 +1,52 @@
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class FastPreprocessor:
+    """Tensor-native replacement for ``ViTImageProcessor`` on the hot path.
+
+    ``resize`` runs per image (PIL, same resampling as the HF processor) and
+    is safe to call from a thread pool. ``__call__`` stacks the resized
+    uint8 images into a preallocated buffer and applies rescale and
+    normalization to the whole batch as one fused multiply-add. The buffer
+    is shared, so ``__call__`` must only ever run on one thread (the
+    batcher's).
+    """
+
+    def __init__(self, extractor, max_batch_size: int):
+        self.size = (extractor.size["width"], extractor.size["height"])
+        self.resample = Image.Resampling(int(extractor.resample))
+        self.do_resize = extractor.do_resize
+        rescale = extractor.rescale_factor if extractor.do_rescale else 1.0
+        if extractor.do_normalize:
+            mean = torch.tensor(extractor.image_mean, dtype=torch.float32)
+            std = torch.tensor(extractor.image_std, dtype=torch.float32)
+        else:
+            mean, std = torch.zeros(3), torch.ones(3)
+        # (x * rescale - mean) / std == x * scale + bias
+        self.scale = (rescale / std).view(1, 3, 1, 1)
+        self.bias = (-mean / std).view(1, 3, 1, 1)
+        width, height = self.size
+        self._buffer = torch.empty(
+            (max(1, max_batch_size), height, width, 3), dtype=torch.uint8
+        )
+
+    def resize(self, image: Image.Image) -> np.ndarray:
+        if self.do_resize and image.size != self.size:
+            image = image.resize(self.size, resample=self.resample)
+        return np.asarray(image.convert("RGB"), dtype=np.uint8)
+
+    def __call__(self, images: List[np.ndarray]) -> torch.Tensor:
+        if len(images) <= self._buffer.shape[0]:
+            batch = self._buffer[: len(images)]
+        else:
+            batch = torch.empty(
+                (len(images), *self._buffer.shape[1:]), dtype=torch.uint8
+            )
+        for row, image in zip(batch, images):
+            row.copy_(torch.from_numpy(image))
+        pixel_values = batch.permute(0, 3, 1, 2).to(torch.float32)
+        return pixel_values.mul_(self.scale).add_(self.bias).contiguous()
@@ -0,0 +1,137 @@
+"""Fit a PCA projection that shrinks embeddings before they are stored.
+
+    python -m embedding.projection --images ./samples --dimension 256 \\
+        --output projection-256.npz --save-vectors full.npy
+
+Embeds the images with the eager model (or takes full-precision vectors
+from ``--vectors``) and writes the mean and the top ``--dimension``
+principal components. Serve it with ``PROJECTION_PATH=projection-256.npz``
+and set ``EMBEDDING_DIMENSION`` to match in ingesting and retriever; the
+index has to be rebuilt, as old and projected vectors are not comparable.
+Check the loss with ``python -m benchmarks.recall`` on the saved vectors.
+"""
+
+import argparse
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+import torch
+from loguru import logger
+
+from embedding.config import Config
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class Projection:
+    """Linear map ``(x - mean) @ components.T`` applied after the CLS token."""
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray):
+        self.mean = torch.from_numpy(np.asarray(mean, dtype=np.float32))
+        self.components = torch.from_numpy(np.asarray(components, dtype=np.float32))
+
+    @property
+    def dimension(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def load(cls, path: str) -> "Projection":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["mean"], data["components"])
+
+    def save(self, path: str):
+        np.savez(path, mean=self.mean.numpy(), components=self.components.numpy())
+
+    def __call__(self, embeddings: torch.Tensor) -> torch.Tensor:
+        mean = self.mean.to(embeddings.device)
+        components = self.components.to(embeddings.device)
+        return (embeddings - mean) @ components.T
+
+
+def fit_projection(vectors: np.ndarray, dimension: int):
+    """PCA via SVD; returns the projection and its explained variance ratio."""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    if not 0 < dimension <= min(vectors.shape):
+        raise ValueError(
+            f"Cannot fit {dimension} components to {vectors.shape[0]} vectors "
+            f"of dimension {vectors.shape[1]}"
+        )
+    mean = vectors.mean(axis=0)
+    _, singular_values, components = np.linalg.svd(vectors - mean, full_matrices=False)
+    variance = singular_values**2
+    explained = float(variance[:dimension].sum() / variance.sum())
+    return Projection(mean, components[:dimension]), explained
+
+
+def get_projection() -> Optional[Projection]:
+    if not Config.PROJECTION_PATH:
+        return None
+    projection = Projection.load(Config.PROJECTION_PATH)
+    logger.info(
+        f"Projecting embeddings to {projection.dimension} dimensions "
+        f"with {Config.PROJECTION_PATH}"
+    )
+    return projection
+
+
+def embed_directory(path: str, batch_size: int = 32) -> np.ndarray:
+    from PIL import Image
+    from transformers import ViTImageProcessor, ViTMSNModel
+
+    from embedding.backends import EagerBackend, configure_threads
+
+    paths = sorted(
+        os.path.join(path, name)
+        for name in os.listdir(path)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        sys.exit(f"No images found in {path}")
+    configure_threads()
+    extractor = ViTImageProcessor.from_pretrained(Config.MODEL_NAME)
+    backend = EagerBackend(ViTMSNModel.from_pretrained(Config.MODEL_NAME).eval())
+    vectors = []
+    for start in range(0, len(paths), batch_size):
+        images = [
+            Image.open(image_path).convert("RGB")
+            for image_path in paths[start : start + batch_size]
+        ]
+        pixel_values = extractor(images=images, return_tensors="pt")["pixel_values"]
+        vectors.append(backend(pixel_values).numpy())
+        logger.info(f"Embedded {min(start + batch_size, len(paths))}/{len(paths)}")
+    return np.concatenate(vectors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="Directory of sample images to embed")
+    source.add_argument("--vectors", help=".npy file of full-precision embeddings")
+    parser.add_argument("--dimension", type=int, required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--save-vectors", help="Also save the embedded images")
+    args = parser.parse_args()
+
+    if args.images:
+        vectors = embed_directory(args.images)
+        if args.save_vectors:
+            np.save(args.save_vectors, vectors)
+    else:
+        vectors = np.load(args.vectors)
+
+    try:
+        projection, explained = fit_projection(vectors, args.dimension)
+    except ValueError as e:
+        sys.exit(str(e))
+    projection.save(args.output)
+    print(
+        f"{vectors.shape[1]} -> {projection.dimension} dimensions over "
+        f"{len(vectors)} vectors, {explained:.2%} of the variance kept; "
+        f"written to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
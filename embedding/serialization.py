@@ -0,0 +1,60 @@
+from io import BytesIO
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response
+
+JSON = "application/json"
+OCTET_STREAM = "application/octet-stream"
+NPY = "application/x-npy"
+BINARY_MEDIA_TYPES = {OCTET_STREAM, NPY}
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+
+def negotiate(accept: Optional[str]) -> Tuple[str, str]:
+    """Pick the response media type and dtype from an Accept header.
+
+    Binary formats take an optional ``dtype`` parameter, e.g.
+    ``application/octet-stream; dtype=float16``. Anything else falls back
+    to JSON so existing clients keep working.
+    """
+    for media_range in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        if media_type.lower() not in BINARY_MEDIA_TYPES:
+            continue
+        dtype = "float32"
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "dtype":
+                dtype = value.strip().strip('"').lower()
+        if dtype not in DTYPES:
+            raise HTTPException(
+                status_code=406, detail=f"Unsupported embedding dtype: {dtype}"
+            )
+        return media_type.lower(), dtype
+    return JSON, "float32"
+
+
+def encode_vectors(vectors: torch.Tensor, media_type: str, dtype: str) -> Response:
+    """Serialize a 1-D vector or a 2-D batch of vectors.
+
+    Binary bodies are little-endian and taken straight from the tensor's
+    buffer (no copy for float32 on little-endian hosts).
+    """
+    if media_type == JSON:
+        return JSONResponse(vectors.tolist())
+
+    array = vectors.detach().cpu().numpy().astype(DTYPES[dtype], copy=False)
+    headers = {
+        "X-Embedding-Dtype": dtype,
+        "X-Embedding-Shape": ",".join(str(dim) for dim in array.shape),
+    }
+    if media_type == NPY:
+        buffer = BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        body = buffer.getvalue()
+    else:
+        body = memoryview(np.ascontiguousarray(array)).cast("B")
+    return Response(content=body, media_type=media_type, headers=headers)
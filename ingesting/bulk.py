@@ -0,0 +1,491 @@
+"""Bulk ingestion pipeline and command line ingester.
+
+Images flow through bounded queues: read/validate -> embed (batched
+/embed_batch calls) -> GCS upload (concurrent) -> vector upsert (chunked).
+Images whose content hash is already ingested are skipped before the
+embedding call. Completed keys are appended to a checkpoint file so an
+interrupted run resumes where it stopped.
+
+    python -m ingesting.bulk --dir ./images --checkpoint ingest.ckpt
+    python -m ingesting.bulk --manifest images.jsonl
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import mimetypes
+import os
+from time import time
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Union
+
+from loguru import logger
+
+from common.uploads import file_digest
+from ingesting.config import Config
+from ingesting.dedup import IngestedHashes, content_hash
+from ingesting.utils import (
+    InvalidImageError,
+    embedding_client,
+    get_feature_vectors,
+    io_pool,
+    validate_image,
+)
+
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png"}
+_DONE = object()
+
+
+class IngestItem:
+    """One image to ingest; ``load`` returns its bytes or an open file.
+
+    Files (such as the spooled uploads of ``/push_images``) are never read
+    into memory whole: they are digested in chunks and streamed to the
+    embedding service and to the bucket.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        filename: str,
+        load: Callable[[], Union[bytes, BinaryIO]],
+        content_type: Optional[str] = None,
+    ):
+        self.key = key
+        self.filename = filename
+        self.load = load
+        self.content_type = content_type or (
+            mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        self.data = None
+        self.feature = None
+        self.file_id = None
+        self.gcs_path = None
+        self.error = None
+        self.duplicate = False
+
+    def result(self) -> dict:
+        if self.duplicate:
+            return {
+                "key": self.key,
+                "filename": self.filename,
+                "status": "duplicate",
+                "file_id": self.file_id,
+                "gcs_path": self.gcs_path,
+            }
+        if self.error is not None:
+            return {
+                "key": self.key,
+                "filename": self.filename,
+                "status": "failed",
+                "error": self.error,
+            }
+        return {
+            "key": self.key,
+            "filename": self.filename,
+            "status": "ingested",
+            "file_id": self.file_id,
+            "gcs_path": self.gcs_path,
+        }
+
+
+class Checkpoint:
+    """Append-only record of keys that were fully ingested."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+            logger.info(f"Resuming from checkpoint with {len(self.done)} keys")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def mark_done(self, keys: List[str]):
+        self.done.update(keys)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.writelines(f"{key}\n" for key in keys)
+
+
+class PipelineStats:
+    def __init__(self):
+        self.started_at = time()
+        self.ingested = 0
+        self.failed = 0
+        self.skipped = 0
+        self.duplicates = 0
+
+    def as_dict(self) -> dict:
+        elapsed = time() - self.started_at
+        return {
+            "ingested": self.ingested,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "duplicates": self.duplicates,
+            "elapsed_seconds": round(elapsed, 3),
+            "images_per_second": round(self.ingested / elapsed, 2) if elapsed else 0,
+        }
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        vector_store,
+        bucket,
+        embed_batch_size: int = Config.BULK_EMBED_BATCH_SIZE,
+        upload_concurrency: int = Config.BULK_UPLOAD_CONCURRENCY,
+        upsert_batch_size: int = Config.BULK_UPSERT_BATCH_SIZE,
+        queue_size: int = Config.BULK_QUEUE_SIZE,
+        checkpoint: Optional[Checkpoint] = None,
+        ingested_hashes: Optional[IngestedHashes] = None,
+        on_progress: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.vector_store = vector_store
+        self.bucket = bucket
+        self.embed_batch_size = embed_batch_size
+        self.upload_concurrency = upload_concurrency
+        self.upsert_batch_size = upsert_batch_size
+        self.queue_size = queue_size
+        self.checkpoint = checkpoint or Checkpoint(None)
+        self.ingested_hashes = ingested_hashes or IngestedHashes()
+        # file_id -> later items with the same content, settled with the first
+        self._in_flight: Dict[str, List[IngestItem]] = {}
+        self.on_progress = on_progress
+        self.stats = PipelineStats()
+        self.results: List[dict] = []
+
+    async def run(self, items: Iterable[IngestItem]) -> dict:
+        read_queue = asyncio.Queue(self.queue_size)
+        upload_queue = asyncio.Queue(self.queue_size)
+        upsert_queue = asyncio.Queue(self.queue_size)
+
+        stages = [
+            asyncio.create_task(
+                self._then_done(self._read(items, read_queue), read_queue)
+            ),
+            asyncio.create_task(
+                self._then_done(
+                    self._embed(read_queue, upload_queue),
+                    upload_queue,
+                    consumers=self.upload_concurrency,
+                )
+            ),
+            asyncio.create_task(
+                self._then_done(
+                    self._upload_all(upload_queue, upsert_queue), upsert_queue
+                )
+            ),
+            asyncio.create_task(self._upsert(upsert_queue)),
+        ]
+        # A stage that raises fails the whole run; the others are cancelled
+        # rather than left waiting on a queue that no longer moves.
+        try:
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+        for stage in stages:
+            if stage in done and stage.exception() is not None:
+                raise stage.exception()
+        return self.stats.as_dict()
+
+    @staticmethod
+    async def _then_done(stage, queue: asyncio.Queue, consumers: int = 1):
+        """Run ``stage``, then tell the next stage it is done, even on failure.
+
+        Not when cancelled: the run is then being torn down and nothing is
+        left downstream to drain the queue.
+        """
+        cancelled = False
+        try:
+            await stage
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                for _ in range(consumers):
+                    await queue.put(_DONE)
+
+    async def _upload_all(
+        self, upload_queue: asyncio.Queue, upsert_queue: asyncio.Queue
+    ):
+        uploaders = [
+            asyncio.create_task(self._upload(upload_queue, upsert_queue))
+            for _ in range(self.upload_concurrency)
+        ]
+        try:
+            await asyncio.gather(*uploaders)
+        finally:
+            for uploader in uploaders:
+                uploader.cancel()
+
+    def _fail(self, item: IngestItem, error: str):
+        item.error = error
+        self.stats.failed += 1
+        self.results.append(item.result())
+        logger.warning(f"Failed to ingest {item.key}: {error}")
+        self._report("failed", 1)
+        # Not checkpointed, so the next run retries them along with the first
+        for duplicate in self._in_flight.pop(item.file_id, []):
+            self._fail(duplicate, f"Duplicate of {item.key}, which failed: {error}")
+
+    def _report(self, event: str, count: int):
+        if self.on_progress is not None:
+            self.on_progress(event, count)
+
+    @staticmethod
+    def _load_and_validate(item: IngestItem):
+        ext = item.filename.split(".")[-1].lower()
+        if ext not in ALLOWED_EXTENSIONS:
+            raise ValueError("Only .jpg/.jpeg/.png allowed")
+        data = item.load()
+        validate_image(data)
+        item.data = data
+        if isinstance(data, bytes):
+            item.file_id = content_hash(data)
+        else:
+            item.file_id = file_digest(data)
+        item.gcs_path = f"images/{item.file_id}.{ext}"
+
+    async def _read(self, items: Iterable[IngestItem], read_queue: asyncio.Queue):
+        # Files are read and validated a batch-sized window at a time so the
+        # embed stage receives full batches.
+        window = []
+        for item in items:
+            if item.key in self.checkpoint:
+                self.stats.skipped += 1
+                self._report("skipped", 1)
+                continue
+            window.append(item)
+            if len(window) >= self.embed_batch_size:
+                await self._read_window(window, read_queue)
+                window = []
+        if window:
+            await self._read_window(window, read_queue)
+
+    async def _read_window(self, window: List[IngestItem], read_queue: asyncio.Queue):
+        outcomes = await asyncio.gather(
+            *(io_pool.run(self._load_and_validate, item) for item in window),
+            return_exceptions=True,
+        )
+        valid = []
+        for item, outcome in zip(window, outcomes):
+            if isinstance(outcome, Exception):
+                self._fail(item, str(outcome))
+            else:
+                valid.append(item)
+
+        existing = await io_pool.run(
+            self.ingested_hashes.lookup, [item.file_id for item in valid]
+        )
+        for item in valid:
+            if item.file_id in existing:
+                self._skip_duplicate(item, existing[item.file_id])
+                continue
+            if item.file_id in self._in_flight:
+                # The same content twice in one run: a duplicate once the
+                # first one is upserted, and failed if it fails
+                item.data = None
+                self._in_flight[item.file_id].append(item)
+                continue
+            self._in_flight[item.file_id] = []
+            await read_queue.put(item)
+
+    def _skip_duplicate(self, item: IngestItem, gcs_path: str):
+        item.duplicate = True
+        item.gcs_path = gcs_path
+        item.data = None
+        self.stats.duplicates += 1
+        self.results.append(item.result())
+        self.checkpoint.mark_done([item.key])
+        self._report("duplicate", 1)
+
+    async def _embed(self, read_queue: asyncio.Queue, upload_queue: asyncio.Queue):
+        finished = False
+        while not finished:
+            batch = []
+            item = await read_queue.get()
+            while item is not _DONE:
+                batch.append(item)
+                if len(batch) >= self.embed_batch_size or read_queue.empty():
+                    break
+                item = await read_queue.get()
+            finished = item is _DONE
+            for item, feature in await self._embed_batch(batch):
+                item.feature = feature
+                await upload_queue.put(item)
+
+    async def _embed_batch(self, batch: List[IngestItem]) -> list:
+        """Embed ``batch``, failing only the images the service rejects.
+
+        The rejected image is failed and the rest are sent again. When the
+        service does not say which image it rejected, each is sent alone.
+        """
+        if not batch:
+            return []
+        try:
+            features = await get_feature_vectors([item.data for item in batch])
+        except InvalidImageError as e:
+            if len(batch) == 1:
+                self._fail(batch[0], f"Embedding failed: {e.detail}")
+                return []
+            if e.position is not None and e.position < len(batch):
+                self._fail(batch[e.position], f"Embedding failed: {e.detail}")
+                return await self._embed_batch(
+                    batch[: e.position] + batch[e.position + 1 :]
+                )
+            embedded = []
+            for item in batch:
+                embedded += await self._embed_batch([item])
+            return embedded
+        except Exception as e:
+            for item in batch:
+                self._fail(item, f"Embedding failed: {e}")
+            return []
+        return list(zip(batch, features))
+
+    async def _upload(self, upload_queue: asyncio.Queue, upsert_queue: asyncio.Queue):
+        while True:
+            item = await upload_queue.get()
+            if item is _DONE:
+                return
+            blob = self.bucket.blob(
+                item.gcs_path, chunk_size=Config.GCS_UPLOAD_CHUNK_SIZE
+            )
+            if isinstance(item.data, bytes):
+                upload = functools.partial(blob.upload_from_string, item.data)
+            else:
+                upload = functools.partial(
+                    blob.upload_from_file, item.data, rewind=True
+                )
+            try:
+                await io_pool.run(upload, content_type=item.content_type)
+            except Exception as e:
+                self._fail(item, f"GCS upload failed: {e}")
+                continue
+            item.data = None
+            await upsert_queue.put(item)
+
+    async def _upsert(self, upsert_queue: asyncio.Queue):
+        chunk = []
+        while True:
+            item = await upsert_queue.get()
+            if item is not _DONE:
+                chunk.append(item)
+            if chunk and (item is _DONE or len(chunk) >= self.upsert_batch_size):
+                await self._flush_chunk(chunk)
+                chunk = []
+            if item is _DONE:
+                return
+
+    async def _flush_chunk(self, chunk: List[IngestItem]):
+        vectors = [
+            (
+                item.file_id,
+                item.feature,
+                {"gcs_path": item.gcs_path, "filename": item.filename},
+            )
+            for item in chunk
+        ]
+        try:
+            await io_pool.run(self.vector_store.upsert, vectors)
+        except Exception as e:
+            for item in chunk:
+                self._fail(item, f"Upsert failed: {e}")
+            return
+        self.checkpoint.mark_done([item.key for item in chunk])
+        self.ingested_hashes.add({item.file_id: item.gcs_path for item in chunk})
+        for item in chunk:
+            for duplicate in self._in_flight.pop(item.file_id, []):
+                self._skip_duplicate(duplicate, item.gcs_path)
+        self.stats.ingested += len(chunk)
+        self.results.extend(item.result() for item in chunk)
+        self._report("ingested", len(chunk))
+        logger.info(f"Upserted {len(chunk)} vectors ({self.stats.as_dict()})")
+
+
+def _file_loader(path: str) -> Callable[[], bytes]:
+    def load() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    return load
+
+
+def iter_directory(directory: str) -> Iterable[IngestItem]:
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            key = os.path.relpath(path, directory)
+            yield IngestItem(key, filename, _file_loader(path))
+
+
+def iter_manifest(manifest: str) -> Iterable[IngestItem]:
+    """Each JSONL line has a ``path`` and optional ``filename``/``key``."""
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            path = os.path.join(base, entry["path"])
+            yield IngestItem(
+                entry.get("key", entry["path"]),
+                entry.get("filename", os.path.basename(path)),
+                _file_loader(path),
+                entry.get("content_type"),
+            )
+
+
+def main():
+    from ingesting.utils import get_bucket, get_vector_store
+
+    parser = argparse.ArgumentParser(description="Bulk ingest images")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="Directory of images to ingest")
+    source.add_argument("--manifest", help="JSONL manifest of images to ingest")
+    parser.add_argument("--checkpoint", help="File recording ingested keys")
+    parser.add_argument(
+        "--embed-batch-size", type=int, default=Config.BULK_EMBED_BATCH_SIZE
+    )
+    parser.add_argument(
+        "--upload-concurrency", type=int, default=Config.BULK_UPLOAD_CONCURRENCY
+    )
+    parser.add_argument(
+        "--upsert-batch-size", type=int, default=Config.BULK_UPSERT_BATCH_SIZE
+    )
+    args = parser.parse_args()
+
+    items = iter_directory(args.dir) if args.dir else iter_manifest(args.manifest)
+    vector_store = get_vector_store()
+    pipeline = IngestPipeline(
+        vector_store,
+        get_bucket(),
+        embed_batch_size=args.embed_batch_size,
+        upload_concurrency=args.upload_concurrency,
+        upsert_batch_size=args.upsert_batch_size,
+        checkpoint=Checkpoint(args.checkpoint),
+        ingested_hashes=IngestedHashes(
+            Config.INGESTED_HASHES_PATH or None,
+            vector_store if Config.DEDUP_VERIFY_WITH_STORE else None,
+        ),
+    )
+
+    async def run():
+        try:
+            return await pipeline.run(items)
+        finally:
+            pipeline.vector_store.flush()
+            await embedding_client.close()
+
+    stats = asyncio.run(run())
+    logger.info(f"Bulk ingestion finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,118 @@ import os
 
 
 class Config:
+    # Config for vector store ("pinecone" or "local")
+    VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+    LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+    # How the local index stores vectors: "float32", "float16" or "int8"
+    # (check recall with `python -m benchmarks.recall`); Pinecone keeps float32
+    VECTOR_CODEC = os.getenv("VECTOR_CODEC", "float32")
+    # Two-stage search: a float32 local store of every vector, written by
+    # ingesting next to the primary index, for exact re-ranking in retriever.
+    # A local store has a single writer: run one ingesting replica with it,
+    # on a volume the retriever also mounts; a second one fails to connect.
+    RERANK_STORE_PATH = os.getenv("RERANK_STORE_PATH", "")
+    # "none" for exact search, "hnsw" for approximate search (needs hnswlib)
+    LOCAL_INDEX_ANN = os.getenv("LOCAL_INDEX_ANN", "none")
+    LOCAL_INDEX_FLUSH_EVERY = int(os.getenv("LOCAL_INDEX_FLUSH_EVERY", "100"))
+    # Local stores are also saved this often, so the retriever's view of the
+    # re-rank store trails ingestion by seconds rather than by upserts
+    LOCAL_INDEX_FLUSH_SECONDS = float(os.getenv("LOCAL_INDEX_FLUSH_SECONDS", "5"))
+    HNSW_M = int(os.getenv("HNSW_M", "16"))
+    HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+    HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
     # Config for Pinecone
     INDEX_NAME = "mlops1-project"
-    INPUT_RESOLUTION = 768
+    # Must match the vectors of the embedding service: 768, or the dimension
+    # of its PROJECTION_PATH. Changing it means rebuilding the index.
+    EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "768"))
     PINECONE_CLOUD = "gcp"
     PINECONE_REGION = "us-central1"
     # Config for GCS
     GCS_BUCKET_NAME = "image-retrieval-bucket-1907"
+    # Resumable uploads in chunks of this size; must be a multiple of 256 KiB
+    GCS_UPLOAD_CHUNK_SIZE = int(os.getenv("GCS_UPLOAD_CHUNK_SIZE", str(8 * 2**20)))
+    # "gcs", or "local" to keep images in LOCAL_BUCKET_PATH (signed URLs are
+    # then file:// URLs); meant for local runs and benchmarks
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+    LOCAL_BUCKET_PATH = os.getenv("LOCAL_BUCKET_PATH", "local_bucket")
     # Config for embedding service
     EMBEDDING_SERVICE_URL = os.getenv(
         "EMBEDDING_SERVICE_URL", "http://localhost:5000/embed"
     )
+    EMBEDDING_BATCH_SERVICE_URL = os.getenv(
+        "EMBEDDING_BATCH_SERVICE_URL", "http://localhost:5000/embed_batch"
+    )
+    # "application/octet-stream", "application/x-npy" or "application/json"
+    EMBEDDING_RESPONSE_FORMAT = os.getenv(
+        "EMBEDDING_RESPONSE_FORMAT", "application/octet-stream"
+    )
+    EMBEDDING_RESPONSE_DTYPE = os.getenv("EMBEDDING_RESPONSE_DTYPE", "float32")
+    EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "30"))
+    EMBEDDING_CONNECT_TIMEOUT_SECONDS = float(
+        os.getenv("EMBEDDING_CONNECT_TIMEOUT_SECONDS", "5")
+    )
+    EMBEDDING_MAX_CONNECTIONS = int(os.getenv("EMBEDDING_MAX_CONNECTIONS", "20"))
+    EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16"))
+    EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+    EMBEDDING_RETRY_BACKOFF_SECONDS = float(
+        os.getenv("EMBEDDING_RETRY_BACKOFF_SECONDS", "0.2")
+    )
+    # Config for content-hash deduplication
+    INGESTED_HASHES_PATH = os.getenv("INGESTED_HASHES_PATH", "")
+    # Ask the vector store about hashes missing from the local record. Costs
+    # a vector store round trip for every new image, so it is meant for when
+    # INGESTED_HASHES_PATH is not kept across restarts.
+    DEDUP_VERIFY_WITH_STORE = (
+        os.getenv("DEDUP_VERIFY_WITH_STORE", "false").lower() == "true"
+    )
+    # Config for bulk ingestion
+    BULK_EMBED_BATCH_SIZE = int(os.getenv("BULK_EMBED_BATCH_SIZE", "32"))
+    BULK_UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY", "16"))
+    BULK_UPSERT_BATCH_SIZE = int(os.getenv("BULK_UPSERT_BATCH_SIZE", "100"))
+    BULK_QUEUE_SIZE = int(os.getenv("BULK_QUEUE_SIZE", "256"))
+    # Config for image validation
+    ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG"}
+    MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))
+    # Resize to the model input size before calling the embedding service and
+    # send raw pixels (as .npy) instead of the encoded image
+    CLIENT_PREPROCESS = os.getenv("CLIENT_PREPROCESS", "false").lower() == "true"
+    MODEL_INPUT_SIZE = int(os.getenv("MODEL_INPUT_SIZE", "224"))
+    # Thread pool for blocking SDK calls; new requests get a 429 with
+    # Retry-After once IO_MAX_PENDING calls are already waiting
+    IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+    IO_MAX_PENDING = int(os.getenv("IO_MAX_PENDING", "64"))
+    RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    # The vector store and the bucket are connected after startup, retried
+    # with exponential backoff; /readyz fails until they are. While one is
+    # down, requests get a 503 without retrying it for CONNECT_COOLDOWN_SECONDS.
+    STARTUP_RETRY_BACKOFF_SECONDS = float(
+        os.getenv("STARTUP_RETRY_BACKOFF_SECONDS", "0.5")
+    )
+    STARTUP_RETRY_MAX_BACKOFF_SECONDS = float(
+        os.getenv("STARTUP_RETRY_MAX_BACKOFF_SECONDS", "30")
+    )
+    CONNECT_COOLDOWN_SECONDS = float(os.getenv("CONNECT_COOLDOWN_SECONDS", "5"))
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "8098"))
+    # Config for uploads: larger images are rejected before they are read,
+    # larger request bodies before they are parsed
+    MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 2**20)))
+    MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(128 * 2**20)))
+    # Config for tracing. TRACING_EXPORTER is "jaeger", "otlp", "memory"
+    # (kept in process, for tests) or "none"; TRACING_ENABLED=false also
+    # turns tracing off, e.g. for benchmarks.
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "jaeger")
+    JAEGER_AGENT_HOST = os.getenv(
+        "JAEGER_AGENT_HOST",
+        "jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
+    )
+    JAEGER_AGENT_PORT = int(os.getenv("JAEGER_AGENT_PORT", "6831"))
+    OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4317")
+    # Share of new traces sampled up front; callers' decisions are followed.
+    # With TRACE_TAIL_SLOW_SECONDS > 0, the other traces are still exported
+    # when they are at least that slow or failed. That means recording every
+    # span of every request and holding it until its trace ends, so it is
+    # off by default; turn it on where that cost is acceptable.
+    TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))
+    TRACE_TAIL_SLOW_SECONDS = float(os.getenv("TRACE_TAIL_SLOW_SECONDS", "0"))
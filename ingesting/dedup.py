@@ -0,0 +1,63 @@
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, Optional
+
+from loguru import logger
+
+
+def content_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class IngestedHashes:
+    """Content hashes that are already in the bucket and the vector store.
+
+    Lookups hit an in-memory dict (hash -> gcs_path) that is persisted as an
+    append-only file, so a restarted pod still short-circuits duplicates
+    before calling the embedding service. On a local miss the vector store
+    can be asked as the source of truth, since vector ids are the hashes.
+    """
+
+    def __init__(self, path: Optional[str] = None, vector_store=None):
+        self.path = path
+        self.vector_store = vector_store
+        self._paths: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    digest, _, gcs_path = line.rstrip("\n").partition(" ")
+                    if digest:
+                        self._paths[digest] = gcs_path
+            logger.info(f"Loaded {len(self._paths)} ingested hashes from {path}")
+
+    def lookup(self, digests: Iterable[str]) -> Dict[str, str]:
+        """Return ``{digest: gcs_path}`` for the digests already ingested."""
+        digests = list(digests)
+        found = {
+            digest: self._paths[digest] for digest in digests if digest in self._paths
+        }
+        missing = [digest for digest in digests if digest not in found]
+        if missing and self.vector_store is not None:
+            vectors = self.vector_store.fetch(missing)
+            remote = {
+                digest: vector["metadata"].get("gcs_path", "")
+                for digest, vector in vectors.items()
+            }
+            self.add(remote)
+            found.update(remote)
+        return found
+
+    def get(self, digest: str) -> Optional[str]:
+        return self.lookup([digest]).get(digest)
+
+    def add(self, paths: Dict[str, str]):
+        if not paths:
+            return
+        with self._lock:
+            new = {d: p for d, p in paths.items() if d not in self._paths}
+            self._paths.update(new)
+            if self.path and new:
+                with open(self.path, "a") as f:
+                    f.writelines(f"{digest} {path}\n" for digest, path in new.items())
@@ -1,59 +1,74 @@
-import atexit
+import asyncio
 import datetime
-import uuid
-from io import BytesIO
-from time import time
+from time import perf_counter
+from typing import List
 
 import uvicorn
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, HTTPException, Response, UploadFile
 from loguru import logger
 from opentelemetry import metrics
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
 from opentelemetry.exporter.prometheus import PrometheusMetricReader
 from opentelemetry.metrics import set_meter_provider
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.trace import Link, get_tracer_provider, set_tracer_provider
-from PIL import Image, UnidentifiedImageError
+from opentelemetry.trace import Link, get_tracer_provider
 from prometheus_client import Gauge, Summary, start_http_server
 
+from common.instrumentation import (
+    RequestMetrics,
+    StageTimer,
+    TraceContextMiddleware,
+    setup_tracing,
+)
+from common.uploads import UploadLimitMiddleware, check_size, check_upload, file_digest
+from ingesting.bulk import IngestItem, IngestPipeline
 from ingesting.config import Config
-from ingesting.utils import get_feature_vector, get_index, get_storage_client
+from ingesting.dedup import IngestedHashes
+from ingesting.utils import (
+    LazyConnection,
+    connect_bucket,
+    connect_with_retries,
+    embedding_client,
+    get_connected,
+    get_feature_vector,
+    get_vector_store,
+    io_pool,
+    validate_image,
+)
 
-set_tracer_provider(
-    TracerProvider(resource=Resource.create({SERVICE_NAME: "ingesting-service"}))
+started_at = perf_counter()
+span_exporter = setup_tracing(
+    "ingesting-service",
+    exporter=Config.TRACING_EXPORTER if Config.TRACING_ENABLED else "none",
+    sample_ratio=Config.TRACE_SAMPLE_RATIO,
+    tail_slow_seconds=Config.TRACE_TAIL_SLOW_SECONDS,
+    jaeger_agent_host=Config.JAEGER_AGENT_HOST,
+    jaeger_agent_port=Config.JAEGER_AGENT_PORT,
+    otlp_endpoint=Config.OTLP_ENDPOINT,
 )
 tracer = get_tracer_provider().get_tracer("ingesting", "0.1.1")
-jaeger_exporter = JaegerExporter(
-    agent_host_name="jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
-    agent_port=6831,
-)
-span_processor = BatchSpanProcessor(jaeger_exporter)
-get_tracer_provider().add_span_processor(span_processor)
-atexit.register(span_processor.shutdown)
-
-index = get_index(Config.INDEX_NAME)
-logger.info(f"Pinecone index: {Config.INDEX_NAME}")
-
-GCS_BUCKET_NAME = Config.GCS_BUCKET_NAME
-try:
-    storage_client = get_storage_client()
-    bucket = storage_client.get_bucket(GCS_BUCKET_NAME)
-    if not bucket.exists():
-        logger.error(f"Bucket {GCS_BUCKET_NAME} not found in Google Cloud Storage.")
-        raise HTTPException(
-            status_code=404, detail=f"Bucket {GCS_BUCKET_NAME} not found."
-        )
-
-    logger.info(f"Connected to GCS bucket '{GCS_BUCKET_NAME}' successfully")
-except Exception as e:
-    logger.error(f"Error accessing GCS bucket '{GCS_BUCKET_NAME}': {e}")
-    raise HTTPException(status_code=500, detail=str(e))
 
-# Start Prometheus client
-start_http_server(port=8098, addr="0.0.0.0")
+# Remote dependencies are connected after startup (see connect_dependencies),
+# so a slow or failing API delays readiness instead of failing the import
+vector_store_connection = LazyConnection(
+    f"{Config.VECTOR_STORE} vector store",
+    get_vector_store,
+    Config.CONNECT_COOLDOWN_SECONDS,
+)
+bucket_connection = LazyConnection(
+    f"bucket {Config.GCS_BUCKET_NAME}",
+    connect_bucket,
+    Config.CONNECT_COOLDOWN_SECONDS,
+)
+ingested_hashes_connection = LazyConnection(
+    "ingested hashes",
+    lambda: IngestedHashes(
+        Config.INGESTED_HASHES_PATH or None,
+        vector_store_connection.get() if Config.DEDUP_VERIFY_WITH_STORE else None,
+    ),
+    Config.CONNECT_COOLDOWN_SECONDS,
+)
+dependencies = [vector_store_connection, bucket_connection, ingested_hashes_connection]
 
 # Service name is required for most backends
 resource = Resource(attributes={SERVICE_NAME: "ingesting-service"})
@@ -70,15 +85,45 @@ ingesting_counter = meter.create_counter(
     name="ingesting_push_image_counter", description="Number of push_image requests"
 )
 
+vector_size_gauge = Gauge("ingesting_vector_size", "Size of returned vector")
+duplicate_counter = meter.create_counter(
+    name="ingesting_duplicate_image_counter",
+    description="Number of uploads skipped because their content was already ingested",
+)
+# Deprecated: superseded by ingesting_request_duration_seconds, and still
+# recorded (for successful requests, as before) for one release so existing
+# dashboards and alerts keep working. Remove in the next release.
 ingesting_histogram = meter.create_histogram(
     name="ingesting_push_image_response_time_seconds",
-    description="Response time for push_image",
+    description="Response time for push_image (deprecated)",
     unit="s",
 )
-
-vector_size_gauge = Gauge("ingesting_vector_size", "Size of returned vector")
 response_time_summary = Summary(
-    "ingesting_response_time_summary_seconds", "Summary of response time"
+    "ingesting_response_time_summary_seconds",
+    "Summary of response time (deprecated)",
+)
+
+
+def record_legacy_latency(endpoint: str, status: int, seconds: float):
+    if status >= 400:
+        return
+    ingesting_histogram.record(seconds, {"api": endpoint})
+    if endpoint == "/push_image":
+        response_time_summary.observe(seconds)
+
+
+request_metrics = RequestMetrics("ingesting", on_request=record_legacy_latency)
+startup_gauge = Gauge(
+    "ingesting_startup_seconds",
+    "Seconds from start until the vector store and the bucket were connected",
+)
+
+bulk_images_counter = meter.create_counter(
+    name="ingesting_bulk_images_counter",
+    description="Number of images processed by bulk ingestion, by status",
+)
+bulk_throughput_gauge = Gauge(
+    "ingesting_bulk_images_per_second", "Throughput of the last bulk ingestion"
 )
 
 app = FastAPI(
@@ -86,6 +131,59 @@ app = FastAPI(
     docs_url="/ingesting/docs",
     openapi_url="/ingesting/openapi.json",
 )
+app.add_middleware(UploadLimitMiddleware, max_bytes=Config.MAX_REQUEST_BYTES)
+app.add_middleware(TraceContextMiddleware)
+
+
+async def connect_dependencies():
+    await connect_with_retries(dependencies)
+    startup_gauge.set(perf_counter() - started_at)
+    logger.info(f"Ready {perf_counter() - started_at:.2f} seconds after start")
+
+
+@app.on_event("startup")
+async def start_embedding_client():
+    await embedding_client.start()
+
+
+@app.on_event("startup")
+async def start_connecting():
+    start_http_server(port=Config.METRICS_PORT, addr="0.0.0.0")
+    # In the background, so /healthz answers while /readyz waits for them
+    app.state.connect = asyncio.ensure_future(connect_dependencies())
+
+
+async def flush_periodically():
+    """Save the vector store every ``LOCAL_INDEX_FLUSH_SECONDS``.
+
+    Flushing is a no-op without unsaved writes, or for Pinecone.
+    """
+    while True:
+        await asyncio.sleep(Config.LOCAL_INDEX_FLUSH_SECONDS)
+        if not vector_store_connection.connected:
+            continue
+        try:
+            await io_pool.run(vector_store_connection.get().flush)
+        except Exception as e:
+            logger.error(f"Error while saving the vector store: {e}")
+
+
+@app.on_event("startup")
+async def start_flushing():
+    app.state.flush = asyncio.ensure_future(flush_periodically())
+
+
+@app.on_event("shutdown")
+async def close_embedding_client():
+    await embedding_client.close()
+
+
+@app.on_event("shutdown")
+def flush_vector_store():
+    app.state.flush.cancel()
+    if vector_store_connection.connected:
+        vector_store_connection.get().flush()
+    io_pool.shutdown()
 
 
 @app.get("/")
@@ -98,42 +196,93 @@ def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/readyz")
+def readiness_check():
+    waiting = [
+        dependency.name for dependency in dependencies if not dependency.connected
+    ]
+    if waiting:
+        raise HTTPException(
+            status_code=503, detail=f"Connecting to {', '.join(waiting)}"
+        )
+    return {"status": "ready"}
+
+
 @app.post("/push_image")
-async def push_image(file: UploadFile = File(...)):
-    start_time = time()
+async def push_image(response: Response, file: UploadFile = File(...)):
     ingesting_counter.add(1, {"api": "/push_image"})
-    with tracer.start_as_current_span("push_image") as push_span:
+    timer = StageTimer()
+    with tracer.start_as_current_span("push_image") as push_span, request_metrics.track(
+        "/push_image", timer
+    ):
+        io_pool.admit()
 
         with tracer.start_as_current_span(
             "validate-image", links=[Link(push_span.get_span_context())]
-        ):
-            image_bytes = await file.read()
+        ), timer.stage("validate"):
             ext = file.filename.split(".")[-1].lower()
             if ext not in {"jpg", "jpeg", "png"}:
                 raise HTTPException(
                     status_code=400, detail="Only .jpg/.jpeg/.png allowed"
                 )
+            # Starlette spools large uploads to disk; from here on the image
+            # is passed around as that file, never copied into memory whole
+            check_upload(file, Config.MAX_UPLOAD_BYTES)
             try:
-                Image.open(BytesIO(image_bytes)).convert("RGB")
-            except UnidentifiedImageError:
-                raise HTTPException(status_code=400, detail="Invalid image file")
+                await io_pool.run(validate_image, file.file)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+        with tracer.start_as_current_span(
+            "check-duplicate", links=[Link(push_span.get_span_context())]
+        ), timer.stage("dedup"):
+            file_id = await io_pool.run(file_digest, file.file)
+            ingested_hashes = await get_connected(ingested_hashes_connection)
+            existing_path = await io_pool.run(ingested_hashes.get, file_id)
+        push_span.set_attribute("duplicate", existing_path is not None)
+
+        if existing_path is not None:
+            duplicate_counter.add(1, {"api": "/push_image"})
+            logger.info(f"Skipping duplicate upload: {file_id}")
+            bucket = await get_connected(bucket_connection)
+            blob = bucket.blob(existing_path)
+            signed_url = await io_pool.run(
+                blob.generate_signed_url,
+                version="v4",
+                expiration=datetime.timedelta(hours=1),
+                method="GET",
+                response_disposition=f"attachment; filename={file.filename}",
+            )
+            response.headers["Server-Timing"] = timer.header()
+            return {
+                "message": "Already ingested",
+                "file_id": file_id,
+                "gcs_path": existing_path,
+                "signed_url": signed_url,
+                "duplicate": True,
+            }
 
         with tracer.start_as_current_span(
             "get-feature-vector", links=[Link(push_span.get_span_context())]
-        ):
-            feature = get_feature_vector(image_bytes)
+        ), timer.stage("embed"):
+            feature = await get_feature_vector(file.file)
             vector_size_gauge.set(len(feature))
 
-        file_id = str(uuid.uuid4())
         gcs_path = f"images/{file_id}.{ext}"
 
         with tracer.start_as_current_span(
             "upload-to-gcs", links=[Link(push_span.get_span_context())]
-        ):
-            blob = bucket.blob(gcs_path)
-            if not blob.exists():
+        ), timer.stage("upload"):
+            bucket = await get_connected(bucket_connection)
+            blob = bucket.blob(gcs_path, chunk_size=Config.GCS_UPLOAD_CHUNK_SIZE)
+            if not await io_pool.run(blob.exists):
                 try:
-                    blob.upload_from_string(image_bytes, content_type=file.content_type)
+                    await io_pool.run(
+                        blob.upload_from_file,
+                        file.file,
+                        rewind=True,
+                        content_type=file.content_type,
+                    )
                     logger.info(f"Uploaded to GCS: {gcs_path}")
                 except Exception as e:
                     logger.error(f"GCS upload failed: {e}")
@@ -141,9 +290,10 @@ async def push_image(file: UploadFile = File(...)):
 
         with tracer.start_as_current_span(
             "generate-signed-url", links=[Link(push_span.get_span_context())]
-        ):
+        ), timer.stage("sign"):
             response_disposition = f"attachment; filename={file.filename}"
-            signed_url = blob.generate_signed_url(
+            signed_url = await io_pool.run(
+                blob.generate_signed_url,
                 version="v4",
                 expiration=datetime.timedelta(hours=1),
                 method="GET",
@@ -152,21 +302,65 @@ async def push_image(file: UploadFile = File(...)):
 
         with tracer.start_as_current_span(
             "upsert-to-pinecone", links=[Link(push_span.get_span_context())]
-        ):
-            index.upsert(
-                [(file_id, feature, {"gcs_path": gcs_path, "filename": file.filename})]
+        ), timer.stage("upsert"):
+            vector_store = await get_connected(vector_store_connection)
+            await io_pool.run(
+                vector_store.upsert,
+                [(file_id, feature, {"gcs_path": gcs_path, "filename": file.filename})],
             )
             logger.info(f"Upserted vector to Pinecone: {file_id}")
-            elapsed = time() - start_time
-            ingesting_histogram.record(elapsed, {"api": "/push_image"})
-            response_time_summary.observe(elapsed)
+            await io_pool.run(ingested_hashes.add, {file_id: gcs_path})
+        response.headers["Server-Timing"] = timer.header()
         return {
             "message": "Successfully!",
             "file_id": file_id,
             "gcs_path": gcs_path,
             "signed_url": signed_url,
+            "duplicate": False,
         }
 
 
+@app.post("/push_images")
+async def push_images(files: List[UploadFile] = File(...)):
+    ingesting_counter.add(1, {"api": "/push_images"})
+    timer = StageTimer()
+    with tracer.start_as_current_span(
+        "push_images"
+    ) as push_span, request_metrics.track("/push_images", timer):
+        io_pool.admit()
+        items = []
+        with timer.stage("read"):
+            # The spooled uploads are handed over as files and streamed
+            # through the pipeline, like /push_image does
+            for position, file in enumerate(files):
+                check_size(file, Config.MAX_UPLOAD_BYTES)
+                items.append(
+                    IngestItem(
+                        str(position),
+                        file.filename,
+                        lambda file=file.file: file,
+                        file.content_type,
+                    )
+                )
+        push_span.set_attribute("image_count", len(items))
+
+        # Connected only once the request itself is known to be acceptable;
+        # each image is validated by the pipeline and reported on its own
+        pipeline = IngestPipeline(
+            await get_connected(vector_store_connection),
+            await get_connected(bucket_connection),
+            ingested_hashes=await get_connected(ingested_hashes_connection),
+            on_progress=lambda status, count: bulk_images_counter.add(
+                count, {"api": "/push_images", "status": status}
+            ),
+        )
+        with timer.stage("pipeline"):
+            stats = await pipeline.run(items)
+        bulk_throughput_gauge.set(stats["images_per_second"])
+
+    results = sorted(pipeline.results, key=lambda result: int(result["key"]))
+    return {"message": "Successfully!", **stats, "results": results}
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=5001)
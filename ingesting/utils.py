@@ -1,15 +1,34 @@
+import asyncio
+import contextvars
+import functools
 import os
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic
+from typing import BinaryIO, List, Optional, Union
 
-import requests
+import httpx
+import numpy as np
 from fastapi import HTTPException
+from PIL import Image, UnidentifiedImageError
 from google.cloud import storage
 from google.oauth2 import service_account
 from loguru import logger
 from pinecone import Pinecone, ServerlessSpec
 
+from common.instrumentation import inject_trace_context
+from common.storage import LocalBucket
+from common.vector_store import (
+    LocalVectorStore,
+    MirroredVectorStore,
+    PineconeVectorStore,
+)
 from ingesting.config import Config
 
-PINECONE_APIKEY = os.environ["PINECONE_APIKEY"]
+PINECONE_APIKEY = os.getenv("PINECONE_APIKEY")
 
 
 def get_storage_client():
@@ -20,6 +39,19 @@ def get_storage_client():
     return storage.Client()
 
 
+def get_bucket():
+    if Config.STORAGE_BACKEND == "local":
+        return LocalBucket(Config.LOCAL_BUCKET_PATH, Config.GCS_BUCKET_NAME)
+    return get_storage_client().get_bucket(Config.GCS_BUCKET_NAME)
+
+
+def connect_bucket():
+    bucket = get_bucket()
+    if not bucket.exists():
+        raise RuntimeError(f"Bucket {Config.GCS_BUCKET_NAME} not found")
+    return bucket
+
+
 def get_index(index_name):
     pc = Pinecone(api_key=PINECONE_APIKEY)
     # if index_name in pc.list_indexes().names():
@@ -29,28 +61,417 @@ def get_index(index_name):
         pc.create_index(
             name=index_name,
             metric="cosine",
-            dimension=Config.INPUT_RESOLUTION,
+            dimension=Config.EMBEDDING_DIMENSION,
             spec=ServerlessSpec(
                 cloud=Config.PINECONE_CLOUD, region=Config.PINECONE_REGION
             ),
         )
         logger.info(f"Created Pinecone index: {index_name}")
+    else:
+        dimension = pc.describe_index(index_name).dimension
+        if dimension != Config.EMBEDDING_DIMENSION:
+            raise ValueError(
+                f"Pinecone index {index_name} has dimension {dimension}, "
+                f"but EMBEDDING_DIMENSION is {Config.EMBEDDING_DIMENSION}"
+            )
     return pc.Index(index_name)
 
 
-def get_feature_vector(image_bytes: bytes) -> list:
+def get_vector_store():
+    store = get_primary_vector_store()
+    if Config.RERANK_STORE_PATH:
+        # Full-precision copy for the retriever's exact re-ranking stage
+        full_precision = LocalVectorStore(
+            dimension=Config.EMBEDDING_DIMENSION,
+            path=Config.RERANK_STORE_PATH,
+            flush_every=Config.LOCAL_INDEX_FLUSH_EVERY,
+        )
+        full_precision.lock_writer()
+        return MirroredVectorStore(store, full_precision)
+    return store
+
+
+def get_primary_vector_store():
+    if Config.VECTOR_STORE == "local":
+        store = LocalVectorStore(
+            dimension=Config.EMBEDDING_DIMENSION,
+            path=Config.LOCAL_INDEX_PATH or None,
+            codec=Config.VECTOR_CODEC,
+            ann=Config.LOCAL_INDEX_ANN,
+            hnsw_m=Config.HNSW_M,
+            hnsw_ef_construction=Config.HNSW_EF_CONSTRUCTION,
+            hnsw_ef_search=Config.HNSW_EF_SEARCH,
+            flush_every=Config.LOCAL_INDEX_FLUSH_EVERY,
+        )
+        if store.path:
+            store.lock_writer()
+        return store
+    if Config.VECTOR_STORE == "pinecone":
+        if Config.VECTOR_CODEC != "float32":
+            logger.warning("VECTOR_CODEC only applies to the local vector store")
+        return PineconeVectorStore(get_index(Config.INDEX_NAME))
+    raise ValueError(f"Unknown vector store: {Config.VECTOR_STORE}")
+
+
+def embedding_accept_header() -> str:
+    if Config.EMBEDDING_RESPONSE_FORMAT == "application/json":
+        return "application/json"
+    return (
+        f"{Config.EMBEDDING_RESPONSE_FORMAT}; dtype={Config.EMBEDDING_RESPONSE_DTYPE}"
+    )
+
+
+def decode_vectors(response) -> np.ndarray:
+    """Decode an embedding service response into a float32 array."""
+    content_type = response.headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return np.asarray(response.json(), dtype=np.float32)
+    if content_type.startswith("application/x-npy"):
+        vectors = np.load(BytesIO(response.content), allow_pickle=False)
+    else:
+        dtype = response.headers.get("X-Embedding-Dtype", "float32")
+        shape = response.headers.get("X-Embedding-Shape")
+        vectors = np.frombuffer(
+            response.content, dtype=np.dtype(dtype).newbyteorder("<")
+        )
+        if shape:
+            vectors = vectors.reshape([int(dim) for dim in shape.split(",")])
+    if vectors.shape[-1:] != (Config.EMBEDDING_DIMENSION,):
+        raise ValueError(
+            f"Embedding service returned vectors of shape {vectors.shape}, "
+            f"expected dimension {Config.EMBEDDING_DIMENSION}"
+        )
+    return vectors.astype(np.float32, copy=False)
+
+
+def as_file(image: Union[bytes, BinaryIO]) -> BinaryIO:
+    """Uploads are passed around as file objects; wrap raw bytes to match."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return BytesIO(image)
+    image.seek(0)
+    return image
+
+
+def validate_image(image: Union[bytes, BinaryIO]) -> Image.Image:
+    """Check format and dimensions from the image header, without decoding."""
+    try:
+        image = Image.open(as_file(image))
+        image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValueError("Invalid image file")
+    if image.format not in Config.ALLOWED_IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image.format}")
+    width, height = image.size
+    if width * height > Config.MAX_IMAGE_PIXELS:
+        raise ValueError(f"Image of {width}x{height} pixels is too large")
+    return image
+
+
+def preprocess_image(image: Union[bytes, BinaryIO]) -> bytes:
+    """Downscale to the model input size and serialize the pixels as .npy.
+
+    ``draft`` lets the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding,
+    so large camera images are never decoded at full resolution.
+    """
+    size = (Config.MODEL_INPUT_SIZE, Config.MODEL_INPUT_SIZE)
+    image = Image.open(as_file(image))
+    image.draft("RGB", size)
+    image = image.convert("RGB").resize(size, Image.BILINEAR)
+    buffer = BytesIO()
+    np.save(buffer, np.asarray(image, dtype=np.uint8), allow_pickle=False)
+    return buffer.getvalue()
+
+
+async def embedding_payload(image: Union[bytes, BinaryIO], filename: str):
+    if Config.CLIENT_PREPROCESS:
+        pixels = await io_pool.run(preprocess_image, image)
+        return (f"{filename}.npy", pixels, "application/x-npy")
+    # File objects are streamed by httpx in chunks, not read into memory
+    return (f"{filename}.jpg", image, "image/jpeg")
+
+
+def overloaded(detail: str, retry_after=None) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(retry_after or Config.RETRY_AFTER_SECONDS)},
+    )
+
+
+class InvalidImageError(HTTPException):
+    """The embedding service rejected an image of the request as invalid."""
+
+    def __init__(self, detail: str, position: Optional[int] = None):
+        super().__init__(status_code=400, detail=detail)
+        # Index of the image in the request, if the service reported it
+        self.position = position
+
+
+def invalid_image(response: httpx.Response) -> InvalidImageError:
+    try:
+        detail = str(response.json()["detail"])
+    except (ValueError, KeyError, TypeError):
+        detail = response.text
+    position = re.search(r"position (\d+)", detail)
+    return InvalidImageError(detail, int(position.group(1)) if position else None)
+
+
+def unavailable(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=detail,
+        headers={"Retry-After": str(Config.RETRY_AFTER_SECONDS)},
+    )
+
+
+class BlockingPool:
+    """Bounded thread pool for blocking SDK calls (GCS, Pinecone, PIL).
+
+    Handlers ``await pool.run(...)`` instead of calling the SDKs inline, so
+    a slow call only holds a pool thread and not the event loop. ``admit``
+    sheds new requests with a 429 once ``max_pending`` calls are already
+    waiting, rather than letting latency grow without bound.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="blocking-io"
+        )
+
+    def admit(self):
+        if self.pending >= self.max_pending:
+            raise overloaded("Server is busy, retry later")
+
+    async def run(self, func, *args, **kwargs):
+        self.pending += 1
+        # Like asyncio.to_thread, run in a copy of the caller's context so
+        # spans started in the pool are children of the request's span
+        context = contextvars.copy_context()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(context.run, func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+io_pool = BlockingPool(Config.IO_WORKERS, Config.IO_MAX_PENDING)
+
+
+class LazyConnection:
+    """A remote dependency, connected after startup rather than at import.
+
+    ``connect`` builds it once, under a lock, with ``factory``. ``get``
+    returns it, connecting on first use; after a failed attempt it fails
+    fast for ``cooldown_seconds`` instead of calling the remote API once per
+    request while it is down. Retrying is left to ``connect_with_retries``.
+    """
+
+    def __init__(self, name: str, factory, cooldown_seconds: float):
+        self.name = name
+        self.factory = factory
+        self.cooldown_seconds = cooldown_seconds
+        self._value = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._value is not None
+
+    def connect(self):
+        with self._lock:
+            if self._value is None:
+                try:
+                    self._value = self.factory()
+                except Exception:
+                    self._failed_at = monotonic()
+                    raise
+                logger.info(f"Connected to {self.name}")
+            return self._value
+
+    def get(self):
+        if self._value is not None:
+            return self._value
+        if (
+            self._failed_at is not None
+            and monotonic() - self._failed_at < self.cooldown_seconds
+        ):
+            raise RuntimeError(f"{self.name} is unavailable")
+        return self.connect()
+
+
+async def get_connected(connection: LazyConnection):
+    """The connected dependency, or a 503 while it cannot be reached."""
+    try:
+        return await io_pool.run(connection.get)
+    except Exception as e:
+        logger.error(f"Cannot connect to {connection.name}: {e}")
+        raise unavailable(f"{connection.name} is unavailable, retry later")
+
+
+async def connect_with_retries(connections: List[LazyConnection]):
+    """Connect every dependency, retrying each with exponential backoff."""
+
+    async def connect(connection: LazyConnection):
+        delay = Config.STARTUP_RETRY_BACKOFF_SECONDS
+        while not connection.connected:
+            try:
+                await io_pool.run(connection.connect)
+            except Exception as e:
+                logger.warning(
+                    f"Cannot connect to {connection.name}, "
+                    f"retrying in {delay:.1f} seconds: {e}"
+                )
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, Config.STARTUP_RETRY_MAX_BACKOFF_SECONDS)
+
+    await asyncio.gather(*(connect(connection) for connection in connections))
+
+
+class EmbeddingClient:
+    """Shared keep-alive client for the embedding service.
+
+    A single ``httpx.AsyncClient`` pools connections across requests, a
+    semaphore bounds how many calls are in flight at once, and transient
+    failures (connection errors, 429 and 5xx) are retried with jittered
+    exponential backoff.
+    """
+
+    RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self):
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                Config.EMBEDDING_TIMEOUT_SECONDS,
+                connect=Config.EMBEDDING_CONNECT_TIMEOUT_SECONDS,
+            ),
+            limits=httpx.Limits(
+                max_connections=Config.EMBEDDING_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.EMBEDDING_MAX_CONNECTIONS,
+            ),
+        )
+        self._semaphore = asyncio.Semaphore(Config.EMBEDDING_MAX_CONCURRENCY)
+        logger.info("Embedding client started")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("Embedding client closed")
+
+    async def post(self, url: str, files) -> httpx.Response:
+        # Lazily (re)start when used outside the app lifecycle, e.g. from a
+        # script or a test client that runs each request on its own loop.
+        if self._client is None or self._loop is not asyncio.get_running_loop():
+            await self.start()
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    # W3C traceparent, so the embedding spans join this trace
+                    headers = inject_trace_context(
+                        {"Accept": embedding_accept_header()}
+                    )
+                    response = await self._client.post(
+                        url, files=files, headers=headers
+                    )
+                if (
+                    response.status_code not in self.RETRYABLE_STATUS_CODES
+                    or attempt >= Config.EMBEDDING_MAX_RETRIES
+                ):
+                    response.raise_for_status()
+                    return response
+                logger.warning(
+                    f"Embedding service returned {response.status_code}, retrying"
+                )
+            except httpx.TransportError as e:
+                if attempt >= Config.EMBEDDING_MAX_RETRIES:
+                    raise
+                logger.warning(f"Embedding service unreachable ({e}), retrying")
+            delay = Config.EMBEDDING_RETRY_BACKOFF_SECONDS * (2**attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+embedding_client = EmbeddingClient()
+
+
+async def get_feature_vector(image: Union[bytes, BinaryIO]) -> list:
     try:
         logger.info(f"Calling embedding service at {Config.EMBEDDING_SERVICE_URL}")
-        response = requests.post(
-            url=Config.EMBEDDING_SERVICE_URL,
-            files={"file": ("image.jpg", image_bytes, "image/jpeg")},
+        response = await embedding_client.post(
+            Config.EMBEDDING_SERVICE_URL,
+            files={"file": await embedding_payload(image, "image")},
         )
-        response.raise_for_status()
-        feature = response.json()
+        feature = decode_vectors(response).tolist()
         return feature
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 400:
+            raise HTTPException(status_code=400, detail="Invalid image file")
+        if e.response.status_code == 429:
+            raise overloaded(
+                "Embedding service is busy", e.response.headers.get("Retry-After")
+            )
+        logger.error(f"Failed to get feature vector: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get feature vector from embedding service",
+        )
     except Exception as e:
         logger.error(f"Failed to get feature vector: {e}")
         raise HTTPException(
             status_code=500,
             detail="Failed to get feature vector from embedding service",
         )
+
+
+async def get_feature_vectors(images: List[bytes]) -> List[list]:
+    if not images:
+        return []
+    try:
+        logger.info(
+            f"Calling embedding service at {Config.EMBEDDING_BATCH_SERVICE_URL} "
+            f"with {len(images)} images"
+        )
+        payloads = await asyncio.gather(
+            *(
+                embedding_payload(image_bytes, f"image_{i}")
+                for i, image_bytes in enumerate(images)
+            )
+        )
+        response = await embedding_client.post(
+            Config.EMBEDDING_BATCH_SERVICE_URL,
+            files=[("files", payload) for payload in payloads],
+        )
+        features = decode_vectors(response).tolist()
+        return features
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 429:
+            raise overloaded(
+                "Embedding service is busy", e.response.headers.get("Retry-After")
+            )
+        if e.response.status_code == 400:
+            raise invalid_image(e.response)
+        logger.error(f"Failed to get feature vectors: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get feature vectors from embedding service",
+        )
+    except Exception as e:
+        logger.error(f"Failed to get feature vectors: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get feature vectors from embedding service",
+        )
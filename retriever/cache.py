@@ -0,0 +1,233 @@
+import base64
+import json
+import secrets
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from retriever.config import Config
+
+
+class InMemoryBackend:
+    """In-process LRU store with a TTL, an entry cap and a byte budget."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> int:
+        """Store ``value``; returns how many entries were evicted to fit it."""
+        if len(value) > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, monotonic() + self.ttl_seconds)
+            self._size += len(value)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+        return evicted
+
+    def _remove(self, key: str):
+        value, _ = self._entries.pop(key)
+        self._size -= len(value)
+
+
+class RedisBackend:
+    """Shared store so every retriever replica sees the same cache."""
+
+    def __init__(self, url: str, ttl_seconds: float):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(
+                "QUERY_CACHE_BACKEND=redis requires the 'redis' package"
+            ) from e
+        self.ttl_seconds = ttl_seconds
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(key)
+
+    def set(self, key: str, value: bytes) -> int:
+        self._client.set(key, value, ex=max(1, int(self.ttl_seconds)))
+        # Redis evicts under maxmemory on its own; those are not seen here
+        return 0
+
+
+class QueryCache:
+    """Content-addressed cache of search results.
+
+    Keys are the SHA-256 of the uploaded bytes, values hold the query
+    feature vector and the matches (id, score, metadata) returned for it.
+    """
+
+    PREFIX = "retriever:query:"
+
+    def __init__(self, backend, on_hit=None, on_miss=None, on_evict=None):
+        self.backend = backend
+        self.on_hit = on_hit
+        self.on_miss = on_miss
+        self.on_evict = on_evict
+
+    def get(self, key: str, endpoint: Optional[str] = None) -> Optional[dict]:
+        """The cached entry, or None; ``on_hit``/``on_miss`` get ``endpoint``."""
+        try:
+            raw = self.backend.get(self.PREFIX + key)
+        except Exception as e:
+            logger.warning(f"Query cache lookup failed: {e}")
+            raw = None
+        if raw is None:
+            if self.on_miss is not None:
+                self.on_miss(endpoint)
+            return None
+        if self.on_hit is not None:
+            self.on_hit(endpoint)
+        entry = json.loads(raw)
+        feature = base64.b64decode(entry["feature"])
+        entry["feature"] = np.frombuffer(feature, dtype="<f4").tolist()
+        return entry
+
+    def set(
+        self, key: str, feature: list, matches: list, endpoint: Optional[str] = None
+    ):
+        """Cache an entry; ``on_evict`` gets ``endpoint`` for each one it evicts."""
+        feature = np.asarray(feature, dtype="<f4").tobytes()
+        entry = {
+            "feature": base64.b64encode(feature).decode("ascii"),
+            "matches": matches,
+        }
+        try:
+            evicted = self.backend.set(self.PREFIX + key, json.dumps(entry).encode())
+        except Exception as e:
+            logger.warning(f"Query cache store failed: {e}")
+            return
+        if self.on_evict is not None:
+            for _ in range(evicted):
+                self.on_evict(endpoint)
+
+
+class SignedUrlCache:
+    """Signed GCS URLs keyed by ``gcs_path``, kept until shortly before expiry.
+
+    A ``None`` value records a path whose blob was found missing, so it is
+    not checked again until the entry expires.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, gcs_path: str):
+        """Return ``(found, url)``; ``found`` is False on a miss."""
+        with self._lock:
+            entry = self._entries.get(gcs_path)
+            if entry is None:
+                return False, None
+            url, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[gcs_path]
+                return False, None
+            self._entries.move_to_end(gcs_path)
+            return True, url
+
+    def set(self, gcs_path: str, url: Optional[str]):
+        with self._lock:
+            self._entries[gcs_path] = (url, monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(gcs_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CursorStore:
+    """Candidate lists kept for a short while so later pages skip the search.
+
+    Shares the query cache backend, so with Redis a cursor issued by one
+    replica can be followed on another. Like the query cache, it degrades
+    when the backend fails: no cursor is issued, and one that cannot be
+    read is treated as expired.
+    """
+
+    PREFIX = "retriever:cursor:"
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, matches: list) -> Optional[str]:
+        token = secrets.token_urlsafe(16)
+        try:
+            self.backend.set(self.PREFIX + token, json.dumps(matches).encode())
+        except Exception as e:
+            logger.warning(f"Cursor store failed: {e}")
+            return None
+        return token
+
+    def get(self, token: str) -> Optional[list]:
+        try:
+            raw = self.backend.get(self.PREFIX + token)
+        except Exception as e:
+            logger.warning(f"Cursor lookup failed: {e}")
+            return None
+        return None if raw is None else json.loads(raw)
+
+
+def get_query_cache(on_hit=None, on_miss=None, on_evict=None) -> Optional[QueryCache]:
+    if Config.QUERY_CACHE_BACKEND == "none":
+        return None
+    if Config.QUERY_CACHE_BACKEND == "redis":
+        backend = RedisBackend(Config.REDIS_URL, Config.QUERY_CACHE_TTL_SECONDS)
+    else:
+        backend = InMemoryBackend(
+            max_entries=Config.QUERY_CACHE_MAX_ENTRIES,
+            max_bytes=Config.QUERY_CACHE_MAX_BYTES,
+            ttl_seconds=Config.QUERY_CACHE_TTL_SECONDS,
+        )
+    logger.info(f"Query cache backend: {Config.QUERY_CACHE_BACKEND}")
+    return QueryCache(backend, on_hit=on_hit, on_miss=on_miss, on_evict=on_evict)
+
+
+def get_signed_url_cache() -> SignedUrlCache:
+    return SignedUrlCache(
+        max_entries=Config.SIGNED_URL_CACHE_MAX_ENTRIES,
+        ttl_seconds=max(
+            0,
+            Config.SIGNED_URL_EXPIRATION_SECONDS
+            - Config.SIGNED_URL_REFRESH_MARGIN_SECONDS,
+        ),
+    )
+
+
+def get_cursor_store() -> CursorStore:
+    if Config.QUERY_CACHE_BACKEND == "redis":
+        backend = RedisBackend(Config.REDIS_URL, Config.CURSOR_TTL_SECONDS)
+    else:
+        backend = InMemoryBackend(
+            max_entries=Config.CURSOR_MAX_ENTRIES,
+            max_bytes=Config.CURSOR_MAX_BYTES,
+            ttl_seconds=Config.CURSOR_TTL_SECONDS,
+        )
+    return CursorStore(backend)
@@ -2,16 +2,129 @@ import os
 
 
 class Config:
+    # Config for vector store ("pinecone" or "local")
+    VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+    LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "")
+    # How the local index stores vectors: "float32", "float16" or "int8"
+    # (check recall with `python -m benchmarks.recall`); Pinecone keeps float32
+    VECTOR_CODEC = os.getenv("VECTOR_CODEC", "float32")
+    # Two-stage search: a float32 local store of every vector, written by
+    # ingesting next to the primary index, for exact re-ranking in retriever
+    RERANK_STORE_PATH = os.getenv("RERANK_STORE_PATH", "")
+    # Candidates fetched from the primary index for re-ranking
+    RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "100"))
+    # "none" for exact search, "hnsw" for approximate search (needs hnswlib)
+    LOCAL_INDEX_ANN = os.getenv("LOCAL_INDEX_ANN", "none")
+    LOCAL_INDEX_FLUSH_EVERY = int(os.getenv("LOCAL_INDEX_FLUSH_EVERY", "100"))
+    HNSW_M = int(os.getenv("HNSW_M", "16"))
+    HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+    HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
     # Config for Pinecone
     INDEX_NAME = "mlops1-project"
-    INPUT_RESOLUTION = 768
+    # Must match the vectors of the embedding service: 768, or the dimension
+    # of its PROJECTION_PATH. Changing it means rebuilding the index.
+    EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "768"))
     PINECONE_CLOUD = "gcp"
     PINECONE_REGION = "us-central1"
     # Config for retriever
     TOP_K = 5
+    MAX_TOP_K = int(os.getenv("MAX_TOP_K", "100"))
+    # Candidates fetched per query and kept under a cursor for later pages
+    SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "50"))
+    CURSOR_TTL_SECONDS = float(os.getenv("CURSOR_TTL_SECONDS", "300"))
+    CURSOR_MAX_ENTRIES = int(os.getenv("CURSOR_MAX_ENTRIES", "10000"))
+    CURSOR_MAX_BYTES = int(os.getenv("CURSOR_MAX_BYTES", str(64 * 2**20)))
+    # Config for /search_images
+    SEARCH_IMAGES_MAX_FILES = int(os.getenv("SEARCH_IMAGES_MAX_FILES", "32"))
+    RRF_K = int(os.getenv("RRF_K", "60"))
+    # Config for query cache ("memory", "redis" or "none")
+    QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory")
+    QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1024"))
+    QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 2**20)))
+    QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "300"))
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     # Config for GCS
     GCS_BUCKET_NAME = "image-retrieval-bucket-1907"
+    # "gcs", or "local" to keep images in LOCAL_BUCKET_PATH (signed URLs are
+    # then file:// URLs); meant for local runs and benchmarks
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+    LOCAL_BUCKET_PATH = os.getenv("LOCAL_BUCKET_PATH", "local_bucket")
+    SIGNED_URL_EXPIRATION_SECONDS = int(
+        os.getenv("SIGNED_URL_EXPIRATION_SECONDS", "3600")
+    )
+    # Cached URLs are re-signed this long before they expire
+    SIGNED_URL_REFRESH_MARGIN_SECONDS = int(
+        os.getenv("SIGNED_URL_REFRESH_MARGIN_SECONDS", "300")
+    )
+    SIGNED_URL_CACHE_MAX_ENTRIES = int(
+        os.getenv("SIGNED_URL_CACHE_MAX_ENTRIES", "10000")
+    )
+    # Check blob.exists() before signing (one extra GCS round trip per miss)
+    VERIFY_BLOB_EXISTS = os.getenv("VERIFY_BLOB_EXISTS", "false").lower() == "true"
     # Config for embedding service
     EMBEDDING_SERVICE_URL = os.getenv(
         "EMBEDDING_SERVICE_URL", "http://localhost:5000/embed"
     )
+    EMBEDDING_BATCH_SERVICE_URL = os.getenv(
+        "EMBEDDING_BATCH_SERVICE_URL", "http://localhost:5000/embed_batch"
+    )
+    # "application/octet-stream", "application/x-npy" or "application/json"
+    EMBEDDING_RESPONSE_FORMAT = os.getenv(
+        "EMBEDDING_RESPONSE_FORMAT", "application/octet-stream"
+    )
+    EMBEDDING_RESPONSE_DTYPE = os.getenv("EMBEDDING_RESPONSE_DTYPE", "float32")
+    EMBEDDING_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "30"))
+    EMBEDDING_CONNECT_TIMEOUT_SECONDS = float(
+        os.getenv("EMBEDDING_CONNECT_TIMEOUT_SECONDS", "5")
+    )
+    EMBEDDING_MAX_CONNECTIONS = int(os.getenv("EMBEDDING_MAX_CONNECTIONS", "20"))
+    EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16"))
+    EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+    EMBEDDING_RETRY_BACKOFF_SECONDS = float(
+        os.getenv("EMBEDDING_RETRY_BACKOFF_SECONDS", "0.2")
+    )
+    # Config for image validation
+    ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG"}
+    MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))
+    # Resize to the model input size before calling the embedding service and
+    # send raw pixels (as .npy) instead of the encoded image
+    CLIENT_PREPROCESS = os.getenv("CLIENT_PREPROCESS", "false").lower() == "true"
+    MODEL_INPUT_SIZE = int(os.getenv("MODEL_INPUT_SIZE", "224"))
+    # Thread pool for blocking SDK calls; new requests get a 429 with
+    # Retry-After once IO_MAX_PENDING calls are already waiting
+    IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+    IO_MAX_PENDING = int(os.getenv("IO_MAX_PENDING", "64"))
+    RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+    # The vector store and the bucket are connected after startup, retried
+    # with exponential backoff; /readyz fails until they are. While one is
+    # down, requests get a 503 without retrying it for CONNECT_COOLDOWN_SECONDS.
+    STARTUP_RETRY_BACKOFF_SECONDS = float(
+        os.getenv("STARTUP_RETRY_BACKOFF_SECONDS", "0.5")
+    )
+    STARTUP_RETRY_MAX_BACKOFF_SECONDS = float(
+        os.getenv("STARTUP_RETRY_MAX_BACKOFF_SECONDS", "30")
+    )
+    CONNECT_COOLDOWN_SECONDS = float(os.getenv("CONNECT_COOLDOWN_SECONDS", "5"))
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "8097"))
+    # Config for uploads: larger images are rejected before they are read,
+    # larger request bodies before they are parsed
+    MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 2**20)))
+    MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(128 * 2**20)))
+    # Config for tracing. TRACING_EXPORTER is "jaeger", "otlp", "memory"
+    # (kept in process, for tests) or "none"; TRACING_ENABLED=false also
+    # turns tracing off, e.g. for benchmarks.
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "jaeger")
+    JAEGER_AGENT_HOST = os.getenv(
+        "JAEGER_AGENT_HOST",
+        "jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
+    )
+    JAEGER_AGENT_PORT = int(os.getenv("JAEGER_AGENT_PORT", "6831"))
+    OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4317")
+    # Share of new traces sampled up front; callers' decisions are followed.
+    # With TRACE_TAIL_SLOW_SECONDS > 0, the other traces are still exported
+    # when they are at least that slow or failed. That means recording every
+    # span of every request and holding it until its trace ends, so it is
+    # off by default; turn it on where that cost is acceptable.
+    TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))
+    TRACE_TAIL_SLOW_SECONDS = float(os.getenv("TRACE_TAIL_SLOW_SECONDS", "0"))
@@ -1,61 +1,76 @@
-import atexit
-import datetime
-from io import BytesIO
-from time import time
+import asyncio
+from time import perf_counter
+from typing import BinaryIO, List, Optional, Tuple
 
 import uvicorn
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, HTTPException, Query, Response, UploadFile
 from loguru import logger
 from opentelemetry import metrics
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
 from opentelemetry.exporter.prometheus import PrometheusMetricReader
 from opentelemetry.metrics import set_meter_provider
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.trace import Link, get_tracer_provider, set_tracer_provider
-from PIL import Image, UnidentifiedImageError
+from opentelemetry.trace import Link, get_tracer_provider
 from prometheus_client import Gauge, Summary, start_http_server
 
+from common.instrumentation import (
+    RequestMetrics,
+    StageTimer,
+    TraceContextMiddleware,
+    setup_tracing,
+)
+from common.uploads import UploadLimitMiddleware, check_upload, file_digest
+from retriever.cache import get_cursor_store, get_query_cache, get_signed_url_cache
 from retriever.config import Config
-from retriever.utils import get_feature_vector, get_index, search, get_storage_client
+from retriever.utils import (
+    LazyConnection,
+    connect_bucket,
+    connect_with_retries,
+    embedding_client,
+    get_connected,
+    get_feature_vector,
+    get_feature_vectors,
+    get_reranker,
+    get_vector_store,
+    io_pool,
+    mean_embedding,
+    reciprocal_rank_fusion,
+    search,
+    sign_urls,
+    validate_image,
+)
 
-set_tracer_provider(
-    TracerProvider(resource=Resource.create({SERVICE_NAME: "retriever-service"}))
+started_at = perf_counter()
+span_exporter = setup_tracing(
+    "retriever-service",
+    exporter=Config.TRACING_EXPORTER if Config.TRACING_ENABLED else "none",
+    sample_ratio=Config.TRACE_SAMPLE_RATIO,
+    tail_slow_seconds=Config.TRACE_TAIL_SLOW_SECONDS,
+    jaeger_agent_host=Config.JAEGER_AGENT_HOST,
+    jaeger_agent_port=Config.JAEGER_AGENT_PORT,
+    otlp_endpoint=Config.OTLP_ENDPOINT,
 )
 tracer = get_tracer_provider().get_tracer("retriever", "0.1.1")
-jaeger_exporter = JaegerExporter(
-    agent_host_name="jaeger-tracing-jaeger-all-in-one.tracing.svc.cluster.local",
-    agent_port=6831,
-)
-span_processor = BatchSpanProcessor(jaeger_exporter)
-get_tracer_provider().add_span_processor(span_processor)
-atexit.register(span_processor.shutdown)
-
-index = get_index(Config.INDEX_NAME)
-logger.info(f"Pinecone index: {Config.INDEX_NAME}")
-
-GCS_BUCKET_NAME = Config.GCS_BUCKET_NAME
-try:
-    storage_client = get_storage_client()
-    bucket = storage_client.get_bucket(GCS_BUCKET_NAME)
-    if not bucket.exists():
-        logger.error(f"Bucket {GCS_BUCKET_NAME} not found in Google Cloud Storage.")
-        raise HTTPException(
-            status_code=404, detail=f"Bucket {GCS_BUCKET_NAME} not found."
-        )
-
-    logger.info(f"Connected to GCS bucket '{GCS_BUCKET_NAME}' successfully")
-except Exception as e:
-    logger.error(f"Error accessing GCS bucket '{GCS_BUCKET_NAME}': {e}")
-    raise HTTPException(status_code=500, detail=str(e))
 
-# Start Prometheus client
-start_http_server(port=8097, addr="0.0.0.0")
+# Remote dependencies are connected after startup (see connect_dependencies),
+# so a slow or failing API delays readiness instead of failing the import
+vector_store_connection = LazyConnection(
+    f"{Config.VECTOR_STORE} vector store",
+    get_vector_store,
+    Config.CONNECT_COOLDOWN_SECONDS,
+)
+bucket_connection = LazyConnection(
+    f"bucket {Config.GCS_BUCKET_NAME}",
+    connect_bucket,
+    Config.CONNECT_COOLDOWN_SECONDS,
+)
+dependencies = [vector_store_connection, bucket_connection]
+reranker = get_reranker()
+if reranker is not None:
+    logger.info(f"Re-ranking {Config.RERANK_CANDIDATES} candidates exactly")
 
 # Service name is required for most backends
-resource = Resource(attributes={SERVICE_NAME: "ingesting-service"})
+resource = Resource(attributes={SERVICE_NAME: "retriever-service"})
 
 # Exporter to export metrics to Prometheus
 reader = PrometheusMetricReader()
@@ -63,32 +78,101 @@ reader = PrometheusMetricReader()
 # Meter is responsible for creating and recording metrics
 provider = MeterProvider(resource=resource, metric_readers=[reader])
 set_meter_provider(provider)
-meter = metrics.get_meter("ingesting", "0.1.1")
+meter = metrics.get_meter("retriever", "0.1.1")
 
 search_counter = meter.create_counter(
     name="retriever_search_image_counter", description="Number of search_image requests"
 )
 
+retriever_vector_size_gauge = Gauge(
+    "retriever_vector_size",
+    "Length of embedding vector returned from embedding service",
+)
+
+# Deprecated: superseded by retriever_request_duration_seconds, and still
+# recorded (for successful requests, as before) for one release so existing
+# dashboards and alerts keep working. Remove in the next release.
 search_histogram = meter.create_histogram(
     name="retriever_search_image_response_time_seconds",
-    description="Response time for search_image requests",
+    description="Response time for search_image requests (deprecated)",
     unit="s",
 )
+retriever_response_time_summary = Summary(
+    "retriever_response_time_summary_seconds",
+    "Summary of search_image response time (deprecated)",
+)
 
-retriever_vector_size_gauge = Gauge(
-    "retriever_vector_size",
-    "Length of embedding vector returned from embedding service",
+
+def record_legacy_latency(endpoint: str, status: int, seconds: float):
+    if status >= 400:
+        return
+    search_histogram.record(seconds, {"api": endpoint})
+    if endpoint == "/search_image":
+        retriever_response_time_summary.observe(seconds)
+
+
+request_metrics = RequestMetrics("retriever", on_request=record_legacy_latency)
+startup_gauge = Gauge(
+    "retriever_startup_seconds",
+    "Seconds from start until the vector store and the bucket were connected",
 )
 
-retriever_response_time_summary = Summary(
-    "retriever_response_time_summary_seconds", "Summary of search_image response time"
+query_cache_hit_counter = meter.create_counter(
+    name="retriever_query_cache_hits", description="Number of query cache hits"
 )
+query_cache_miss_counter = meter.create_counter(
+    name="retriever_query_cache_misses", description="Number of query cache misses"
+)
+query_cache_eviction_counter = meter.create_counter(
+    name="retriever_query_cache_evictions",
+    description="Number of query cache entries evicted to respect size limits",
+)
+
+query_cache = get_query_cache(
+    on_hit=lambda endpoint: query_cache_hit_counter.add(1, {"api": endpoint}),
+    on_miss=lambda endpoint: query_cache_miss_counter.add(1, {"api": endpoint}),
+    on_evict=lambda endpoint: query_cache_eviction_counter.add(1, {"api": endpoint}),
+)
+signed_url_cache = get_signed_url_cache()
+cursor_store = get_cursor_store()
 
 app = FastAPI(
     title="Retriever Service",
     docs_url="/retriever/docs",
     openapi_url="/retriever/openapi.json",
 )
+app.add_middleware(UploadLimitMiddleware, max_bytes=Config.MAX_REQUEST_BYTES)
+app.add_middleware(TraceContextMiddleware)
+
+
+async def connect_dependencies():
+    await connect_with_retries(dependencies)
+    startup_gauge.set(perf_counter() - started_at)
+    logger.info(f"Ready {perf_counter() - started_at:.2f} seconds after start")
+
+
+@app.on_event("startup")
+async def start_embedding_client():
+    await embedding_client.start()
+
+
+@app.on_event("startup")
+async def start_connecting():
+    start_http_server(port=Config.METRICS_PORT, addr="0.0.0.0")
+    # In the background, so /healthz answers while /readyz waits for them
+    app.state.connect = asyncio.ensure_future(connect_dependencies())
+
+
+@app.on_event("shutdown")
+async def close_embedding_client():
+    await embedding_client.close()
+
+
+@app.on_event("shutdown")
+def flush_vector_store():
+    if vector_store_connection.connected:
+        vector_store_connection.get().flush()
+    io_pool.shutdown()
 
 
 @app.get("/")
@@ -101,72 +185,327 @@ def health_check():
     return {"status": "OK!"}
 
 
-@app.post("/search_image")
-async def search_image(file: UploadFile = File(...)):
-    with tracer.start_as_current_span("search_image") as main_span:
+@app.get("/readyz")
+def readiness_check():
+    waiting = [
+        dependency.name for dependency in dependencies if not dependency.connected
+    ]
+    if waiting:
+        raise HTTPException(
+            status_code=503, detail=f"Connecting to {', '.join(waiting)}"
+        )
+    return {"status": "ready"}
+
+
+def format_results(matches: list, signed_urls: list, limit: int) -> list:
+    results = []
+    for match, signed_url in zip(matches, signed_urls):
+        if len(results) == limit:
+            break
+        if signed_url is None:
+            continue
+        results.append(
+            {
+                "id": match["id"],
+                "score": match["score"],
+                "filename": match["metadata"].get("filename"),
+                "url": signed_url,
+            }
+        )
+        logger.info(f"Found URL for match ID {match['id']}")
+    return results
+
+
+async def find_candidates(
+    image: BinaryIO, count: int, main_span, timer: StageTimer, endpoint: str
+) -> list:
+    """Embed the query image and fetch ``count`` matches, via the query cache.
 
+    ``endpoint`` labels the query cache hit and miss counters.
+    """
+    with timer.stage("cache"):
+        cache_key = await io_pool.run(file_digest, image) if query_cache else None
+        cached = (
+            await io_pool.run(query_cache.get, cache_key, endpoint)
+            if query_cache
+            else None
+        )
+    main_span.set_attribute("cache_hit", cached is not None)
+    if cached is not None and len(cached["matches"]) >= count:
+        return cached["matches"]
+
+    if cached is not None:
+        # Cached with fewer candidates than this page needs; reuse the feature
+        feature = cached["feature"]
+    else:
         with tracer.start_as_current_span(
             "validate-image", links=[Link(main_span.get_span_context())]
-        ):
-            image_bytes = await file.read()
+        ), timer.stage("validate"):
             try:
-                Image.open(BytesIO(image_bytes)).convert("RGB")
-            except UnidentifiedImageError:
+                await io_pool.run(validate_image, image)
+            except ValueError:
                 raise HTTPException(
                     status_code=400, detail="Uploaded file is not a valid image."
                 )
 
         with tracer.start_as_current_span(
             "get-feature-vector", links=[Link(main_span.get_span_context())]
-        ):
-            feature = get_feature_vector(image_bytes)
+        ), timer.stage("embed"):
+            feature = await get_feature_vector(image)
+
+    with tracer.start_as_current_span(
+        "pinecone-search", links=[Link(main_span.get_span_context())]
+    ), timer.stage("query"):
+        vector_store = await get_connected(vector_store_connection)
+        matches = await io_pool.run(
+            search, vector_store, feature, top_k=count, reranker=reranker, timer=timer
+        )
+        retriever_vector_size_gauge.set(len(feature))
+
+    if query_cache:
+        await io_pool.run(query_cache.set, cache_key, feature, matches, endpoint)
+    return matches
+
+
+def parse_cursor(cursor: str) -> Tuple[str, int]:
+    token, _, offset = cursor.rpartition(".")
+    if not token or not offset.isdigit():
+        raise HTTPException(status_code=400, detail="Malformed cursor.")
+    return token, int(offset)
+
+
+@app.post("/search_image")
+async def search_image(
+    response: Response,
+    file: Optional[UploadFile] = File(None),
+    top_k: int = Query(Config.TOP_K, ge=1, le=Config.MAX_TOP_K),
+    offset: int = Query(0, ge=0),
+    min_score: Optional[float] = Query(None),
+    cursor: Optional[str] = Query(None),
+):
+    """Search with one image, a page at a time.
+
+    The first call embeds the image and fetches up to
+    ``Config.SEARCH_CANDIDATES`` candidates. While more remain after the
+    returned page, an ``X-Next-Cursor`` header refers to them; passing it
+    back as ``cursor`` (without a file) returns the next page without
+    embedding or querying again. URLs are signed for the returned page only.
+    """
+    search_counter.add(1, {"api": "/search_image"})
+    if file is None and cursor is None:
+        raise HTTPException(status_code=422, detail="Upload a file or pass a cursor.")
+    timer = StageTimer()
+    with tracer.start_as_current_span(
+        "search_image"
+    ) as main_span, request_metrics.track("/search_image", timer):
+        io_pool.admit()
+        main_span.set_attribute("top_k", top_k)
+        if cursor is not None:
+            token, offset = parse_cursor(cursor)
+            main_span.set_attribute("offset", offset)
+            with timer.stage("cursor"):
+                candidates = await io_pool.run(cursor_store.get, token)
+            if candidates is None:
+                raise HTTPException(
+                    status_code=410, detail="Cursor has expired; search again."
+                )
+        else:
+            token = None
+            check_upload(file, Config.MAX_UPLOAD_BYTES)
+            candidates = await find_candidates(
+                file.file,
+                max(Config.SEARCH_CANDIDATES, offset + top_k),
+                main_span,
+                timer,
+                "/search_image",
+            )
+
+        if min_score is not None:
+            candidates = [match for match in candidates if match["score"] >= min_score]
+        page = candidates[offset : offset + top_k]
+        if offset + top_k < len(candidates):
+            if token is None:
+                token = await io_pool.run(cursor_store.create, candidates)
+            if token is not None:
+                response.headers["X-Next-Cursor"] = f"{token}.{offset + top_k}"
+
+        if not page:
+            response.headers["Server-Timing"] = timer.header()
+            return []
 
         with tracer.start_as_current_span(
-            "pinecone-search", links=[Link(main_span.get_span_context())]
-        ):
-            search_start = time()
-            match_ids = search(index, feature, top_k=Config.TOP_K)
-            search_elapsed = time() - search_start
-            logger.info(f"Search completed in {search_elapsed:.4f} seconds")
-            labels = {"api": "/search_image"}
-            search_counter.add(1, labels)
-            search_histogram.record(search_elapsed, labels)
-            retriever_response_time_summary.observe(search_elapsed)
-            retriever_vector_size_gauge.set(len(feature))
-            if not match_ids:
-                return []
+            "generate-signed-urls", links=[Link(main_span.get_span_context())]
+        ), timer.stage("sign"):
+            bucket = await get_connected(bucket_connection)
+            signed_urls = await sign_urls(
+                bucket,
+                [match["metadata"].get("gcs_path", "") for match in page],
+                signed_url_cache,
+            )
+
+        results = format_results(page, signed_urls, top_k)
+    response.headers["Server-Timing"] = timer.header()
+    return results
+
+
+FUSION_MODES = ("none", "mean", "rrf")
+
+
+@app.post("/search_images")
+async def search_images(
+    response: Response,
+    files: List[UploadFile] = File(...),
+    fusion: str = Query("none"),
+):
+    """Search with several query images in one round trip.
+
+    With ``fusion=none`` the response holds one result list per image, in
+    upload order. ``mean`` searches once with the mean of the normalized
+    query embeddings and ``rrf`` merges the per-image result lists with
+    reciprocal-rank fusion; both return a single list.
+    """
+    search_counter.add(1, {"api": "/search_images"})
+    if fusion not in FUSION_MODES:
+        raise HTTPException(
+            status_code=400, detail=f"fusion must be one of {', '.join(FUSION_MODES)}"
+        )
+    if len(files) > Config.SEARCH_IMAGES_MAX_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {Config.SEARCH_IMAGES_MAX_FILES} query images.",
+        )
+    timer = StageTimer()
+    with tracer.start_as_current_span(
+        "search_images"
+    ) as main_span, request_metrics.track("/search_images", timer):
+        io_pool.admit()
+        main_span.set_attribute("image_count", len(files))
+        main_span.set_attribute("fusion", fusion)
+
+        for file in files:
+            check_upload(file, Config.MAX_UPLOAD_BYTES)
+        images = [file.file for file in files]
+        keys = await asyncio.gather(
+            *(
+                io_pool.run(file_digest, image) if query_cache else asyncio.sleep(0)
+                for image in images
+            )
+        )
+        cached = await asyncio.gather(
+            *(
+                (
+                    io_pool.run(query_cache.get, key, "/search_images")
+                    if query_cache
+                    else asyncio.sleep(0)
+                )
+                for key in keys
+            )
+        )
+        misses = [i for i, entry in enumerate(cached) if entry is None]
+        main_span.set_attribute("cache_hits", len(images) - len(misses))
 
         with tracer.start_as_current_span(
-            "fetch-from-pinecone", links=[Link(main_span.get_span_context())]
-        ):
-            response = index.fetch(ids=match_ids)
+            "validate-images", links=[Link(main_span.get_span_context())]
+        ), timer.stage("validate"):
+            outcomes = await asyncio.gather(
+                *(io_pool.run(validate_image, images[i]) for i in misses),
+                return_exceptions=True,
+            )
+            for position, outcome in zip(misses, outcomes):
+                if isinstance(outcome, ValueError):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Image at position {position} is not a valid image.",
+                    )
+                if isinstance(outcome, Exception):
+                    raise outcome
 
-        images_url = []
+        # All query images are embedded in one batch
         with tracer.start_as_current_span(
-            "generate-signed-urls", links=[Link(main_span.get_span_context())]
-        ):
-            for match_id in match_ids:
-                if len(images_url) == Config.TOP_K:
-                    break
-                if match_id in response.get("vectors", {}):
-                    metadata = response["vectors"][match_id].get("metadata", {})
-                    gcs_path = metadata.get("gcs_path", "")
-                    blob = bucket.blob(gcs_path)
-                    if not blob.exists():
-                        logger.warning(
-                            f"Image with GCS path {gcs_path} does not exist in bucket."
+            "get-feature-vectors", links=[Link(main_span.get_span_context())]
+        ), timer.stage("embed"):
+            embedded = await get_feature_vectors([images[i] for i in misses])
+        features = [entry["feature"] if entry else None for entry in cached]
+        for i, feature in zip(misses, embedded):
+            features[i] = feature
+
+        with tracer.start_as_current_span(
+            "pinecone-search", links=[Link(main_span.get_span_context())]
+        ), timer.stage("query"):
+            vector_store = await get_connected(vector_store_connection)
+            if fusion == "mean":
+                query = mean_embedding(features)
+                match_lists = [
+                    await io_pool.run(
+                        search,
+                        vector_store,
+                        query,
+                        top_k=Config.TOP_K,
+                        reranker=reranker,
+                    )
+                ]
+            else:
+                searched = await asyncio.gather(
+                    *(
+                        io_pool.run(
+                            search,
+                            vector_store,
+                            features[i],
+                            top_k=Config.TOP_K,
+                            reranker=reranker,
                         )
-                        continue
-                    signed_url = blob.generate_signed_url(
-                        version="v4",
-                        expiration=datetime.timedelta(hours=1),
-                        method="GET",
+                        for i in misses
                     )
-                    images_url.append(signed_url)
-                    logger.info(f"Found URL for match ID {match_id}")
-                else:
-                    logger.warning(f"Match ID {match_id} not found in response.")
-    return images_url
+                )
+                # /search_image caches up to SEARCH_CANDIDATES matches; a page
+                # is TOP_K, as for the lists searched here
+                match_lists = [
+                    entry["matches"][: Config.TOP_K] if entry else None
+                    for entry in cached
+                ]
+                for i, matches in zip(misses, searched):
+                    match_lists[i] = matches
+                    if query_cache:
+                        await io_pool.run(
+                            query_cache.set,
+                            keys[i],
+                            features[i],
+                            matches,
+                            "/search_images",
+                        )
+                if fusion == "rrf":
+                    match_lists = [
+                        reciprocal_rank_fusion(match_lists, Config.TOP_K, Config.RRF_K)
+                    ]
+
+        with tracer.start_as_current_span(
+            "generate-signed-urls", links=[Link(main_span.get_span_context())]
+        ), timer.stage("sign"):
+            bucket = await get_connected(bucket_connection)
+            # Each path is signed once even if several queries matched it
+            paths = [
+                match["metadata"].get("gcs_path", "")
+                for matches in match_lists
+                for match in matches
+            ]
+            signed_urls = dict(
+                zip(paths, await sign_urls(bucket, paths, signed_url_cache))
+            )
+
+        results = [
+            format_results(
+                matches,
+                [
+                    signed_urls[match["metadata"].get("gcs_path", "")]
+                    for match in matches
+                ],
+                Config.TOP_K,
+            )
+            for matches in match_lists
+        ]
+
+    response.headers["Server-Timing"] = timer.header()
+    return results if fusion == "none" else results[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from common.vector_store import LocalVectorStore, VectorStore
+
+
+class ExactReranker:
+    """Second stage of two-stage search: exact cosine over full-precision rows.
+
+    The rows live in a float32 ``LocalVectorStore`` at ``path``, written by
+    the ingesting service next to its primary index and memory-mapped here.
+    The store is reopened whenever the ingesting service has saved it again.
+    """
+
+    def __init__(self, path: str, dimension: int):
+        self.path = path
+        self.dimension = dimension
+        self._lock = threading.Lock()
+        self._store: Optional[LocalVectorStore] = None
+        self._version = None
+
+    def _current_store(self) -> LocalVectorStore:
+        try:
+            version = os.stat(os.path.join(self.path, "records.json")).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        with self._lock:
+            if self._store is None or version != self._version:
+                try:
+                    self._store = LocalVectorStore(self.dimension, path=self.path)
+                    self._version = version
+                except (FileNotFoundError, ValueError) as e:
+                    # Saved again while it was being opened; retried next query
+                    if self._store is None:
+                        raise
+                    logger.warning(f"Keeping the previous re-rank store: {e}")
+            return self._store
+
+    def rerank(
+        self,
+        vector: list,
+        candidates: list,
+        top_k: int,
+        fallback: Optional[VectorStore] = None,
+    ) -> list:
+        """Order ``candidates`` by exact cosine to ``vector`` and keep ``top_k``.
+
+        Candidates without a full-precision row (ingested since the store
+        was last saved, or before it existed) are scored from ``fallback``'s
+        copy of their vector. Any still without a score keep their
+        first-stage rank among the results, so none is dropped.
+        """
+        ids, rows = self._current_store().fetch_vectors(
+            [match["id"] for match in candidates]
+        )
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = dict(zip(ids, (rows @ query).tolist()))
+        missing = [match["id"] for match in candidates if match["id"] not in scores]
+        if missing and fallback is not None:
+            scores.update(self._fallback_scores(query, missing, fallback))
+        if len(scores) < len(candidates):
+            logger.warning(
+                f"{len(candidates) - len(scores)} of {len(candidates)} candidates "
+                f"have no full-precision vector to re-rank"
+            )
+        reranked = sorted(
+            (
+                {**match, "score": scores[match["id"]]}
+                for match in candidates
+                if match["id"] in scores
+            ),
+            key=lambda match: match["score"],
+            reverse=True,
+        )
+        for rank, match in enumerate(candidates):
+            if match["id"] not in scores:
+                reranked.insert(rank, match)
+        return reranked[:top_k]
+
+    @staticmethod
+    def _fallback_scores(query: np.ndarray, ids: list, fallback: VectorStore) -> dict:
+        try:
+            fetched = fallback.fetch(ids)
+        except Exception as e:
+            logger.warning(f"Could not fetch vectors to re-rank: {e}")
+            return {}
+        if not fetched:
+            return {}
+        found = list(fetched)
+        vectors = np.asarray(
+            [fetched[vector_id]["values"] for vector_id in found], dtype=np.float32
+        )
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return dict(zip(found, (vectors @ query).tolist()))
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Keep spans in process instead of sending them to the cluster's Jaeger agent
+os.environ.setdefault("TRACING_EXPORTER", "memory")
+# Run against the in-process vector store and a directory standing in for
+# the bucket, so the suite needs neither Pinecone nor GCS credentials
+os.environ.setdefault("VECTOR_STORE", "local")
+os.environ.setdefault("STORAGE_BACKEND", "local")
+os.environ.setdefault("LOCAL_BUCKET_PATH", tempfile.mkdtemp(prefix="test-bucket-"))
@@ -1,13 +1,25 @@
+import asyncio
 import os
 import sys
+import zipfile
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 import pytest
+import torch
+from PIL import Image
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
 
-from embedding.main import app
+from embedding.batching import MicroBatcher
+from embedding.cache import EmbeddingCache
+from embedding.main import app, extractor, model, run_warm_up, span_exporter
+from embedding.parity import parity_report
+from embedding.preprocessing import FastPreprocessor
+from embedding.projection import Projection, fit_projection
 
 client = TestClient(app)
 
@@ -29,6 +41,18 @@ def test_embedding_health():
     assert response.json()["status"] == "healthy"
 
 
+def test_embedding_ready_after_warm_up():
+    batches = "embedding_batch_size_images_count"
+    batches_before = REGISTRY.get_sample_value(batches, {"api": "/embed"}) or 0
+    assert client.get("/readyz").status_code == 503
+    asyncio.run(run_warm_up())
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ready"
+    # Warm-up runs as a batch of the batcher, which owns the preprocessor
+    assert REGISTRY.get_sample_value(batches, {"api": "/embed"}) == batches_before + 1
+
+
 def test_embed_valid_image(test_image_bytes):
     files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
     response = client.post("/embed", files=files)
@@ -38,6 +62,42 @@ def test_embed_valid_image(test_image_bytes):
     assert len(vector) > 0
 
 
+def test_embed_continues_callers_trace(test_image_bytes):
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    headers = {"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"}
+    response = client.post("/embed", files=files, headers=headers)
+    assert response.status_code == 200
+    spans = [
+        span
+        for span in span_exporter.get_finished_spans()
+        if span.name == "embed_image"
+    ]
+    assert format(spans[-1].context.trace_id, "032x") == trace_id
+    assert spans[-1].parent.span_id == 0x00F067AA0BA902B7
+
+
+def test_embed_binary_response(test_image_bytes):
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    json_vector = client.post("/embed", files=files).json()
+    response = client.post(
+        "/embed", files=files, headers={"Accept": "application/octet-stream"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+    vector = np.frombuffer(response.content, dtype="<f4")
+    assert np.allclose(vector, json_vector, atol=1e-5)
+
+
+def test_embed_preprocessed_pixels():
+    buffer = BytesIO()
+    np.save(buffer, np.zeros((224, 224, 3), dtype=np.uint8), allow_pickle=False)
+    files = {"file": ("image.npy", buffer.getvalue(), "application/x-npy")}
+    response = client.post("/embed", files=files)
+    assert response.status_code == 200
+    assert len(response.json()) > 0
+
+
 def test_embed_invalid_image_type(invalid_bytes):
     files = {"file": ("fake.txt", invalid_bytes, "text/plain")}
     response = client.post("/embed", files=files)
@@ -45,6 +105,191 @@ def test_embed_invalid_image_type(invalid_bytes):
     assert response.json()["detail"] == "Uploaded file is not a valid image."
 
 
+def test_embed_truncated_image(test_image_bytes):
+    truncated = test_image_bytes[: len(test_image_bytes) // 2]
+    files = {"file": ("truncated.jpeg", truncated, "image/jpeg")}
+    assert client.post("/embed", files=files).status_code == 400
+    files = [("files", ("truncated.jpeg", truncated, "image/jpeg"))]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Image at position 0 is not a valid image."
+
+
 def test_embed_no_file():
     response = client.post("/embed")
     assert response.status_code == 422
+
+
+def test_embed_batch_valid_images(test_image_bytes):
+    files = [
+        ("files", ("first.jpeg", test_image_bytes, "image/jpeg")),
+        ("files", ("second.jpeg", test_image_bytes, "image/jpeg")),
+    ]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 200
+    vectors = response.json()
+    assert len(vectors) == 2
+    assert len(vectors[0]) == len(vectors[1]) > 0
+
+
+def test_embed_batch_invalid_image(test_image_bytes, invalid_bytes):
+    files = [
+        ("files", ("first.jpeg", test_image_bytes, "image/jpeg")),
+        ("files", ("fake.txt", invalid_bytes, "text/plain")),
+    ]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Image at position 1 is not a valid image."
+
+
+def zip_archive(members: dict) -> bytes:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_embed_batch_archive(test_image_bytes):
+    archive = zip_archive({"a.jpeg": test_image_bytes, "b.jpeg": test_image_bytes})
+    files = [("files", ("images.zip", archive, "application/zip"))]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+
+def test_embed_batch_checks_magic_bytes(test_image_bytes):
+    # Decodable, but not one of the formats /embed accepts
+    bmp = BytesIO()
+    Image.new("RGB", (8, 8)).save(bmp, format="BMP")
+    archive = zip_archive({"a.jpeg": test_image_bytes, "b.bmp": bmp.getvalue()})
+    files = [
+        ("files", ("first.jpeg", test_image_bytes, "image/jpeg")),
+        ("files", ("images.zip", archive, "application/zip")),
+    ]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Image at position 2 is not a valid image."
+
+
+def test_embed_batch_archive_limits(test_image_bytes, monkeypatch):
+    monkeypatch.setattr("embedding.config.Config.EMBED_BATCH_MAX_IMAGES", 2)
+    archive = zip_archive({f"{i}.jpeg": test_image_bytes for i in range(3)})
+    files = [("files", ("images.zip", archive, "application/zip"))]
+    response = client.post("/embed_batch", files=files)
+    assert response.status_code == 413
+    assert response.json()["detail"] == "At most 2 images per batch."
+
+    # A few KiB that would expand to 64 MiB are refused before decompressing
+    monkeypatch.setattr("embedding.config.Config.MAX_UPLOAD_BYTES", 2**20)
+    bomb = zip_archive({"bomb.jpeg": bytes(64 * 2**20)})
+    assert len(bomb) < 2**20
+    files = [("files", ("bomb.zip", bomb, "application/zip"))]
+    assert client.post("/embed_batch", files=files).status_code == 413
+
+
+def test_embedding_cache_eviction_and_persistence(tmp_path):
+    path = str(tmp_path / "cache.npy")
+    evictions = []
+    cache = EmbeddingCache(
+        4, max_entries=2, path=path, on_evict=lambda: evictions.append(1)
+    )
+    cache.set("a", np.ones(4, dtype=np.float32))
+    cache.set("b", np.full(4, 2, dtype=np.float32))
+    assert cache.get("a") is not None  # "b" is now least recently used
+    cache.set("c", np.full(4, 3, dtype=np.float32))
+    assert cache.get("b") is None
+    assert len(evictions) == 1
+    cache.flush()
+
+    reopened = EmbeddingCache(4, max_entries=2, path=path)
+    assert len(reopened) == 2
+    assert np.array_equal(reopened.get("a"), np.ones(4, dtype=np.float32))
+    assert np.array_equal(reopened.get("c"), np.full(4, 3, dtype=np.float32))
+
+
+def test_torchscript_backend_parity(test_image_bytes):
+    image = Image.open(BytesIO(test_image_bytes)).convert("RGB")
+    pixel_values = extractor(images=[image], return_tensors="pt")["pixel_values"]
+    report = parity_report(model, pixel_values, "torchscript", int8=False)
+    assert report["min_cosine"] > 0.999
+
+
+def test_fast_preprocessor_matches_hf_processor(test_image_bytes):
+    image = Image.open(BytesIO(test_image_bytes)).convert("RGB")
+    expected = extractor(images=[image, image], return_tensors="pt")["pixel_values"]
+    preprocessor = FastPreprocessor(extractor, max_batch_size=4)
+    resized = preprocessor.resize(image)
+    actual = preprocessor([resized, resized])
+    assert actual.shape == expected.shape
+    assert torch.allclose(actual, expected, atol=1e-5)
+
+
+def test_projection_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((200, 8)) @ rng.standard_normal((8, 32))
+    projection, explained = fit_projection(vectors, 8)
+    assert explained > 0.999
+    projection.save(str(tmp_path / "projection.npz"))
+
+    loaded = Projection.load(str(tmp_path / "projection.npz"))
+    projected = loaded(torch.from_numpy(vectors.astype(np.float32)))
+    assert projected.shape == (200, 8)
+    # A rank-8 sample keeps its geometry in 8 dimensions
+    original = np.linalg.norm(vectors[0] - vectors[1])
+    assert np.isclose(
+        torch.dist(projected[0], projected[1]).item(), original, rtol=1e-3
+    )
+
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    batch_sizes = []
+
+    def process_batch(items):
+        batch_sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(process_batch, max_batch_size=4, max_wait_ms=50)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10]
+    assert batch_sizes == [4, 2]
+
+
+def test_micro_batcher_rejects_when_queue_is_full():
+    async def run():
+        batcher = MicroBatcher(
+            lambda items: items, max_batch_size=1, max_wait_ms=0, max_queue_size=2
+        )
+        tasks = [asyncio.ensure_future(batcher.submit(i)) for i in range(3)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], asyncio.QueueFull)
+
+
+def test_micro_batcher_queues_all_or_nothing():
+    processed = []
+
+    def process_batch(items):
+        processed.extend(items)
+        return items
+
+    async def run():
+        batcher = MicroBatcher(
+            process_batch, max_batch_size=4, max_wait_ms=0, max_queue_size=2
+        )
+        with pytest.raises(asyncio.QueueFull):
+            await batcher.submit_many([1, 2, 3])
+        results = await batcher.submit_many([4, 5])
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(run()) == [4, 5]
+    assert processed == [4, 5]
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import sys
 from pathlib import Path
@@ -10,13 +12,22 @@ from fastapi.testclient import TestClient
 
 @pytest.fixture(autouse=True)
 def mock_get_feature_vector(monkeypatch):
-    def fake_get_feature_vector(_):
+    async def fake_get_feature_vector(_):
         return [0.1] * 768
 
     monkeypatch.setattr("ingesting.main.get_feature_vector", fake_get_feature_vector)
 
+    async def fake_get_feature_vectors(images):
+        return [[0.1] * 768 for _ in images]
+
+    monkeypatch.setattr("ingesting.bulk.get_feature_vectors", fake_get_feature_vectors)
+
 
 from ingesting.main import app
+from ingesting.bulk import Checkpoint, IngestItem, IngestPipeline, iter_manifest
+from common.storage import LocalBucket
+from ingesting.utils import InvalidImageError, LazyConnection
+from common.vector_store import LocalVectorStore
 
 client = TestClient(app)
 
@@ -50,6 +61,126 @@ def test_push_image(test_image_bytes):
     assert response.status_code == 200
 
 
+def test_push_images(test_image_bytes, invalid_image_bytes):
+    files = [
+        ("files", ("first.jpeg", test_image_bytes, "image/jpeg")),
+        ("files", ("broken.jpeg", invalid_image_bytes, "image/jpeg")),
+        ("files", ("second.jpeg", test_image_bytes, "image/jpeg")),
+    ]
+    response = client.post("/push_images", files=files)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["failed"] == 1
+    statuses = [result["status"] for result in body["results"]]
+    assert statuses[0] in {"ingested", "duplicate"}
+    assert statuses[1:] == ["failed", "duplicate"]
+
+
+def test_push_duplicate_image(test_image_bytes):
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    first = client.post("/push_image", files=files).json()
+    second = client.post("/push_image", files=files).json()
+    assert second["duplicate"] is True
+    assert second["file_id"] == first["file_id"]
+    assert second["gcs_path"] == first["gcs_path"]
+
+
 def test_push_no_file():
     response = client.post(f"/push_image")
     assert response.status_code == 422  # validation error (missing file)
+
+
+def test_push_image_rejects_before_reading(
+    test_image_bytes, invalid_image_bytes, monkeypatch
+):
+    # Bad uploads are rejected before any dependency is needed
+    def unreachable():
+        raise ConnectionError("Dependency is down")
+
+    for name in ("vector_store", "bucket", "ingested_hashes"):
+        monkeypatch.setattr(
+            f"ingesting.main.{name}_connection",
+            LazyConnection(name, unreachable, cooldown_seconds=60),
+        )
+
+    files = {"file": ("fake.jpeg", invalid_image_bytes, "image/jpeg")}
+    response = client.post("/push_image", files=files)
+    assert response.status_code == 400
+
+    monkeypatch.setattr("ingesting.config.Config.MAX_UPLOAD_BYTES", 1024)
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    response = client.post("/push_image", files=files)
+    assert response.status_code == 413
+    response = client.post("/push_images", files=[("files", files["file"])])
+    assert response.status_code == 413
+
+    monkeypatch.setattr("ingesting.config.Config.MAX_UPLOAD_BYTES", 2**20)
+    response = client.post("/push_image", files=files)
+    assert response.status_code == 503
+    assert "retry-after" in response.headers
+
+
+def test_bulk_pipeline_fails_on_bad_manifest_line(test_image_bytes, tmp_path):
+    (tmp_path / "image.jpeg").write_bytes(test_image_bytes)
+    manifest = tmp_path / "images.jsonl"
+    manifest.write_text('{"path": "image.jpeg"}\nnot json\n')
+    pipeline = IngestPipeline(
+        LocalVectorStore(dimension=768),
+        LocalBucket(str(tmp_path / "bucket"), "test-bucket"),
+        embed_batch_size=1,
+    )
+    run = pipeline.run(iter_manifest(str(manifest)))
+    with pytest.raises(json.JSONDecodeError):
+        asyncio.run(asyncio.wait_for(run, timeout=10))
+
+
+def test_bulk_duplicate_is_settled_with_the_first_copy(test_image_bytes, tmp_path):
+    class FailingBucket(LocalBucket):
+        def blob(self, name, chunk_size=None):
+            blob = super().blob(name)
+            blob.upload_from_string = lambda *args, **kwargs: 1 / 0
+            return blob
+
+    checkpoint = Checkpoint(str(tmp_path / "ingest.ckpt"))
+    pipeline = IngestPipeline(
+        LocalVectorStore(dimension=768),
+        FailingBucket(str(tmp_path / "bucket"), "test-bucket"),
+        embed_batch_size=2,
+        checkpoint=checkpoint,
+    )
+    items = [
+        IngestItem(key, f"{key}.jpeg", lambda: test_image_bytes)
+        for key in ("first", "second")
+    ]
+    stats = asyncio.run(pipeline.run(items))
+    assert stats["failed"] == 2
+    assert stats["duplicates"] == 0
+    # Neither is checkpointed, so both are retried by the next run
+    assert checkpoint.done == set()
+
+
+def test_bulk_rejected_image_fails_alone(test_image_bytes, tmp_path, monkeypatch):
+    truncated = test_image_bytes[: len(test_image_bytes) // 2]
+
+    async def fake_get_feature_vectors(images):
+        if truncated in images:
+            position = images.index(truncated)
+            raise InvalidImageError(
+                f"Image at position {position} is not a valid image.", position
+            )
+        return [[0.1] * 768 for _ in images]
+
+    monkeypatch.setattr("ingesting.bulk.get_feature_vectors", fake_get_feature_vectors)
+    pipeline = IngestPipeline(
+        LocalVectorStore(dimension=768),
+        LocalBucket(str(tmp_path / "bucket"), "test-bucket"),
+        embed_batch_size=4,
+    )
+    payloads = [test_image_bytes + bytes(i) for i in range(3)] + [truncated]
+    items = [
+        IngestItem(str(i), f"{i}.jpeg", lambda data=data: data)
+        for i, data in enumerate(payloads)
+    ]
+    stats = asyncio.run(pipeline.run(items))
+    assert stats["ingested"] == 3
+    assert stats["failed"] == 1
@@ -1,22 +1,54 @@
+import asyncio
 import os
 import sys
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 import pytest
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
 
 
 @pytest.fixture(autouse=True)
 def mock_get_feature_vector(monkeypatch):
-    def fake_get_feature_vector(_):
+    async def fake_get_feature_vector(_):
         return [0.1] * 768
 
     monkeypatch.setattr("retriever.main.get_feature_vector", fake_get_feature_vector)
 
+    async def fake_get_feature_vectors(images):
+        return [[0.1] * 768 for _ in images]
 
-from retriever.main import app
+    monkeypatch.setattr("retriever.main.get_feature_vectors", fake_get_feature_vectors)
+
+
+from retriever.main import (
+    app,
+    bucket_connection,
+    connect_dependencies,
+    query_cache,
+    vector_store_connection,
+)
+from retriever.config import Config
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased
+
+from common.instrumentation import (
+    HeadSampler,
+    RecordOnlySampler,
+    TailSamplingProcessor,
+)
+from retriever.cache import InMemoryBackend, QueryCache
+from retriever.rerank import ExactReranker
+from retriever.utils import LazyConnection, search
+from common.uploads import file_digest
+from common.vector_store import LocalVectorStore, MirroredVectorStore
 
 client = TestClient(app)
 
@@ -27,6 +59,20 @@ def test_image_bytes():
         return f.read()
 
 
+@pytest.fixture(scope="module", autouse=True)
+def seeded_index(test_image_bytes):
+    """A few indexed images, in the local vector store and bucket of conftest."""
+    bucket = bucket_connection.connect()
+    vectors = []
+    for i in range(3):
+        gcs_path = f"images/seed-{i}.jpg"
+        bucket.blob(gcs_path).upload_from_string(test_image_bytes)
+        values = [0.1] * 768
+        values[i] = 1.0
+        vectors.append((f"seed-{i}", values, {"gcs_path": gcs_path}))
+    vector_store_connection.connect().upsert(vectors)
+
+
 @pytest.fixture(scope="session")
 def corrupted_image_bytes():
     return b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x02\x03"
@@ -44,16 +90,332 @@ def test_retriever_health():
 
 
 def test_search_image(test_image_bytes):
+    legacy = "retriever_response_time_summary_seconds_count"
+    legacy_before = REGISTRY.get_sample_value(legacy) or 0
     files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
     response = client.post(f"/search_image", files=files)
     assert response.status_code == 200
+    assert "query;dur=" in response.headers["Server-Timing"]
+    # The deprecated series is still recorded next to the new one
+    assert REGISTRY.get_sample_value(legacy) == legacy_before + 1
 
     result = response.json()
     assert isinstance(result, list)
     assert len(result) > 0
-    assert all(url.startswith("https://") for url in result)
+    assert all(match["url"] for match in result)
+    assert all({"id", "score", "filename"} <= match.keys() for match in result)
+
+
+def test_search_image_cache_hit(test_image_bytes, monkeypatch):
+    calls = []
+
+    async def counting_get_feature_vector(_):
+        calls.append(1)
+        return [0.2] * 768
+
+    monkeypatch.setattr(
+        "retriever.main.get_feature_vector", counting_get_feature_vector
+    )
+    # Trailing bytes give this upload its own cache key
+    image_bytes = test_image_bytes + b"cache-hit"
+    files = {"file": ("test_image.jpeg", image_bytes, "image/jpeg")}
+    first = client.post("/search_image", files=files)
+    second = client.post("/search_image", files=files)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert len(calls) == 1
+
+
+def test_search_image_pages_with_cursor(test_image_bytes):
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    first = client.post("/search_image?top_k=1", files=files)
+    assert first.status_code == 200
+    assert len(first.json()) == 1
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.post(f"/search_image?top_k=1&cursor={cursor}")
+    assert second.status_code == 200
+    assert second.json()[0]["id"] != first.json()[0]["id"]
+
+    expired = client.post("/search_image?cursor=unknown.1")
+    assert expired.status_code == 410
+
+
+def test_search_image_survives_cursor_store_failures(test_image_bytes, monkeypatch):
+    class DownBackend:
+        def get(self, key):
+            raise ConnectionError("Redis is down")
+
+        def set(self, key, value):
+            raise ConnectionError("Redis is down")
+
+    monkeypatch.setattr("retriever.main.cursor_store.backend", DownBackend())
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    response = client.post("/search_image?top_k=1", files=files)
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert "X-Next-Cursor" not in response.headers
+    assert client.post("/search_image?cursor=unknown.1").status_code == 410
+
+
+def test_search_images(test_image_bytes):
+    files = [
+        ("files", ("front.jpeg", test_image_bytes, "image/jpeg")),
+        ("files", ("side.jpeg", test_image_bytes + b"side", "image/jpeg")),
+    ]
+    response = client.post("/search_images", files=files)
+    assert response.status_code == 200
+    per_query = response.json()
+    assert len(per_query) == 2
+    assert all(isinstance(results, list) and results for results in per_query)
+
+    for fusion in ("mean", "rrf"):
+        fused = client.post(f"/search_images?fusion={fusion}", files=files).json()
+        assert isinstance(fused, list) and fused
+        assert all({"id", "score", "filename", "url"} <= m.keys() for m in fused)
+    # The repeated queries hit the query cache, counted under this endpoint
+    hits = REGISTRY.get_sample_value(
+        "retriever_query_cache_hits_total", {"api": "/search_images"}
+    )
+    assert hits >= 4
+
+
+def test_search_images_uses_a_page_of_cached_matches(test_image_bytes, monkeypatch):
+    image_bytes = test_image_bytes + b"long-cached-list"
+    matches = [
+        {"id": str(i), "score": 1.0, "metadata": {"gcs_path": f"images/{i}.jpg"}}
+        for i in range(50)
+    ]
+    query_cache.set(file_digest(BytesIO(image_bytes)), [0.1] * 768, matches)
+    signed = []
+
+    async def fake_sign_urls(bucket, paths, cache):
+        signed.extend(paths)
+        return paths
+
+    monkeypatch.setattr("retriever.main.sign_urls", fake_sign_urls)
+    files = [("files", ("query.jpeg", image_bytes, "image/jpeg"))]
+    response = client.post("/search_images", files=files)
+    assert response.status_code == 200
+    assert len(signed) == len(response.json()[0]) == Config.TOP_K
+
+
+def test_query_cache_evictions_are_labelled_with_the_caller():
+    evictions = []
+    cache = QueryCache(
+        InMemoryBackend(max_entries=1, max_bytes=2**20, ttl_seconds=60),
+        on_evict=evictions.append,
+    )
+    cache.set("a", [0.1], [], "/search_image")
+    cache.set("b", [0.1], [], "/search_images")
+    assert evictions == ["/search_images"]
+
+
+def test_search_corrupted_image(corrupted_image_bytes):
+    labels = {"endpoint": "/search_image", "stage": "validate", "status": "400"}
+    errors_before = REGISTRY.get_sample_value("retriever_request_errors_total", labels)
+    files = {"file": ("broken.jpeg", corrupted_image_bytes, "image/jpeg")}
+    response = client.post("/search_image", files=files)
+    assert response.status_code == 400
+    errors = REGISTRY.get_sample_value("retriever_request_errors_total", labels)
+    assert errors == (errors_before or 0) + 1
+    in_flight = REGISTRY.get_sample_value(
+        "retriever_requests_in_flight", {"endpoint": "/search_image"}
+    )
+    assert in_flight == 0
+
+
+def test_search_sheds_load_when_busy(test_image_bytes, monkeypatch):
+    monkeypatch.setattr("retriever.main.io_pool.max_pending", 0)
+    files = {"file": ("test_image.jpeg", test_image_bytes, "image/jpeg")}
+    response = client.post("/search_image", files=files)
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
 
 
 def test_search_no_file():
     response = client.post(f"/search_image")
     assert response.status_code == 422
+
+
+def test_ready_once_dependencies_connect(monkeypatch):
+    attempts = []
+
+    def flaky_connect():
+        attempts.append(len(attempts))
+        if len(attempts) < 3:
+            raise ConnectionError("Vector store is down")
+        return object()
+
+    dependency = LazyConnection("flaky store", flaky_connect, cooldown_seconds=60)
+    monkeypatch.setattr("retriever.main.dependencies", [dependency])
+    monkeypatch.setattr("retriever.utils.Config.STARTUP_RETRY_BACKOFF_SECONDS", 0)
+    assert client.get("/healthz").status_code == 200
+    assert client.get("/readyz").status_code == 503
+
+    with pytest.raises(ConnectionError):
+        dependency.get()
+    # Cooling down: fails fast without calling the remote API again
+    with pytest.raises(RuntimeError):
+        dependency.get()
+    assert len(attempts) == 1
+
+    asyncio.run(connect_dependencies())
+    assert len(attempts) == 3
+    assert client.get("/readyz").status_code == 200
+    assert REGISTRY.get_sample_value("retriever_startup_seconds") > 0
+
+
+def test_local_vector_store_query_and_persistence(tmp_path):
+    store = LocalVectorStore(dimension=3, path=str(tmp_path), flush_every=1)
+    store.upsert(
+        [
+            ("a", [1.0, 0.0, 0.0], {"gcs_path": "images/a.jpg"}),
+            ("b", [0.0, 1.0, 0.0], {"gcs_path": "images/b.jpg"}),
+            ("c", [1.0, 1.0, 0.0], {"gcs_path": "images/c.jpg"}),
+        ]
+    )
+    matches = store.query([1.0, 0.1, 0.0], top_k=2)
+    assert [match["id"] for match in matches] == ["a", "c"]
+    assert matches[0]["metadata"] == {"gcs_path": "images/a.jpg"}
+
+    store.delete(["a"])
+    reloaded = LocalVectorStore(dimension=3, path=str(tmp_path))
+    assert len(reloaded) == 2
+    assert reloaded.query([1.0, 0.1, 0.0], top_k=1)[0]["id"] == "c"
+    assert set(reloaded.fetch(["a", "b"])) == {"b"}
+
+
+@pytest.mark.parametrize("codec", ["float16", "int8"])
+def test_local_vector_store_quantized_codecs(tmp_path, codec):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((50, 16)).astype(np.float32)
+    store = LocalVectorStore(dimension=16, path=str(tmp_path), codec=codec)
+    store.upsert([(str(i), vector.tolist(), {}) for i, vector in enumerate(vectors)])
+    store.flush()
+
+    reloaded = LocalVectorStore(dimension=16, path=str(tmp_path), codec=codec)
+    assert reloaded._vectors.dtype == np.dtype(codec)
+    for i in (0, 17, 42):
+        assert reloaded.query(vectors[i].tolist(), top_k=1)[0]["id"] == str(i)
+    fetched = np.asarray(reloaded.fetch(["3"])["3"]["values"])
+    expected = vectors[3] / np.linalg.norm(vectors[3])
+    assert np.allclose(fetched, expected, atol=1e-2)
+    with pytest.raises(ValueError):
+        LocalVectorStore(dimension=16, path=str(tmp_path), codec="float32")
+
+
+def test_two_stage_search_reranks_exactly(tmp_path, monkeypatch):
+    monkeypatch.setattr("retriever.config.Config.RERANK_CANDIDATES", 20)
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((200, 32)).astype(np.float32)
+    store = MirroredVectorStore(
+        LocalVectorStore(dimension=32, codec="int8"),
+        LocalVectorStore(dimension=32, path=str(tmp_path)),
+    )
+    store.upsert([(str(i), vector.tolist(), {}) for i, vector in enumerate(vectors)])
+    store.flush()
+
+    query = vectors[7] + 0.5 * rng.standard_normal(32).astype(np.float32)
+    matches = search(
+        store, query.tolist(), 5, reranker=ExactReranker(str(tmp_path), 32)
+    )
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = normalized @ (query / np.linalg.norm(query))
+    assert [match["id"] for match in matches] == [
+        str(i) for i in np.argsort(-exact)[:5]
+    ]
+    assert np.allclose([match["score"] for match in matches], np.sort(exact)[::-1][:5])
+
+
+def test_local_vector_store_saves_whole_generations(tmp_path):
+    store = LocalVectorStore(dimension=3, path=str(tmp_path), flush_every=1)
+    store.upsert([("a", [1, 0, 0], {}), ("b", [0, 1, 0], {}), ("c", [0, 0, 1], {})])
+    store.delete(["a"])
+    store.upsert([("d", [1, 1, 0], {})])
+    # records.json names the current generation; only the one before is kept
+    assert sorted(os.listdir(tmp_path)) == [
+        "records.json",
+        "scales.2.npy",
+        "scales.3.npy",
+        "vectors.2.npy",
+        "vectors.3.npy",
+        "writer.lock",
+    ]
+
+    reranker = ExactReranker(str(tmp_path), 3)
+    candidates = [
+        {"id": "missing", "score": 0.99, "metadata": {}},
+        {"id": "c", "score": 0.5, "metadata": {}},
+        {"id": "d", "score": 0.4, "metadata": {}},
+    ]
+    # Candidates without a full-precision row keep their first-stage rank
+    matches = reranker.rerank([1, 1, 0], candidates, 2)
+    assert [match["id"] for match in matches] == ["missing", "d"]
+    assert np.isclose(matches[1]["score"], 1.0)
+    # ...unless the primary store has their vector, as for an unsaved upsert
+    primary = LocalVectorStore(dimension=3)
+    primary.upsert([("missing", [-1, 0, 0], {})])
+    matches = reranker.rerank([1, 1, 0], candidates, 3, fallback=primary)
+    assert [match["id"] for match in matches] == ["d", "c", "missing"]
+    assert np.isclose(matches[2]["score"], -(0.5**0.5))
+
+
+def test_local_vector_store_has_a_single_writer(tmp_path):
+    writer = LocalVectorStore(dimension=3, path=str(tmp_path))
+    writer.lock_writer()
+    other = LocalVectorStore(dimension=3, path=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        other.lock_writer()
+    other.upsert([("a", [1, 0, 0], {})])
+    with pytest.raises(RuntimeError):
+        other.flush()
+    writer.upsert([("a", [1, 0, 0], {})])
+    writer.flush()
+    assert len(LocalVectorStore(dimension=3, path=str(tmp_path))) == 1
+
+
+def test_tail_sampling_keeps_failed_traces_only():
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider(
+        sampler=ParentBased(
+            HeadSampler(0.0),
+            remote_parent_not_sampled=RecordOnlySampler(),
+            local_parent_not_sampled=RecordOnlySampler(),
+        )
+    )
+    provider.add_span_processor(
+        TailSamplingProcessor(SimpleSpanProcessor(exporter), slow_seconds=60)
+    )
+    tracer = provider.get_tracer("test")
+
+    with tracer.start_as_current_span("fast"):
+        with tracer.start_as_current_span("fast-child"):
+            pass
+    with pytest.raises(ValueError):
+        with tracer.start_as_current_span("failed"):
+            with tracer.start_as_current_span("failed-child"):
+                raise ValueError("boom")
+
+    exported = exporter.get_finished_spans()
+    assert sorted(span.name for span in exported) == ["failed", "failed-child"]
+    assert all(span.context.trace_flags.sampled for span in exported)
+
+
+def test_tail_sampling_holds_at_most_max_traces():
+    processor = TailSamplingProcessor(
+        SimpleSpanProcessor(InMemorySpanExporter()), slow_seconds=60, max_traces=2
+    )
+    provider = TracerProvider(sampler=RecordOnlySampler())
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer("test")
+
+    roots = [tracer.start_span(f"root-{i}") for i in range(5)]
+    for root in roots:
+        with trace.use_span(root, end_on_exit=False):
+            with tracer.start_as_current_span("child"):
+                pass
+        assert len(processor._pending) <= 2
+    for root in roots:
+        root.end()
+    assert not processor._pending